@@ -5,22 +5,98 @@ My ledger pal helps me to import CSV reports produced by my bank
 into Emacs using Ledger.
 
 Usage:
-  mypl.py [-dinv] <bank> <input> [-o OUTPUT]
+  mypl.py [-dinv] <bank> <input> [-o OUTPUT] [--shard PERIOD] [--no-cache]
+          [--memory-report FILE] [--route] [--since DATE] [--until DATE]
+          [--plan [--json]] [--checkpoint ROWS] [--resume]
+          [--balance AMOUNT] [--metrics FILE]
+  mypl.py --split PERIOD <ledger> [-dn]
+  mypl.py --reformat <ledger> [-dn] [--align] [--memory MB]
+  mypl.py --recategorize <ledger> [-dn]
+  mypl.py --learn <ledger> [-d] [--min-count N] [--save]
+  mypl.py --detect <statement>... [-d]
+  mypl.py --serve [-dv] [--socket FILE | --port PORT]
+  mypl.py --resources-to-sqlite <json> <db> [-d]
+  mypl.py --resources-to-json <db> <json> [-d]
   mypl.py (-l | --list) [-d --debug]
   mypl.py (-h | --help)
   mypl.py --version
 
 Options:
-  <bank>                  My bank.
-  <input>                 Input CSV file.
+  <bank>                  My bank, auto to detect it from the header of
+                          the statement.
+  <db>                    SQLite resources file.
+  <input>                 Input CSV, OFX or QFX file, it can be compressed
+                          (gzip, bz2, xz) or a zip archive of statements.
+  <json>                  JSON resources file.
+  <statement>             Statement file, see <input>.
+  <ledger>                Ledger file to split, reformat, recategorize or
+                          learn from.
+  --align                 Align the amounts of the reformatted entries.
+  --balance AMOUNT        Closing balance of the account of the statement,
+                          compared to the balance of its ledger account
+                          after the import like the balance column of the
+                          bank if it has one.
+  --checkpoint ROWS       Save the progress of the import every ROWS rows
+                          to resume it if it fails, the statement cache is
+                          only used to detect the imported statements then.
   -d, --debug             Print callstack.
+  --detect                Print the bank of each statement detected from
+                          its header.
   -h, --help              Show this help.
+  --json                  Print the plan as a JSON list of insertions.
   -i, --interactive       Will ask me for information about the posts before
                           writing them to my ledger file.
+  --learn                 Print the aliases and the rules learned from the
+                          entries of a ledger file which are not in my
+                          resources yet.
   -l, --list              List the available banks.
+  --memory MB             Memory used to sort the entries of --reformat,
+                          bigger ledgers are sorted in temporary files
+                          [default: 64].
+  --memory-report FILE    Write the memory used by each stage of the import
+                          to FILE as JSON.
+  --min-count N           Only learn the rules used by N entries or more
+                          [default: 1].
+  --metrics FILE          Write the counts and the durations of the import
+                          to FILE for monitoring, in the Prometheus text
+                          format if its extension is .prom, else appended
+                          as a JSON line.
   -n, --no-backup         Will not make a backup of the output file before
                           modifying it.
-  -o FILE --output FILE   My ledger file where to export the posts.
+  --no-cache              Do not use the cache of the parsed statements
+                          (default: ~/.cache/mylpl).
+  -o FILE --output FILE   My ledger file where to export the posts, - to
+                          write them to stdout instead (not interactive).
+  --plan                  Print the changes of the import as a unified diff
+                          instead of writing them.
+  --port PORT             Listen on this localhost TCP port instead of a
+                          Unix socket.
+  --recategorize          Resolve again the payee and the accounts of the
+                          entries to Expenses:Unknown with my current
+                          aliases and rules.
+  --reformat              Sort the entries of a ledger file by date and
+                          separate them with one empty line.
+  --resources-to-json     Export SQLite resources to a JSON file.
+  --resume                Resume the import from its last checkpoint, the
+                          checkpoints are saved every 10000 rows by default.
+  --save                  Add the learned aliases and rules to my resources.
+  --route                 Write the posts of each account to the "ledger"
+                          file of the account in the resources (relative to
+                          the output directory), the others to the output.
+  --resources-to-sqlite   Import JSON resources into a SQLite file, name it
+                          .mylplrc.db to use it instead of .mylplrc.
+  --serve                 Run the import service and keep my resources
+                          loaded between imports.
+  --since DATE            Only import the rows dated on or after DATE
+                          (YYYY/MM/DD).
+  --shard PERIOD          Write the posts in one ledger file per period
+                          (year or month) included by the output file.
+  --socket FILE           Unix socket of the import service
+                          (default: ~/.mylpl.sock).
+  --split PERIOD          Move the entries of a ledger file into one ledger
+                          file per period (year or month) and include them.
+  --until DATE            Only import the rows dated on or before DATE
+                          (YYYY/MM/DD).
   -v, --verbose           Print more information.
   --version               Show version.
 
@@ -28,28 +104,268 @@ Github repo: https://github.com/syl20bnr/myledgerpal
 '''
 from docopt import docopt
 import os
+import errno
 import shutil
 import csv
 import json
+import sqlite3
+import hashlib
+import marshal
 import time
 import re
-import fileinput
 import readline
+import resource
+import stat
+import contextlib
+import bisect
+import itertools
+import sys
+import heapq
+import tempfile
+import threading
+import uuid
+import SocketServer
+import socket
+import Queue
+import gzip
+import bz2
+import zipfile
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
 
 
 LEDGER_MODE_DIRECTIVE = "; -*- ledger -*-"
 
 ERR_BANK_UNKNOWN = "Unknown bank '{0}'"
+ERR_BANK_NOT_DETECTED = "Cannot detect the bank of {0} from its header."
 ERR_INPUT_UNKNOWN = "Prodived input file does not exist."
 ERR_UNDEFINED_COLUMN = "Column '{0}' is not defined for bank '{1}'"
 ERR_PERCENTAGE_SUM_NOT_EQUAL_TO_100 = "Sum of percentages is not equal to 100"
 ERR_WRONG_DATE_FORMAT = "Cannot parse date {0} with respect to format {1}"
+ERR_INVALID_REQUEST = "Invalid request: {0}"
+ERR_PERIOD_UNKNOWN = "Unknown period '{0}', use one of: {1}"
+ERR_SHARD_EXISTS = "Ledger file '{0}' already exists."
+ERR_FORMAT_UNKNOWN = "Unknown statement format '{0}' for bank '{1}'"
+ERR_CHECKPOINT_MISMATCH = ("The input changed before the checkpoint of "
+                           "{0}, import it again without --resume.")
+ERR_NOT_A_SOCKET = "'{0}' exists and is not a socket."
+ERR_SERVICE_RUNNING = "An import service is already listening on '{0}'."
+ERR_INTERACTIVE_STDOUT = ("The interactive mode needs the output to be a "
+                          "ledger file, not stdout.")
+ERR_COMPRESSION_UNSUPPORTED = ("Cannot read {0} compressed files, the lzma "
+                               "module is missing.")
+
+# leading bytes of the compressed files
+COMPRESSION_MAGICS = (('\x1f\x8b', 'gzip'),
+                      ('BZh', 'bz2'),
+                      ('\xfd7zXZ\x00', 'xz'),
+                      ('PK\x03\x04', 'zip'))
 
 
 def resources_filename():
     return ".mylplrc"
 
 
+def resources_db_filename():
+    return ".mylplrc.db"
+
+
+def cache_dirname():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.environ.get("HOME", os.getcwd()), ".cache")
+    return os.path.join(base, "mylpl")
+
+
+def get_rss():
+    ''' Current resident set size in bytes. '''
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except IOError:
+        # the peak is the best we can get
+        return get_peak_rss()
+
+
+def get_peak_rss():
+    ''' Peak resident set size in bytes. '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def parse_date(date, date_format="%Y/%m/%d"):
+    ''' Return the date as an integer YYYYMMDD, None stays None. '''
+    if date is None:
+        return None
+    try:
+        t = time.strptime(date, date_format)
+    except ValueError:
+        raise Exception(ERR_WRONG_DATE_FORMAT.format(date, date_format))
+    return t.tm_year * 10000 + t.tm_mon * 100 + t.tm_mday
+
+
+def get_compression(path):
+    ''' Name of the compression of the file at path as detected from its
+    first bytes, None if it isn't compressed. '''
+    with open(path, 'rb') as f:
+        head = f.read(max(len(m) for m, _ in COMPRESSION_MAGICS))
+    for magic, name in COMPRESSION_MAGICS:
+        if head.startswith(magic):
+            return name
+    return None
+
+
+def open_statements(path):
+    ''' Yield a readable file object for each statement stored at path:
+    the file itself, its decompressed content or each file of a zip
+    archive. Everything is decompressed on the fly. '''
+    compression = get_compression(path)
+    if compression == 'zip':
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if info.filename.endswith('/'):
+                    continue
+                f = _ZipMember(archive, info)
+                try:
+                    yield f
+                finally:
+                    f.close()
+        return
+    if compression == 'gzip':
+        f = gzip.GzipFile(path, 'rb')
+    elif compression == 'bz2':
+        f = bz2.BZ2File(path, 'rb')
+    elif compression == 'xz':
+        if lzma is None:
+            raise Exception(ERR_COMPRESSION_UNSUPPORTED.format(compression))
+        f = lzma.LZMAFile(path, 'rb')
+    else:
+        f = open(path, 'rb')
+    try:
+        yield f
+    finally:
+        f.close()
+
+
+def get_read_offset(f):
+    ''' Return the number of bytes of the file on the disk read so far
+    through the statement f of open_statements, None if it is unknown. '''
+    try:
+        return os.lseek(f.fileno(), 0, os.SEEK_CUR)
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+
+
+class _ZipMember(object):
+    ''' File of a zip archive which can be rewound, as for the other
+    statement files. '''
+
+    def __init__(self, archive, info):
+        self._archive = archive
+        self._info = info
+        self._file = archive.open(info)
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def __iter__(self):
+        return iter(self._file)
+
+    def readline(self):
+        return self._file.readline()
+
+    def seek(self, offset):
+        # a zip file can only be read forward, start over
+        assert offset == 0
+        self._file.close()
+        self._file = self._archive.open(self._info)
+
+    def close(self):
+        self._file.close()
+
+
+def get_size(paths):
+    ''' Return the total size of the existing files of paths. '''
+    return sum(os.path.getsize(p) for p in paths if os.path.exists(p))
+
+
+def socket_filename():
+    return ".mylpl.sock"
+
+
+def backup_file(path):
+    ''' Copy path to the first free path.bakN file and return it. '''
+    base = "{0}.bak".format(path)
+    i = 1
+    backup = "{0}{1}".format(base, str(i))
+    while os.path.exists(backup):
+        i += 1
+        backup = "{0}{1}".format(base, str(i))
+    shutil.copyfile(path, backup)
+    return backup
+
+
+class FileLock(object):
+    ''' Advisory lock shared by all the processes modifying path.
+
+    The lock is held on a companion file .<name>.lock so that path itself can
+    be replaced while locked. The companion file is removed on release.
+    Where fcntl is not available the lock does nothing.
+    '''
+
+    def __init__(self, path):
+        d, name = os.path.split(path)
+        self._path = os.path.join(d, ".{0}.lock".format(name))
+        self._file = None
+
+    def __enter__(self):
+        while True:
+            self._file = open(self._path, 'a')
+            if fcntl is None:
+                break
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+            # the file is not the lock anymore if it has been removed by
+            # its previous holder while we were waiting for it
+            try:
+                if (os.fstat(self._file.fileno()).st_ino ==
+                        os.stat(self._path).st_ino):
+                    break
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            self._file.close()
+        return self
+
+    def __exit__(self, *args):
+        try:
+            os.remove(self._path)
+        except OSError:
+            pass
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        self._file.close()
+        self._file = None
+
+
+def _is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
 def rlinput(prompt, prefill=''):
     readline.set_startup_hook(lambda: readline.insert_text(prefill))
     try:
@@ -63,37 +379,161 @@ def main():
         args = docopt(__doc__, version='My Ledger Pal (mylpl) v0.1')
         if args['--list']:
             MyLedgerPal.print_banks()
+        elif args['--serve']:
+            serve(args['--socket'], args['--port'], args['--verbose'])
+        elif args['--resources-to-sqlite']:
+            with open(args['<json>'], 'r') as f:
+                dct = json.load(f)
+            res = SQLiteResources(args['<db>'])
+            res.import_json(dct)
+            res.write()
+        elif args['--resources-to-json']:
+            res = SQLiteResources(args['<db>'])
+            with open(args['<json>'], 'w') as f:
+                json.dump(res.export_json(), f, indent=4, sort_keys=True)
+        elif args['--split']:
+            l = os.path.abspath(os.path.normpath(args['<ledger>']))
+            ledger = ShardedLedger(l, args['--split'])
+            if not args['--no-backup']:
+                print("Backup file '{0}' has been created.".format(
+                    backup_file(l)))
+            print("Number of shards: {0}".format(len(ledger.split())))
+        elif args['--reformat']:
+            l = os.path.abspath(os.path.normpath(args['<ledger>']))
+            if not args['--no-backup']:
+                print("Backup file '{0}' has been created.".format(
+                    backup_file(l)))
+            count = Ledger(l).reformat(args['--align'],
+                                       int(args['--memory']) << 20)
+            print("Number of entries: {0}".format(count))
+        elif args['--recategorize']:
+            l = os.path.abspath(os.path.normpath(args['<ledger>']))
+            res = MyLedgerPal.find_resources(l)
+            if not args['--no-backup']:
+                print("Backup file '{0}' has been created.".format(
+                    backup_file(l)))
+            print("Number of fixed entries: {0}".format(
+                Ledger(l).recategorize(res)))
+        elif args['--detect']:
+            signatures = StatementReader.get_bank_signatures()
+            for path in args['<statement>']:
+                bank = None
+                for f in open_statements(path):
+                    bank = StatementReader.detect_bank(f, signatures)
+                    break
+                print("{0}: {1}".format(path, bank or "unknown"))
+        elif args['--learn']:
+            l = os.path.abspath(os.path.normpath(args['<ledger>']))
+            res = MyLedgerPal.find_resources(l)
+            accounts = set(info.get("account")
+                           for info in res.get_accounts().values())
+            learned = Ledger(l).get_history(accounts).suggest(
+                res, int(args['--min-count']))
+            if args['--save']:
+                rules = Resources.rotate_rules(learned["rules"])
+                for desc, payee in learned["aliases"].items():
+                    res.add_alias(desc, payee)
+                for payee, split in rules.items():
+                    res.add_rule(payee, split.items())
+                res.write()
+                print("Number of learned aliases: {0}".format(
+                    len(learned["aliases"])))
+                print("Number of learned rules: {0}".format(len(rules)))
+            else:
+                print(json.dumps(learned, indent=4, sort_keys=True))
         else:
             o = ""
-            if args['--output']:
+            if args['--output'] == MyLedgerPal.STDOUT:
+                o = MyLedgerPal.STDOUT
+            elif args['--output']:
                 o = os.path.abspath(os.path.normpath(args['--output']))
             else:
                 o = os.path.splitext(args['<input>'])[0] + '.ledger'
             i = os.path.abspath(os.path.normpath(args['<input>']))
-            app = MyLedgerPal(args["<bank>"], i, o,
-                              args["--interactive"],
-                              args["--verbose"],
-                              args["--no-backup"])
-            app.run()
+            report = MemoryReport() if args["--memory-report"] else None
+            # the rows and the prompts show what is going on already
+            progress = (Progress(os.path.getsize(i))
+                        if Progress.is_enabled() and os.path.isfile(i) and
+                        not args["--verbose"] and not args["--interactive"]
+                        else None)
+            metrics = Metrics() if args["--metrics"] else None
+            try:
+                app = MyLedgerPal(args["<bank>"], i, o,
+                                  args["--interactive"],
+                                  args["--verbose"],
+                                  args["--no-backup"],
+                                  shard=args["--shard"],
+                                  cache=(None if args["--no-cache"]
+                                         else StatementCache(cache_dirname())),
+                                  memory_report=report,
+                                  route=args["--route"],
+                                  since=parse_date(args["--since"]),
+                                  until=parse_date(args["--until"]),
+                                  plan=(None if not args["--plan"] else
+                                        "json" if args["--json"] else "diff"),
+                                  checkpoint=(int(args["--checkpoint"])
+                                              if args["--checkpoint"] else
+                                              Checkpoint.ROWS
+                                              if args["--resume"] else None),
+                                  resume=args["--resume"],
+                                  balance=(int(round(
+                                      float(args["--balance"]) * 100))
+                                      if args["--balance"] else None),
+                                  progress=progress,
+                                  metrics=metrics)
+                app.run()
+                if metrics is not None:
+                    metrics.set("success", 1)
+            finally:
+                # a failed import is reported too
+                if metrics is not None:
+                    metrics.write(args["--metrics"])
+            if report is not None:
+                report.write(args["--memory-report"])
+                app._message("Peak memory: {0} bytes".format(
+                    report.get_peak()))
     except Exception as e:
+        # stdout may be the ledger entries read by the next command
+        out = (sys.stderr if args.get("--output") == MyLedgerPal.STDOUT
+               else sys.stdout)
         if args["--debug"]:
             import traceback
-            print traceback.format_exc()
+            out.write(traceback.format_exc() + '\n')
         else:
-            print("Error: {0}".format(str(e)))
+            out.write("Error: {0}\n".format(str(e)))
+
 
+class StatementReader(object):
+    ''' Turn the rows of a bank statement into resolved posts.
 
-class MyLedgerPal(object):
+    bank is either the name of one of the BANKS or a bank profile
+    dictionary. Nothing is read from or written to the disk so a statement
+    can be converted in-process:
+
+        reader = StatementReader('RBC', resources)
+        for text in reader.render(statement_file):
+            ...
+    '''
 
     BANK_COLNAME_ACC_NUM = 'acc_num'
     BANK_COLNAME_DATE = 'date'
     BANK_COLNAME_CHECK_NUM = 'check_num'
     BANK_COLNAME_DESC = 'desc'
     BANK_COLNAME_AMOUNT = 'amount'
+    # optional, balance of the account after the row
+    BANK_COLNAME_BALANCE = 'balance'
     BANK_ENCODING = 'encoding'
     BANK_QUOTE_CHAR = 'quotechar'
     BANK_DELIMITER = 'delimiter'
     BANK_DATE_FORMAT = 'date_format'
+    BANK_FORMAT = 'format'
+    # names of the columns of the first row, to detect the bank
+    BANK_HEADER = 'header'
+    # 'ascending' or 'descending' if the rows are sorted by date
+    BANK_SORTED = 'sorted'
+
+    FORMAT_CSV = 'csv'
+    FORMAT_OFX = 'ofx'
 
     BANKS = {
         'RBC': {BANK_ENCODING: "ISO-8859-1",
@@ -104,72 +544,186 @@ class MyLedgerPal(object):
                 BANK_COLNAME_DATE: 2,
                 BANK_COLNAME_CHECK_NUM: 3,
                 BANK_COLNAME_DESC: [4, 5],
-                BANK_COLNAME_AMOUNT: 6}}
-
-    @staticmethod
-    def print_banks():
-        print(MyLedgerPal._get_bank_helplist())
-
-    @staticmethod
-    def _get_bank_helplist():
-        l = ["Available banks:"]
-        for n in MyLedgerPal.BANKS:
-            l.append(n)
-        return os.linesep.join(l)
-
-    @staticmethod
-    def _get_resources_file_paths(output):
-        locs = [os.getcwd(), os.path.dirname(output)]
-        if "HOME" in os.environ:
-            locs.append(os.environ["HOME"])
-        return [os.path.join(loc, resources_filename())
-                for loc in locs]
-
-    def __init__(self, bank, input, output,
-                 interactive=False,
-                 verbose=False,
-                 no_backup=False):
+                BANK_COLNAME_AMOUNT: 6,
+                BANK_HEADER: [u"Type de compte", u"Num\xe9ro du compte",
+                              u"Date de l'op\xe9ration",
+                              u"Num\xe9ro du ch\xe8que", u"Description 1",
+                              u"Description 2", u"CAD", u"USD"]},
+        # OFX and QFX files of any bank, the ledger is written in UTF-8
+        'OFX': {BANK_FORMAT: FORMAT_OFX,
+                BANK_ENCODING: "UTF-8"}}
+
+    def __init__(self, bank, resources, verbose=False, since=None,
+                 until=None):
+        ''' Only the rows dated from since to until, integers YYYYMMDD,
+        are read when they are given. '''
         self._bank = bank
-        self._input = input
-        self._output = output
-        self._interactive = interactive
+        self._resources = resources
         self._verbose = verbose
-        self._backup = not no_backup
+        self._since = since
+        self._until = until
+        self._sorted = None
+        # rows out of the dates from since to until
+        self._skipped = 0
+        # the same dates come back row after row
+        self._dates = {}
         self._columns = {}
         self._encoding = ""
+        self._format = StatementReader.FORMAT_CSV
         self._quotechar = '"'
         self._delimiter = ","
-        self._resources = None
-        self._is_new_file = not os.path.exists(self._output)
         self._initialize_params()
 
-    def run(self):
-        if self._backup and os.path.exists(self._output):
-            self._backup_output()
-        with open(self._input, 'rb') as i:
-            self._run(i)
+    def posts(self, source, header=None):
+        ''' Lazily yield a post for each row of source which is either a
+        file-like object of the statement or an iterable of rows (lists of
+        cells).
+        header tells if the first row must be skipped, by default only the
+        first row of a file-like object is skipped.
+        '''
+        for row in self._rows(source, header):
+            yield self._create_post(row)
+
+    def render(self, source, header=None):
+        ''' Same as posts but yield the posts formatted for ledger. '''
+        for post in self.posts(source, header):
+            yield unicode(post)
 
     def _print(self, msg):
         if self._verbose:
             print(msg)
 
-    def _initialize_params(self):
-        # error checks
-        if self._bank not in MyLedgerPal.BANKS:
+    def _rows(self, source, header=None):
+        ''' Decoded rows of source, see posts. '''
+        if (hasattr(source, 'read') and
+                self._format == StatementReader.FORMAT_OFX):
+            # an OFX file has no header row
+            return self._filter_rows(iter(OFXReader(source)))
+        if hasattr(source, 'read'):
+            rows = self._csv_reader(source,
+                                    decode=False,
+                                    delimiter=self._delimiter,
+                                    quotechar=self._quotechar)
+            header = header is None or header
+        else:
+            rows = iter(source)
+        if header:
+            next(rows, None)
+        return (self._decode_row(row) for row in self._filter_rows(rows))
+
+    def _filter_rows(self, rows):
+        ''' Drop the rows out of the since/until range, only their raw
+        date is read. '''
+        if self._since is None and self._until is None:
+            return rows
+        return self._filter_dates(rows)
+
+    def _filter_dates(self, rows):
+        idx = self._columns[StatementReader.BANK_COLNAME_DATE]
+        for row in rows:
+            date = self._parse_date(row[idx])
+            if self._since is not None and date < self._since:
+                if self._sorted == 'descending':
+                    return
+                self._skipped += 1
+                continue
+            if self._until is not None and date > self._until:
+                if self._sorted == 'ascending':
+                    return
+                self._skipped += 1
+                continue
+            yield row
+
+    def get_skipped(self):
+        ''' Number of the rows skipped out of the dates so far, the rows
+        after the end of a sorted statement are not read. '''
+        return self._skipped
+
+    def _parse_rows(self, source, header=None):
+        ''' Lazily yield the normalised fields of each row of source, see
+        posts and _parse_row. '''
+        for row in self._rows(source, header):
+            self._print(u"Reading row: {0}".format(u",".join(row)))
+            yield self._parse_row(row)
+
+    @staticmethod
+    def get_bank_signatures():
+        ''' Return the table of the BANKS having a header, for each CSV
+        dialect the bank names by normalised header. '''
+        c = StatementReader
+        signatures = {}
+        for name, bank in c.BANKS.items():
+            if c.BANK_HEADER not in bank:
+                continue
+            dialect = (bank.get(c.BANK_ENCODING, ""),
+                       bank.get(c.BANK_DELIMITER, ","),
+                       bank.get(c.BANK_QUOTE_CHAR, '"'))
+            signatures.setdefault(dialect, {})[
+                c._normalise_header(bank[c.BANK_HEADER])] = name
+        return signatures
+
+    @staticmethod
+    def detect_bank(f, signatures=None):
+        ''' Return the name of the bank of the statement file object f,
+        None if it is unknown. Only the first line of f is read, its
+        normalised cells are looked up in signatures, the table of
+        get_bank_signatures. OFX statements are recognized by their header.
+        f is rewound.
+        '''
+        c = StatementReader
+        head = f.read(1024)
+        f.seek(0)
+        if 'OFXHEADER' in head or '<OFX' in head.upper():
+            for name, bank in sorted(c.BANKS.items()):
+                if bank.get(c.BANK_FORMAT) == c.FORMAT_OFX:
+                    return name
+        line = head.lstrip('\xef\xbb\xbf').splitlines()[0] if head else ''
+        if signatures is None:
+            signatures = c.get_bank_signatures()
+        for (encoding, delimiter, quotechar), names in signatures.items():
+            try:
+                cells = next(csv.reader([line], delimiter=str(delimiter),
+                                        quotechar=str(quotechar),
+                                        skipinitialspace=True), [])
+                if encoding:
+                    cells = [cell.decode(encoding) for cell in cells]
+            except (csv.Error, UnicodeDecodeError):
+                continue
+            name = names.get(c._normalise_header(cells))
+            if name is not None:
+                return name
+        return None
+
+    @staticmethod
+    def _normalise_header(cells):
+        return tuple(u" ".join(cell.lower().split()) for cell in cells)
+
+    def _check_bank(self):
+        if (not isinstance(self._bank, dict) and
+                self._bank not in StatementReader.BANKS):
             raise Exception(ERR_BANK_UNKNOWN.format(self._bank))
-        if not os.path.exists(self._input):
-            raise Exception(ERR_INPUT_UNKNOWN)
-        # more initializations
+
+    def _initialize_params(self):
+        self._check_bank()
         self._initialize_bank()
-        self._resources = self._load_resources()
 
     def _initialize_bank(self):
-        c = MyLedgerPal
+        c = StatementReader
         i = self._get_bank_colidx_definition(self._bank)
         self._encoding = i.get(c.BANK_ENCODING, "")
         self._quotechar = i.get(c.BANK_QUOTE_CHAR, '"')
         self._delimiter = i.get(c.BANK_DELIMITER, ",")
         self._date_format = i.get(c.BANK_DATE_FORMAT, "%Y/%m/%d")
+        self._format = i.get(c.BANK_FORMAT, c.FORMAT_CSV)
+        self._sorted = i.get(c.BANK_SORTED)
+        if self._format == c.FORMAT_OFX:
+            # the rows are built by the reader, in its own layout
+            self._date_format = OFXReader.DATE_FORMAT
+            self._columns.update(OFXReader.COLUMNS)
+            return
+        if self._format != c.FORMAT_CSV:
+            raise Exception(ERR_FORMAT_UNKNOWN.format(self._format,
+                                                      self._bank))
         self._columns[c.BANK_COLNAME_ACC_NUM] = i.get(
             c.BANK_COLNAME_ACC_NUM, -1)
         self._columns[c.BANK_COLNAME_CHECK_NUM] = i.get(
@@ -178,86 +732,37 @@ class MyLedgerPal(object):
             c.BANK_COLNAME_AMOUNT, -1)
         self._columns[c.BANK_COLNAME_DESC] = i.get(c.BANK_COLNAME_DESC, -1)
         self._columns[c.BANK_COLNAME_DATE] = i.get(c.BANK_COLNAME_DATE, -1)
+        if c.BANK_COLNAME_BALANCE in i:
+            self._columns[c.BANK_COLNAME_BALANCE] = i[c.BANK_COLNAME_BALANCE]
         # for now we don't allow undefined column indexes
         for k, v in self._columns.items():
             if v == -1:
                 raise Exception(ERR_UNDEFINED_COLUMN.format(k, self._bank))
 
-    def _load_resources(self):
-        ''' Resources are loaded from these locations:
-        - in the current working directory
-        - beside the location of the target ledger file
-        - in home
-        If the file is present in different places at the same
-        time then only the first encountered one will be processed.
-        '''
-        paths = MyLedgerPal._get_resources_file_paths(self._output)
-        data = None
-        i = 0
-        while data is None and i < len(paths):
-            data = self._get_resources_file_content(paths[i])
-            i += 1
-        if data:
-            return Resources(json.loads(data), paths[i-1], self._interactive)
-        else:
-            # no file exist
-            # write resource file in current working directory
-            return Resources({}, paths[0], self._interactive)
-
-    def _get_resources_file_content(self, path):
-        if os.path.exists(path):
-            with open(path, 'r') as f:
-                return f.read()
-        else:
-            return None
-
-    def _backup_output(self):
-        base = "{0}.bak".format(self._output)
-        i = 1
-        backup = "{0}{1}".format(base, str(i))
-        while os.path.exists(backup):
-            i += 1
-            backup = "{0}{1}".format(base, str(i))
-        shutil.copyfile(self._output, backup)
-        self._print_backup_msg(backup)
-        self._backup = backup
+    def _get_bank_colidx_definition(self, bank):
+        if isinstance(bank, dict):
+            return bank
+        return StatementReader.BANKS[bank]
 
-    def _print_backup_msg(self, backup):
-        print("Backup file '{0}' has been created in {1}.".format(
-            os.path.basename(backup),
-            os.path.dirname(backup)))
-
-    def _get_bank_colidx_definition(self, bankname):
-        return MyLedgerPal.BANKS[bankname]
-
-    def _csv_reader(self, data, dialect=csv.excel, **kwargs):
+    def _csv_reader(self, data, dialect=csv.excel, decode=True, **kwargs):
         # csv.py doesn't do Unicode; encode temporarily in the bank format
         csv_reader = csv.reader(data, dialect=dialect, **kwargs)
         while True:
             try:
                 row = next(csv_reader)
-                # decode back to Unicode, cell by cell:
-                if self._encoding:
-                    yield [unicode(cell, self._encoding) for cell in row]
-                else:
-                    yield [cell for cell in row]
+                yield self._decode_row(row) if decode else row
             except csv.Error as e:
                 # skip error on trailing NULL bytes
                 if "NULL byte" not in e.message:
                     raise csv.Error
 
-    def _run(self, i):
-        reader = self._csv_reader(
-            i, delimiter=self._delimiter, quotechar=self._quotechar)
-        # ensure output file exists
-        open(self._output, 'a').close()
-        # skip header
-        reader.next()
-        posts = [self._write_post(self._create_post(row))
-                 for row in reader]
-        if self._interactive:
-            self._resources.write()
-        print("Number of posts: {0}".format(len(posts)))
+    def _decode_row(self, row):
+        # decode back to Unicode, cell by cell:
+        if self._encoding:
+            return [unicode(cell, self._encoding)
+                    if isinstance(cell, str) else cell for cell in row]
+        else:
+            return [cell for cell in row]
 
     def _get_row_data(self, row, colname):
         if type(self._columns[colname]) is list:
@@ -273,7 +778,7 @@ class MyLedgerPal(object):
             return row[self._columns[colname]]
 
     def _get_row_date(self, row):
-        date = self._get_row_data(row, MyLedgerPal.BANK_COLNAME_DATE)
+        date = self._get_row_data(row, StatementReader.BANK_COLNAME_DATE)
         try:
             fdate = time.strptime(date, self._date_format)
         except ValueError:
@@ -281,55 +786,1197 @@ class MyLedgerPal(object):
                                                          self._date_format))
         return fdate
 
+    def _parse_date(self, date):
+        res = self._dates.get(date)
+        if res is None:
+            res = parse_date(date, self._date_format)
+            self._dates[date] = res
+        return res
+
     def _create_post(self, row):
         self._print(u"Reading row: {0}".format(u",".join(row)))
-        acc_num = self._get_row_data(row, MyLedgerPal.BANK_COLNAME_ACC_NUM)
-        date = self._get_row_date(row)
-        checknum = self._get_row_data(row, MyLedgerPal.BANK_COLNAME_CHECK_NUM)
-        desc = self._get_row_data(row, MyLedgerPal.BANK_COLNAME_DESC)
+        return self._resolve(self._parse_row(row))
+
+    def _parse_row(self, row):
+        ''' Return the normalised fields of a row: a tuple (account number,
+        date as an integer YYYYMMDD, check number, description, amount in
+        cents), followed by the balance in cents or None if the bank has a
+        balance column. '''
+        c = StatementReader
+        fields = (self._get_row_data(row, c.BANK_COLNAME_ACC_NUM),
+                  self._parse_date(self._get_row_data(row,
+                                                      c.BANK_COLNAME_DATE)),
+                  self._get_row_data(row, c.BANK_COLNAME_CHECK_NUM),
+                  self._get_row_data(row, c.BANK_COLNAME_DESC),
+                  int(round(float(self._get_row_data(
+                      row, c.BANK_COLNAME_AMOUNT)) * 100)))
+        if c.BANK_COLNAME_BALANCE in self._columns:
+            balance = self._get_row_data(row, c.BANK_COLNAME_BALANCE).strip()
+            fields += (int(round(float(balance) * 100)) if balance
+                       else None,)
+        return fields
+
+    def _resolve(self, fields):
+        ''' Return the post of the normalised fields of a row. '''
+        acc_num, date, checknum, desc, cents = fields[:5]
         payee = self._resources.get_payee(desc)
-        amount = self._get_row_data(row, MyLedgerPal.BANK_COLNAME_AMOUNT)
         return Post(self._resources.get_ledger_account(acc_num),
                     self._resources.get_currency(acc_num),
                     date,
                     checknum,
                     payee,
                     self._resources.get_payee_account(payee),
-                    float(amount))
+                    cents / 100.0)
 
-    def _write_post(self, post):
+    def _get_ledger_entry(self, post):
         upost = unicode(post)
         self._print(upost)
-        date = post.get_date()
-        rx = re.compile(r'^([0-9]{4}\/[0-9]{2}\/[0-9]{2}).*')
-        written = False
-        # write the post chronologically in output file
-        for line in fileinput.input(self._output, inplace=1, backup=".tmp"):
-            if fileinput.isfirstline():
-                if LEDGER_MODE_DIRECTIVE not in line:
-                    print(LEDGER_MODE_DIRECTIVE)
-            m = rx.match(line)
-            if not written and m is not None and m.group(1) > date:
-                written = True
-                if self._encoding:
-                    print(upost.encode(self._encoding))
-                else:
-                    print(upost)
-            print line,
-        if not written:
-            with open(self._output, 'a') as o:
-                if self._encoding:
-                    o.write('\n')
-                    o.write(upost.encode(self._encoding))
-                else:
-                    o.write('\n')
-                    o.write(upost)
+        if self._encoding:
+            upost = upost.encode(self._encoding)
+        return (post.get_date(), upost)
+
+
+class MyLedgerPal(StatementReader):
+
+    # output writing the posts to stdout, the messages go to stderr then
+    STDOUT = '-'
+    # bank detected from the header of the first statement of the input
+    AUTO = 'auto'
+    STDOUT_CHUNK_SIZE = 1 << 16
+
+    @staticmethod
+    def print_banks():
+        print(MyLedgerPal._get_bank_helplist())
+
+    @staticmethod
+    def _get_bank_helplist():
+        l = ["Available banks:"]
+        for n in StatementReader.BANKS:
+            l.append(n)
+        return os.linesep.join(l)
+
+    @staticmethod
+    def _get_resources_file_paths(output):
+        locs = [os.getcwd(), os.path.dirname(output)]
+        if "HOME" in os.environ:
+            locs.append(os.environ["HOME"])
+        return [os.path.join(loc, resources_filename())
+                for loc in locs]
+
+    def __init__(self, bank, input, output,
+                 interactive=False,
+                 verbose=False,
+                 no_backup=False,
+                 resources=None,
+                 shard=None,
+                 cache=None,
+                 memory_report=None,
+                 route=False,
+                 since=None,
+                 until=None,
+                 plan=None,
+                 checkpoint=None,
+                 resume=False,
+                 balance=None,
+                 progress=None,
+                 metrics=None):
+        ''' plan is 'diff' or 'json' to print what would be written
+        instead of writing it, see _print_plan.
+        checkpoint is the number of rows between two checkpoints, see
+        _read_checkpointed.
+        balance is the closing balance of the statement in cents, see
+        _check_balances.
+        progress is a Progress showing the stages of the import.
+        metrics is a Metrics where the counts and the durations of the
+        import are recorded. '''
+        self._input = input
+        self._output = output
+        self._interactive = interactive
+        self._backup = not no_backup
+        self._shard = shard
+        self._cache = cache
+        self._cache_keys = []
+        self._memory_report = memory_report
+        self._route = route
+        self._plan = plan
+        self._checkpoint = checkpoint
+        self._resume = resume
+        self._closing_balance = balance
+        self._progress = progress
+        self._metrics = metrics
+        # balances of the statement rows by account number and date
+        self._balances = {}
+        self._is_new_file = not os.path.exists(self._output)
+        super(MyLedgerPal, self).__init__(bank, resources, verbose, since,
+                                          until)
+
+    def run(self):
+        try:
+            if self._plan is not None:
+                self._print_plan()
+                return
+            if self._output == MyLedgerPal.STDOUT:
+                self._write_stdout(self._read_input())
+                return
+            # the shards to backup are only known once the posts are read
+            if (self._backup and os.path.exists(self._output) and
+                    not self._shard):
+                self._backup_output()
+            self._run()
+        finally:
+            if self._progress is not None:
+                self._progress.close()
+
+    def _print(self, msg):
+        if self._verbose:
+            self._message(msg)
+
+    def _message(self, msg):
+        if self._progress is not None:
+            self._progress.clear()
+        # keep stdout clean when the posts are written to it
+        if self._output == MyLedgerPal.STDOUT:
+            sys.stderr.write(msg + '\n')
+        else:
+            print(msg)
+
+    def _initialize_params(self):
+        # error checks
+        if self._bank != MyLedgerPal.AUTO:
+            self._check_bank()
+        if not os.path.exists(self._input):
+            raise Exception(ERR_INPUT_UNKNOWN)
+        if self._interactive and self._output == MyLedgerPal.STDOUT:
+            # the prompts would be mixed with the entries
+            raise Exception(ERR_INTERACTIVE_STDOUT)
+        if self._bank == MyLedgerPal.AUTO:
+            self._bank = self._detect_bank()
+        if self._shard and self._shard not in ShardedLedger.PERIODS:
+            raise Exception(ERR_PERIOD_UNKNOWN.format(
+                self._shard, ", ".join(ShardedLedger.PERIODS)))
+        # more initializations
+        self._initialize_bank()
+        if self._resources is None:
+            with self._stage('load-resources'):
+                self._resources = self._load_resources()
+
+    def _detect_bank(self):
+        for f in open_statements(self._input):
+            bank = StatementReader.detect_bank(f)
+            if bank is not None:
+                self._print("Detected bank: {0}".format(bank))
+                return bank
+            break
+        raise Exception(ERR_BANK_NOT_DETECTED.format(self._input))
+
+    @contextlib.contextmanager
+    def _stage(self, name, total=None, position=None):
+        ''' See Progress.stage for total and position. '''
+        if self._progress is not None:
+            self._progress.stage(name, total, position)
+        start = time.time()
+        try:
+            if self._memory_report is None:
+                yield
+            else:
+                with self._memory_report.stage(name):
+                    yield
+        finally:
+            self._count("stage_seconds", time.time() - start, stage=name)
+
+    def _count(self, name, value, **label):
+        if self._metrics is not None:
+            self._metrics.add(name, value, **label)
+
+    def _record_metrics(self, count):
+        ''' Record the counts of the import of count posts. '''
+        if self._metrics is None:
+            return
+        self._metrics.set("posts_written", count)
+        self._metrics.set("rows_skipped", self.get_skipped())
+        for name, value in self._resources.get_lookups().items():
+            self._metrics.set(name, value)
+
+    def _progressed(self, rows):
+        ''' Count rows in the progress as they are iterated. '''
+        if self._progress is None:
+            return rows
+        return self._count_rows(rows)
+
+    def _count_rows(self, rows):
+        for row in rows:
+            yield row
+            self._progress.update()
+
+    @staticmethod
+    def find_resources(output, interactive=False):
+        ''' Resources are loaded from these locations:
+        - in the current working directory
+        - beside the location of the target ledger file
+        - in home
+        If the file is present in different places at the same
+        time then only the first encountered one will be processed.
+        In each location a SQLite resources file is used in priority.
+        '''
+        paths = MyLedgerPal._get_resources_file_paths(output)
+        for path in paths:
+            db = os.path.join(os.path.dirname(path), resources_db_filename())
+            if os.path.exists(db):
+                return SQLiteResources(db, interactive)
+            data = MyLedgerPal._get_resources_file_content(path)
+            if data:
+                return Resources(json.loads(data), path, interactive)
+        # no file exist
+        # write resource file in current working directory
+        return Resources({}, paths[0], interactive)
+
+    def _load_resources(self):
+        res = MyLedgerPal.find_resources(self._output, self._interactive)
+        if self._interactive and os.path.isfile(self._output):
+            res.set_history(self._get_history(res))
+        return res
+
+    def _get_history(self, res):
+        accounts = set(info.get("account")
+                       for info in res.get_accounts().values())
+        return Ledger(self._output).get_history(accounts)
+
+    @staticmethod
+    def _get_resources_file_content(path):
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                return f.read()
+        else:
+            return None
+
+    def _backup_output(self):
+        with FileLock(self._output):
+            backup = backup_file(self._output)
+        self._print_backup_msg(backup)
+        self._backup = backup
+
+    def _print_backup_msg(self, backup):
+        if self._progress is not None:
+            self._progress.clear()
+        print("Backup file '{0}' has been created in {1}.".format(
+            os.path.basename(backup),
+            os.path.dirname(backup)))
+
+    def _run(self):
+        # ensure output file exists
+        open(self._output, 'a').close()
+        checkpoint = None
+        if self._checkpoint:
+            checkpoint, entries = self._read_checkpointed()
+            batches = {} if self._route else {self._output: []}
+            for path, date, text in entries:
+                batches.setdefault(path, []).append((date, text))
+            count = len(entries)
+        else:
+            outputs = [] if self._route else None
+            posts = self._read_input(outputs)
+            batches = self._get_batches(posts, outputs)
+            count = len(posts)
+        with self._stage('write'):
+            self._write_batches(batches)
+        if self._progress is not None:
+            self._progress.close()
+        if self._balances:
+            self._check_balances()
         if self._interactive:
             self._resources.write()
-        return post
+        for key in self._cache_keys:
+            self._cache.add_import(key, self._output)
+        # the import is over, there is nothing to resume anymore
+        if checkpoint is not None:
+            checkpoint.remove()
+        self._record_metrics(count)
+        print("Number of posts: {0}".format(count))
+
+    def _read_checkpointed(self):
+        ''' Same as _read_input but the rows are resolved one by one and
+        the entries are saved in a checkpoint every _checkpoint rows. With
+        _resume the rows before the last checkpoint are skipped without
+        being parsed.
+        Returns the checkpoint and the list of the entries with their
+        ledger file (path, date, text).
+        '''
+        checkpoint = Checkpoint(self._output, self._get_checkpoint_key())
+        entries = checkpoint.load() if self._resume else None
+        if entries is None:
+            if checkpoint.exists():
+                self._message("Warning: the checkpoint of {0} is "
+                              "ignored.".format(self._output))
+            checkpoint = Checkpoint(self._output, checkpoint.key)
+            entries = []
+        # an OFX file is read by chunks, its rows are counted instead
+        by_rows = self._format == StatementReader.FORMAT_OFX
+        routes = {}
+        pending = []
+        for n, i in enumerate(open_statements(self._input)):
+            if n < checkpoint.statement:
+                continue
+            if self._cache is not None:
+                self._check_imported(i)
+            f = _TrackedFile(i)
+            skip = 0
+            header = None
+            if n == checkpoint.statement and checkpoint.rows:
+                if by_rows:
+                    skip = checkpoint.rows
+                else:
+                    f.skip(checkpoint.offset)
+                    if f.get_digest() != checkpoint.digest:
+                        raise Exception(ERR_CHECKPOINT_MISMATCH.format(
+                            self._output))
+                    header = False
+            rows = skip
+            with self._stage('read', position=lambda: get_read_offset(i)):
+                for row in self._progressed(
+                        itertools.islice(self._rows(f, header), skip, None)):
+                    self._print(u"Reading row: {0}".format(u",".join(row)))
+                    fields = self._parse_row(row)
+                    self._add_balance(fields)
+                    path = self._output
+                    if self._route:
+                        if fields[0] not in routes:
+                            routes[fields[0]] = self._get_account_output(
+                                fields[0])
+                        path = routes[fields[0]]
+                    pending.append((path,) + self._get_ledger_entry(
+                        self._resolve(fields)))
+                    rows += 1
+                    if len(pending) >= self._checkpoint:
+                        checkpoint.save(pending, n, f.offset, f.get_digest(),
+                                        rows)
+                        # keep what has been learned so far too
+                        if self._interactive:
+                            self._resources.write()
+                        entries.extend(pending)
+                        pending = []
+            self._count("rows_read", rows - skip)
+        entries.extend(pending)
+        return checkpoint, entries
+
+    def _get_checkpoint_key(self):
+        return hashlib.sha1(repr((
+            Checkpoint.VERSION, self._input,
+            sorted(self._get_bank_colidx_definition(self._bank).items()),
+            self._since, self._until, self._route))).hexdigest()
+
+    def _check_imported(self, i):
+        ''' Warn if the statement i has already been imported in the
+        output, return its cache key. '''
+        profile = dict(self._get_bank_colidx_definition(self._bank))
+        if self._since is not None or self._until is not None:
+            # only the rows in the range are cached
+            profile['range'] = (self._since, self._until)
+        key = self._cache.get_key(i, profile)
+        self._cache_keys.append(key)
+        if self._cache.is_imported(key, self._output):
+            self._message("Warning: this statement has already been "
+                          "imported in {0}.".format(self._output))
+        return key
+
+    def _read_input(self, outputs=None):
+        ''' Posts of all the statements of the input, see
+        open_statements. '''
+        posts = []
+        for i in open_statements(self._input):
+            posts.extend(self._read_posts(i, outputs))
+        return posts
+
+    def _read_posts(self, i, outputs=None):
+        ''' Posts of the statement i, if outputs is a list the ledger
+        file of each post is appended to it. '''
+        rows = None
+        skipped = self._skipped
+        if self._cache is not None:
+            # the parsed rows are cached, only the resolution is done again
+            key = self._check_imported(i)
+            rows, cached = self._cache.load(key)
+            self._skipped += cached
+        if self._interactive:
+            cached = rows is not None
+            with self._stage('resolve'):
+                rows, posts = self._resolve_ahead(i, rows)
+            if not cached and self._cache is not None and self._plan is None:
+                self._cache.save(key, rows, self._skipped - skipped)
+        else:
+            if rows is None:
+                with self._stage('parse',
+                                 position=lambda: get_read_offset(i)):
+                    rows = list(self._progressed(self._parse_rows(i)))
+                if self._cache is not None and self._plan is None:
+                    self._cache.save(key, rows, self._skipped - skipped)
+            with self._stage('resolve', len(rows)):
+                posts = [self._resolve(r) for r in self._progressed(rows)]
+        self._count("rows_read", len(rows))
+        for r in rows:
+            self._add_balance(r)
+        if outputs is not None:
+            routes = {}
+            for r in rows:
+                if r[0] not in routes:
+                    routes[r[0]] = self._get_account_output(r[0])
+                outputs.append(routes[r[0]])
+        return posts
+
+    def _resolve_ahead(self, i, rows=None):
+        ''' Resolve the rows of the statement i, or the parsed rows, while
+        a worker thread parses the next rows and prepares the suggestions of
+        their prompts. The rows are still resolved in order by this thread
+        since an alias entered at a prompt can change the payee of the rows
+        after it.
+        Returns the parsed rows and their posts.
+        '''
+        queue = Queue.Queue()
+        stop = threading.Event()
+        errors = []
+
+        def work():
+            try:
+                for row in (self._rows(i) if rows is None else rows):
+                    if stop.is_set():
+                        break
+                    fields = self._parse_row(row) if rows is None else row
+                    queue.put((row, fields))
+                    self._resources.prefetch(fields[3])
+            except Exception:
+                errors.append(sys.exc_info())
+            queue.put(None)
+
+        worker = threading.Thread(target=work)
+        worker.daemon = True
+        worker.start()
+        parsed = []
+        posts = []
+        try:
+            for row, fields in iter(queue.get, None):
+                if rows is None:
+                    self._print(u"Reading row: {0}".format(u",".join(row)))
+                parsed.append(fields)
+                posts.append(self._resolve(fields))
+        finally:
+            stop.set()
+            worker.join()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return parsed, posts
+
+    def _add_balance(self, fields):
+        ''' Keep the balance of the row fields, and its date for the
+        closing balance, see _check_balances. '''
+        balance = fields[5] if len(fields) > 5 else None
+        if balance is None and self._closing_balance is None:
+            return
+        balances = self._balances.setdefault(fields[0], {}).setdefault(
+            fields[1], set())
+        if balance is not None:
+            balances.add(balance)
+
+    def _check_balances(self):
+        ''' Report the first date where the balance of an account in the
+        ledger differs from the statement. The order of the rows of a date
+        is not known so the balance at the end of a date has to be one of
+        the balances of its rows. The balances of the ledger are read from
+        its BalanceIndex, not from the whole ledger. '''
+        if self._shard:
+            self._message("Warning: the balances are not checked in the "
+                          "shards.")
+            return
+        if self._closing_balance is not None:
+            if len(self._balances) == 1:
+                dates = self._balances.values()[0]
+                dates[max(dates)] = set([self._closing_balance])
+            else:
+                self._message("Warning: the closing balance is not checked, "
+                              "the statement has several accounts.")
+        indexes = {}
+        for acc_num, dates in sorted(self._balances.items()):
+            account = self._resources.get_ledger_account(acc_num).keys()[0]
+            path = (self._get_account_output(acc_num) if self._route
+                    else self._output)
+            if path not in indexes:
+                indexes[path] = Ledger(path).get_balances()
+            for date in sorted(dates):
+                balance = indexes[path].get_balance(account, date)
+                if dates[date] and balance not in dates[date]:
+                    self._message(
+                        "Warning: the balance of {0} on {1:04d}/{2:02d}/"
+                        "{3:02d} is {4:.2f} in {5} instead of {6}.".format(
+                            account, date // 10000, date // 100 % 100,
+                            date % 100, balance / 100.0, path,
+                            " or ".join("{0:.2f}".format(b / 100.0)
+                                        for b in sorted(dates[date]))))
+                    break
+
+    def _get_account_output(self, acc_num):
+        ledger = self._resources.get_ledger(acc_num)
+        if not ledger:
+            return self._output
+        return os.path.normpath(os.path.join(os.path.dirname(self._output),
+                                             os.path.expanduser(ledger)))
+
+    def _print_plan(self):
+        ''' Print where the posts would be inserted, either as a unified
+        diff or as a JSON list. Each ledger file is only read once and
+        nothing is written. '''
+        outputs = [] if self._route else None
+        posts = self._read_input(outputs)
+        batches = self._get_batches(posts, outputs)
+        if self._shard:
+            # the include directives of new shards are not shown
+            shards = {}
+            for path, entries in batches.items():
+                ledger = ShardedLedger(path, self._shard)
+                for e in entries:
+                    shards.setdefault(ledger.get_shard_path(e[0]),
+                                      []).append(e)
+            batches = shards
+        planned = []
+        for path, entries in sorted(batches.items()):
+            ledger = Ledger(path)
+            if self._plan == 'json':
+                planned.extend(dict(i, ledger=path)
+                               for i in ledger.plan(entries))
+            else:
+                # patch only applies relative paths
+                for line in ledger.diff(entries,
+                                        name=os.path.relpath(path)):
+                    sys.stdout.write(line)
+        if self._plan == 'json':
+            print(json.dumps(planned, indent=4))
+
+    def _get_batches(self, posts, outputs=None):
+        ''' Ledger entries of the posts by output file, the output or, if
+        given, the ledger file of each post in outputs. '''
+        batches = {self._output: []} if outputs is None else {}
+        for n, p in enumerate(posts):
+            path = self._output if outputs is None else outputs[n]
+            batches.setdefault(path, []).append(self._get_ledger_entry(p))
+        return batches
+
+    def _write_stdout(self, posts):
+        ''' Write the entries of the posts sorted by date to stdout, with
+        one write per chunk of STDOUT_CHUNK_SIZE bytes. '''
+        entries = sorted((self._get_ledger_entry(p) for p in posts),
+                         key=lambda e: e[0])
+        chunk = []
+        size = 0
+        try:
+            for n, (_, text) in enumerate(entries):
+                if isinstance(text, unicode):
+                    text = text.encode('utf-8')
+                if n:
+                    chunk.append('\n')
+                chunk.append(text)
+                size += len(text) + 1
+                if size >= MyLedgerPal.STDOUT_CHUNK_SIZE:
+                    sys.stdout.write(''.join(chunk))
+                    chunk = []
+                    size = 0
+            sys.stdout.write(''.join(chunk))
+            sys.stdout.flush()
+        except IOError as e:
+            # the reader of the pipe is gone, e.g. head
+            if e.errno != errno.EPIPE:
+                raise
+        self._record_metrics(len(entries))
+        self._message("Number of posts: {0}".format(len(entries)))
+
+    def _write_batches(self, batches):
+        ''' Write the entries of each ledger file of batches. '''
+        if len(batches) == 1:
+            self._write_entries(*batches.items()[0])
+        else:
+            # the ledger files are independent, write them concurrently
+            errors = []
+
+            def write(path, entries):
+                try:
+                    self._write_entries(path, entries)
+                except Exception as e:
+                    errors.append(e)
+            threads = [threading.Thread(target=write, args=b)
+                       for b in batches.items()]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            if errors:
+                raise errors[0]
+            for path, entries in sorted(batches.items()):
+                print("Number of posts in {0}: {1}".format(path,
+                                                          len(entries)))
+
+    def _write_entries(self, path, entries):
+        # write all the entries chronologically in one pass over the file
+        if self._shard:
+            ledger = ShardedLedger(path, self._shard)
+            paths = ledger.get_shard_paths(entries)
+            for shard in paths:
+                if self._backup and os.path.exists(shard):
+                    self._print_backup_msg(backup_file(shard))
+            size = get_size(paths)
+            ledger.insert(entries)
+        else:
+            paths = [path]
+            size = get_size(paths)
+            ledger = Ledger(path)
+            # the output itself is backed up by run
+            backup = ledger.submit(
+                entries, bool(self._backup) and path != self._output and
+                os.path.exists(path))
+            if backup:
+                self._print_backup_msg(backup)
+        self._count("ledger_bytes_before", size, ledger=path)
+        self._count("ledger_bytes_after", get_size(paths), ledger=path)
+        self._count("bytes_rewritten", ledger.get_rewritten(), ledger=path)
+
+
+class OFXReader(object):
+    ''' Iterate over the transactions of an OFX or QFX statement, either
+    version 1 (SGML) or version 2 (XML).
+
+    The file is read by chunks so the memory used doesn't depend on its
+    size. Each transaction is a row of decoded cells laid out as described
+    by COLUMNS, ready for StatementReader._parse_row.
+    '''
+
+    COLUMNS = {StatementReader.BANK_COLNAME_ACC_NUM: 0,
+               StatementReader.BANK_COLNAME_DATE: 1,
+               StatementReader.BANK_COLNAME_CHECK_NUM: 2,
+               StatementReader.BANK_COLNAME_DESC: [3, 4],
+               StatementReader.BANK_COLNAME_AMOUNT: 5}
+    DATE_FORMAT = "%Y%m%d"
+    CHUNK_SIZE = 65536
+
+    # the text of an element stops at the next tag, with or without an end
+    # tag (SGML leaves them out)
+    TAG_RX = re.compile(r'<([^<>]*)>([^<]*)')
+    ENTITY_RX = re.compile(r'&(lt|gt|amp|quot|apos|nbsp);')
+    ENTITIES = {'lt': '<', 'gt': '>', 'amp': '&', 'quot': '"', 'apos': "'",
+                'nbsp': ' '}
+    XML_ENCODING_RX = re.compile(r'<\?xml[^>]*encoding=["\']([^"\']+)')
+    CHARSET_RX = re.compile(r'^CHARSET:\s*(\S+)', re.M)
+    ENCODING_RX = re.compile(r'^ENCODING:\s*(\S+)', re.M)
+
+    def __init__(self, f, encoding=None, chunk_size=CHUNK_SIZE):
+        self._file = f
+        self._encoding = encoding
+        self._chunk_size = chunk_size
+
+    def __iter__(self):
+        acc_num = ""
+        trn = None
+        for tag, text in self._elements():
+            if tag == 'STMTTRN':
+                trn = {}
+            elif tag == '/STMTTRN':
+                if trn is not None:
+                    yield self._get_row(acc_num, trn)
+                trn = None
+            elif trn is not None:
+                # the first one wins, e.g. NAME before PAYEE/NAME
+                trn.setdefault(tag, text)
+            elif tag == 'ACCTID':
+                acc_num = text
+
+    def _get_row(self, acc_num, trn):
+        return [acc_num,
+                trn.get('DTPOSTED', u"")[:8],
+                trn.get('CHECKNUM', u""),
+                trn.get('NAME', u""),
+                trn.get('MEMO', u""),
+                trn.get('TRNAMT', u"").replace(u",", u".")]
+
+    def _elements(self):
+        ''' Yield the (tag, text) of each start and end tag of the file,
+        the tags are upper case and the end tags start with '/'. '''
+        buf = ""
+        encoding = self._encoding
+        while True:
+            chunk = self._file.read(self._chunk_size)
+            buf += chunk
+            if encoding is None and (len(buf) >= self._chunk_size or
+                                     not chunk):
+                encoding = self._get_encoding(buf)
+            if encoding is None:
+                continue
+            # the last tag and its text may be cut, keep them for later
+            end = len(buf) if not chunk else buf.rfind('<')
+            if end > 0:
+                for m in self.TAG_RX.finditer(buf, 0, end):
+                    tag = m.group(1).strip().upper()
+                    if tag and tag[0] not in '?!':
+                        yield (tag, self._decode(m.group(2), encoding))
+                buf = buf[end:]
+            if not chunk:
+                break
+
+    def _decode(self, text, encoding):
+        text = self.ENTITY_RX.sub(lambda m: self.ENTITIES[m.group(1)],
+                                  text.strip())
+        return unicode(text, encoding, 'replace')
+
+    def _get_encoding(self, head):
+        ''' Encoding declared by the header of the file. '''
+        m = self.XML_ENCODING_RX.search(head)
+        if m:
+            return m.group(1)
+        if head.lstrip().startswith('<?xml'):
+            return "UTF-8"
+        m = self.ENCODING_RX.search(head)
+        if m and m.group(1).upper().replace('-', '') == 'UTF8':
+            return "UTF-8"
+        m = self.CHARSET_RX.search(head)
+        if m and m.group(1).isdigit():
+            return "cp" + m.group(1)
+        if m and m.group(1).upper() != 'NONE':
+            return m.group(1)
+        return "cp1252"
+
+
+class _TrackedFile(object):
+    ''' File read line by line, or by chunks, which keeps the number of
+    bytes read and their digest, see Checkpoint. '''
+
+    def __init__(self, f):
+        self._file = f
+        self._digest = hashlib.sha1()
+        self.offset = 0
+
+    def __iter__(self):
+        # no read-ahead, the offset stays at the end of the last line
+        for line in iter(self._file.readline, ''):
+            self._update(line)
+            yield line
+
+    def read(self, size=-1):
+        return self._update(self._file.read(size))
+
+    def skip(self, offset):
+        while self.offset < offset:
+            if not self.read(min(1 << 16, offset - self.offset)):
+                break
+
+    def get_digest(self):
+        return self._digest.hexdigest()
+
+    def _update(self, data):
+        self.offset += len(data)
+        self._digest.update(data)
+        return data
+
+
+class Checkpoint(object):
+    ''' Progress of an import saved beside its ledger file so that it can
+    be resumed if it fails.
+
+    The entries resolved since the last save are appended to a spill file
+    and the position of the import is saved with the size of the spill
+    file: the number of the statement, the byte offset in it with the
+    digest of the bytes before it, and the number of its rows read.
+    '''
+
+    VERSION = 1
+    ROWS = 10000
+
+    def __init__(self, output, key):
+        d, name = os.path.split(output)
+        self._path = os.path.join(d, ".{0}.checkpoint".format(name))
+        self._size = 0
+        self.key = key
+        self.statement = 0
+        self.offset = 0
+        self.digest = None
+        self.rows = 0
+
+    def exists(self):
+        return os.path.exists(self._path)
+
+    def load(self):
+        ''' Return the saved entries if there is a checkpoint of the same
+        import, None otherwise. '''
+        try:
+            with open(self._path, 'rb') as f:
+                state = marshal.load(f)
+            if (state.get("version") != Checkpoint.VERSION or
+                    state.get("key") != self.key):
+                return None
+            entries = []
+            with open(self._path + '.entries', 'rb') as f:
+                while f.tell() < state["size"]:
+                    entries.append(marshal.load(f))
+        except (IOError, EOFError, ValueError, TypeError, AttributeError):
+            return None
+        self._size = state["size"]
+        self.statement = state["statement"]
+        self.offset = state["offset"]
+        self.digest = state["digest"]
+        self.rows = state["rows"]
+        return entries
+
+    def save(self, entries, statement, offset, digest, rows):
+        ''' Spill the entries resolved since the last save and save the
+        position of the import after them. '''
+        # what was spilled after the last save is garbage
+        mode = 'r+b' if self._size else 'wb'
+        with open(self._path + '.entries', mode) as f:
+            f.seek(self._size)
+            f.truncate()
+            for e in entries:
+                marshal.dump(e, f)
+            f.flush()
+            os.fsync(f.fileno())
+            self._size = f.tell()
+        self.statement = statement
+        self.offset = offset
+        self.digest = digest
+        self.rows = rows
+        with open(self._path + '.tmp', 'wb') as f:
+            marshal.dump({"version": Checkpoint.VERSION,
+                          "key": self.key,
+                          "size": self._size,
+                          "statement": statement,
+                          "offset": offset,
+                          "digest": digest,
+                          "rows": rows}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(self._path + '.tmp', self._path)
+
+    def remove(self):
+        for path in (self._path, self._path + '.entries'):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class StatementCache(object):
+    ''' Cache of the parsed rows of the statements.
+
+    The rows are identified by the hash of the content of the statement and
+    of the bank profile, they are stored in a compact binary format with the
+    number of rows skipped out of the dates. The ledger files in which a
+    statement has been imported are remembered too.
+
+    The entries not used for max_age seconds are removed, and the least
+    recently used ones when the cache grows over max_size bytes.
+    '''
+
+    VERSION = 2
+    MAX_AGE = 90 * 24 * 3600
+    MAX_SIZE = 64 << 20
+
+    def __init__(self, directory, max_age=MAX_AGE, max_size=MAX_SIZE):
+        self._directory = directory
+        self._max_age = max_age
+        self._max_size = max_size
+
+    def get_key(self, f, profile):
+        ''' Hash the content of the file object f, f is rewound. '''
+        h = hashlib.sha1(repr((StatementCache.VERSION,
+                               sorted(profile.items()))))
+        for chunk in iter(lambda: f.read(1 << 16), ''):
+            h.update(chunk)
+        f.seek(0)
+        return h.hexdigest()
+
+    def load(self, key):
+        ''' Return the rows and the number of skipped rows saved with key,
+        (None, 0) if there are none. '''
+        path = self._get_path(key, 'rows')
+        try:
+            with open(path, 'rb') as f:
+                rows, skipped = marshal.load(f)
+            # the entry is used, it is the last one to be pruned
+            os.utime(path, None)
+            return rows, skipped
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None, 0
+
+    def save(self, key, rows, skipped=0):
+        self._write(self._get_path(key, 'rows'),
+                    marshal.dumps((rows, skipped)))
+        self._prune()
+
+    def is_imported(self, key, output):
+        return output in self._get_imports(key)
+
+    def add_import(self, key, output):
+        imports = self._get_imports(key)
+        if output not in imports:
+            self._write(self._get_path(key, 'imports'),
+                        json.dumps(imports + [output]))
+
+    def _get_imports(self, key):
+        try:
+            with open(self._get_path(key, 'imports'), 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return []
+
+    def _get_path(self, key, ext):
+        return os.path.join(self._directory, "{0}.{1}".format(key, ext))
+
+    def _write(self, path, data):
+        if not os.path.isdir(self._directory):
+            os.makedirs(self._directory)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.rename(path + '.tmp', path)
+
+    def _prune(self):
+        ''' Remove the files too old, then the least recently used ones
+        until the cache fits in max_size. '''
+        files = []
+        for name in os.listdir(self._directory):
+            path = os.path.join(self._directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+        files.sort(reverse=True)
+        now = time.time()
+        size = 0
+        for mtime, file_size, path in files:
+            if (now - mtime <= self._max_age
+                    and size + file_size <= self._max_size):
+                size += file_size
+            else:
+                try:
+                    os.remove(path)
+                except OSError:
+                    # removed by another import
+                    pass
+
+
+class MemoryReport(object):
+    ''' Memory used by the stages of an import.
+
+    With tracemalloc the traced memory and the top allocation sites of each
+    stage are reported, without it (Python 2) only the resident set size
+    is.
+    '''
+
+    def __init__(self, top=10):
+        self._top = top
+        self._stages = []
+        if tracemalloc is not None and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.time()
+        if tracemalloc is not None:
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            before = tracemalloc.take_snapshot()
+        else:
+            before = get_rss()
+        try:
+            yield
+        finally:
+            stats = {"name": name, "seconds": time.time() - start}
+            if tracemalloc is not None:
+                current, peak = tracemalloc.get_traced_memory()
+                after = tracemalloc.take_snapshot()
+                stats["current_bytes"] = current
+                stats["peak_bytes"] = peak
+                stats["top"] = [
+                    {"site": "{0}:{1}".format(d.traceback[0].filename,
+                                              d.traceback[0].lineno),
+                     "size_bytes": d.size_diff,
+                     "count": d.count_diff}
+                    for d in after.compare_to(before, 'lineno')[:self._top]]
+            else:
+                stats["current_bytes"] = get_rss()
+                stats["delta_bytes"] = stats["current_bytes"] - before
+                stats["peak_bytes"] = get_peak_rss()
+            self._stages.append(stats)
+
+    def get_peak(self):
+        return max([s["peak_bytes"] for s in self._stages] or [0])
+
+    def to_dict(self):
+        return {"tracemalloc": tracemalloc is not None,
+                "peak_bytes": self.get_peak(),
+                "stages": self._stages}
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=4)
+
+
+class Metrics(object):
+    ''' Counters and durations of an import for monitoring.
+
+    Each metric has a value or one value by label, e.g. by stage. The
+    metrics are written in the Prometheus text format, to be read by the
+    textfile collector of the node exporter, or appended as one JSON line.
+    '''
+
+    PREFIX = "mylpl_"
+
+    def __init__(self):
+        self._start = time.time()
+        # name: (label name, {label: value}) or (None, value)
+        self._metrics = {}
+        # the ledger files are written by concurrent threads
+        self._lock = threading.Lock()
+        self.set("success", 0)
+
+    def set(self, name, value, **label):
+        ''' Set the metric name, label is at most one label=value. '''
+        if label:
+            (key, l), = label.items()
+            self._metrics.setdefault(name, (key, {}))[1][l] = value
+        else:
+            self._metrics[name] = (None, value)
+
+    def add(self, name, value=1, **label):
+        with self._lock:
+            if label:
+                (key, l), = label.items()
+                values = self._metrics.setdefault(name, (key, {}))[1]
+                values[l] = values.get(l, 0) + value
+            else:
+                self._metrics[name] = (
+                    None, self._metrics.get(name, (None, 0))[1] + value)
+
+    def to_dict(self):
+        ''' The metrics by name, a dictionary by label for the labelled
+        ones. '''
+        dct = {"timestamp": self._start,
+               "seconds": time.time() - self._start}
+        for name, (key, value) in self._metrics.items():
+            dct[name] = dict(value) if key is not None else value
+        return dct
+
+    def to_prometheus(self):
+        dct = self.to_dict()
+        lines = []
+        for name in sorted(dct):
+            metric = Metrics.PREFIX + name
+            key = self._metrics.get(name, (None,))[0]
+            lines.append("# TYPE {0} gauge".format(metric))
+            if key is None:
+                lines.append("{0} {1}".format(metric, dct[name]))
+                continue
+            for l, value in sorted(dct[name].items()):
+                lines.append('{0}{{{1}="{2}"}} {3}'.format(
+                    metric, key, l.replace('\\', '\\\\')
+                    .replace('"', '\\"').replace('\n', '\\n'), value))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        ''' Replace path with the Prometheus metrics if its extension is
+        .prom, append a JSON line to it otherwise. '''
+        if path.endswith('.prom'):
+            # the collector must never read a partial file
+            with open(path + '.tmp', 'w') as f:
+                f.write(self.to_prometheus())
+            os.rename(path + '.tmp', path)
+        else:
+            with open(path, 'a') as f:
+                f.write(json.dumps(self.to_dict(), sort_keys=True) + '\n')
+
+
+class Progress(object):
+    ''' Progress of an import shown on one line of stderr: the current
+    stage, the rows processed and their rate, the part of the input read and
+    the estimated time left. The line is redrawn at most every INTERVAL
+    seconds.
+    '''
+
+    INTERVAL = 0.25
+
+    @staticmethod
+    def is_enabled(out=None):
+        ''' The progress is only shown on a terminal. '''
+        out = out or sys.stderr
+        return hasattr(out, 'isatty') and out.isatty()
+
+    def __init__(self, size=None, out=None):
+        ''' size is the number of bytes of the input. '''
+        self._out = out or sys.stderr
+        self._size = size
+        self._name = None
+        self._total = None
+        self._position = None
+        self._rows = 0
+        self._start = time.time()
+        self._next = 0
+        self._width = 0
+
+    def stage(self, name, total=None, position=None):
+        ''' Start the stage name, total is its number of rows if it is
+        known and position a function returning the bytes of the input read
+        so far, see get_read_offset. '''
+        self._name = name
+        self._total = total
+        self._position = position
+        self._rows = 0
+        self._start = time.time()
+        self._show(self._start)
+
+    def update(self, rows=1):
+        self._rows += rows
+        now = time.time()
+        if now >= self._next:
+            self._show(now)
+
+    def clear(self):
+        ''' Erase the line before printing something else. '''
+        if self._width:
+            self._out.write('\r' + ' ' * self._width + '\r')
+            self._out.flush()
+            self._width = 0
+
+    def close(self):
+        ''' Show the last state of the progress and keep it. '''
+        if self._width:
+            self._show(time.time())
+            self._out.write('\n')
+            self._out.flush()
+            self._width = 0
+
+    def _show(self, now):
+        self._next = now + Progress.INTERVAL
+        elapsed = now - self._start
+        if not self._rows and not self._total:
+            # a stage which doesn't go through the rows
+            parts = ["{0:.0f}s".format(elapsed)]
+        else:
+            parts = ["{0} rows".format(self._rows)]
+            if elapsed > 0:
+                parts.append("{0:.0f} rows/s".format(self._rows / elapsed))
+        done = float(self._rows) / self._total if self._total else None
+        read = self._position() if self._position is not None else None
+        if read is not None and self._size:
+            parts.append("{0:.1f}/{1:.1f} MB".format(read / float(1 << 20),
+                                                     self._size /
+                                                     float(1 << 20)))
+            if done is None:
+                done = min(float(read) / self._size, 1.0)
+        if done:
+            parts.append("{0:.0f}%".format(done * 100))
+            parts.append("ETA {0:.0f}s".format(elapsed * (1 - done) / done))
+        line = "{0}: {1}".format(self._name, ", ".join(parts))
+        self._out.write('\r' + line + ' ' * max(self._width - len(line), 0))
+        self._out.flush()
+        self._width = len(line)
 
 
 class Post(object):
+    ''' A post is kept compact since large imports hold a lot of them in
+    memory: no instance dictionary, the date is stored as an integer
+    YYYYMMDD and the amount as an integer number of cents. '''
+
+    __slots__ = ('_account', '_currency', '_date', '_cnum', '_payee',
+                 '_payee_accounts', '_comment', '_cents')
 
     POST_ACCOUNT_ALIGNMENT = ' '*4
     POST_AMOUNT_ALIGNMENT = 62
@@ -355,8 +2002,11 @@ class Post(object):
                  payee,
                  payee_accounts,
                  amount):
+        ''' date is either a time.struct_time or an integer YYYYMMDD. '''
         self._account = account
         self._currency = currency
+        if not isinstance(date, int):
+            date = date.tm_year * 10000 + date.tm_mon * 100 + date.tm_mday
         self._date = date
         self._cnum = checknum
         self._payee = payee
@@ -364,6 +2014,14 @@ class Post(object):
         self._comment = ""
         self._amount = amount
 
+    @property
+    def _amount(self):
+        return self._cents / 100.0
+
+    @_amount.setter
+    def _amount(self, amount):
+        self._cents = int(round(amount * 100))
+
     def get_date(self):
         return self._format_date()
 
@@ -393,7 +2051,9 @@ class Post(object):
         return spacing if spacing > 0 else 1
 
     def _format_date(self):
-        return time.strftime("%Y/%m/%d", self._date)
+        return "{0:04d}/{1:02d}/{2:02d}".format(self._date // 10000,
+                                                self._date // 100 % 100,
+                                                self._date % 100)
 
     def _format_payee_accounts(self):
         acc = self._account if self._amount >= 0 else self._payee_accounts
@@ -425,6 +2085,13 @@ class Post(object):
 
 class Resources(object):
 
+    ALIAS_CACHE_SIZE = 10000
+    UNKNOWN_ACCOUNT = "Expenses:Unknown"
+    LOOKUPS = ("alias_hits", "alias_misses", "rule_hits", "rule_misses")
+    # Jaccard index of the trigrams of a suggested alias or payee, sharing
+    # a trigram or two is not enough
+    MIN_SIMILARITY = 0.3
+
     @staticmethod
     def rotate_rules(rules):
         ''' Rotate dictionary of the form {x: {y: a, z: b}} to
@@ -462,14 +2129,50 @@ class Resources(object):
         # For practical reasons we want the information to be stored in memory
         # with the description as the key instead of the ledger account
         rules = dct.get("rules", {})
-        self._rules = Resources.rotate_rules(rules)
+        self._initialize_state()
+        self._rules = dict((k, self._intern_split(v)) for k, v
+                           in Resources.rotate_rules(rules).items())
         self.validate()
+        # the distinct alias lengths, longest first
+        self._alias_lengths = sorted(set(len(k) for k in self._aliases),
+                                     reverse=True)
+        if self._interactive:
+            self._build_similarity_index()
+
+    def _initialize_state(self):
+        ''' Initialize what is kept in memory whatever the storage of the
+        resources. '''
+        # account splits are shared between all the posts with the same
+        # split
+        self._splits = {}
+        # the payees already found for a description
+        self._alias_cache = {}
+        # trigram index of the aliases and payees used to suggest defaults
+        # to the interactive prompts
+        self._similarity_index = None
+        # splits of my past entries used as defaults, see set_history
+        self._history = None
+        # searches of the similar aliases done ahead of the prompts by
+        # another thread, see prefetch
+        self._lock = threading.Lock()
+        self._similar = {}
+        # number of descriptions and payees found or not, see get_lookups
+        self._lookups = dict.fromkeys(Resources.LOOKUPS, 0)
+
+    def _intern_split(self, split):
+        return self._splits.setdefault(tuple(sorted(split.items())), split)
 
     def validate(self):
         self._validate_rules()
 
     def _validate_rules(self):
-        for d in self._rules.values():
+        Resources.check_rules(self._rules)
+
+    @staticmethod
+    def check_rules(rules):
+        ''' Raise an exception if the percentages of a split of rules,
+        {payee: {account: percentage}}, do not sum to 100. '''
+        for d in rules.values():
             percentage_sum = reduce(lambda x, y: x+y, d.values())
             if percentage_sum != 100:
                 raise Exception(ERR_PERCENTAGE_SUM_NOT_EQUAL_TO_100)
@@ -477,10 +2180,33 @@ class Resources(object):
     def write(self):
         ''' if _path == None then original self._path is used to save the
         file '''
-        with open(self._path, 'w') as f:
-            json.dump({"accounts": self._accounts,
-                       "aliases": self._aliases,
-                       "rules": Resources.rotate_rules(self._rules)}, f)
+        with FileLock(self._path):
+            # keep what other processes wrote since the file was loaded
+            if os.path.exists(self._path):
+                with open(self._path, 'r') as f:
+                    self._merge(json.load(f))
+            with open(self._path + '.tmp', 'w') as f:
+                json.dump({"accounts": self._accounts,
+                           "aliases": self._aliases,
+                           "rules": Resources.rotate_rules(self._rules)}, f)
+            os.rename(self._path + '.tmp', self._path)
+
+    def _merge(self, dct):
+        ''' Add the accounts, aliases and rules of dct which are unknown. '''
+        for k, v in dct.get("accounts", {}).items():
+            self._accounts.setdefault(k, v)
+        for k, v in dct.get("aliases", {}).items():
+            if k not in self._aliases:
+                self.add_alias(k, v)
+        for k, v in Resources.rotate_rules(dct.get("rules", {})).items():
+            if k not in self._rules:
+                self._rules[k] = self._intern_split(v)
+                self._add_similarity_keys(k)
+
+    def set_history(self, history):
+        ''' The most frequent split of a payee in the HistoryIndex history
+        is the default one of the interactive prompts. '''
+        self._history = history
 
     def get_accounts(self):
         return self._accounts
@@ -490,33 +2216,34 @@ class Resources(object):
 
     def get_ledger_account(self, accnumber):
         ''' Note, the account number must be passed as a string. '''
-        acc = ''
-        if accnumber in self._accounts:
-            acc = self._accounts[accnumber].get("account", '')
+        acc = (self._get_account_info(accnumber) or {}).get("account", '')
         if acc == '':
             if self._interactive:
                 print("----------------------------------------------------")
                 print("Unknown account {0}".format(accnumber))
                 acc = raw_input("Account name: ")
                 currency = raw_input("Currency: ")
-                self._accounts[accnumber] = {
-                    "account": acc,
-                    "currency": currency
-                }
+                self.add_ledger_account(accnumber, acc, currency)
             else:
                 acc = 'Assets:{0}'.format(accnumber)
-        return {acc: 100}
+        return self._intern_split({acc: 100})
 
     def add_ledger_account(self, accnumber, acc, currency):
         ''' Note, the account number must be passed as a string. '''
-        self._accounts[accnumber] = {"account": acc, "currency": currency}
+        # keep the other information of the account, e.g. its ledger
+        info = dict(self._get_account_info(accnumber) or {})
+        info.update({"account": acc, "currency": currency})
+        with self._lock:
+            self._set_account_info(accnumber, info)
 
     def get_currency(self, accnumber):
         ''' Note, the account number must be passed as a string. '''
-        if accnumber in self._accounts:
-            return self._accounts[accnumber].get("currency", "$")
-        else:
-            return "$"
+        return (self._get_account_info(accnumber) or {}).get("currency", "$")
+
+    def get_ledger(self, accnumber):
+        ''' Ledger file where the posts of the account are routed, None
+        if they go to the output. '''
+        return (self._get_account_info(accnumber) or {}).get("ledger")
 
     def get_aliases(self):
         return self._aliases
@@ -528,7 +2255,13 @@ class Resources(object):
         return self._aliases.get(desc, desc)
 
     def add_alias(self, desc, payee):
-        self._aliases[desc] = payee
+        with self._lock:
+            self._set_alias(desc, payee)
+            if len(desc) not in self._alias_lengths:
+                self._alias_lengths.append(len(desc))
+                self._alias_lengths.sort(reverse=True)
+            self._alias_cache = {}
+            self._add_similarity_keys(desc, payee)
 
     def get_rules(self):
         return self._rules
@@ -549,58 +2282,1659 @@ class Resources(object):
             rule[payee_acc] = percent
             psum += percent
         if psum == 100:
-            self._rules[payee] = rule
+            with self._lock:
+                self._set_rule(payee, self._intern_split(rule))
+                self._add_similarity_keys(payee)
         else:
             raise Exception(ERR_PERCENTAGE_SUM_NOT_EQUAL_TO_100)
 
+    def get_lookups(self):
+        ''' Return the number of hits and misses of the aliases and of the
+        rules, by name in LOOKUPS. '''
+        return dict(self._lookups)
+
     def get_payee(self, desc):
-        alias = None
-        for k in self._aliases.keys():
-            if k in desc:
-                alias = self._aliases[k]
-                break
+        alias = self._alias_cache.get(desc)
+        if alias is None:
+            alias = self._find_alias(desc)
+            if alias is not None:
+                if len(self._alias_cache) >= Resources.ALIAS_CACHE_SIZE:
+                    self._alias_cache = {}
+                self._alias_cache[desc] = alias
+        self._lookups["alias_hits" if alias is not None
+                      else "alias_misses"] += 1
         if alias is None:
             if self._interactive:
                 print("----------------------------------------------------")
                 print("No alias found for match {0}".format(desc))
+                similar = self.get_similar_aliases(desc)
+                for k, p in similar:
+                    print("Similar: {0} -> {1}".format(k, p))
                 match = rlinput("Match: ", desc)
-                alias = (raw_input("Alias (default: {0}): ".format(match))
-                         or match)
-                self._aliases[match] = alias
+                alias = rlinput("Alias: ", similar[0][1] if similar
+                                else match) or match
+                self.add_alias(match, alias)
             else:
                 alias = desc
         return alias
 
     def get_payee_account(self, payee):
-        accounts = {}
-        if payee not in self._rules:
+        accounts = self._get_rule(payee)
+        self._lookups["rule_hits" if accounts is not None
+                      else "rule_misses"] += 1
+        if accounts is None:
+            accounts = {}
             if self._interactive:
                 print("----------------------------------------------------")
                 print("Unknown accounts for payee {0}".format(payee))
+                # the split of the payee in my ledger is the default one,
+                # else the split of the most similar payee
+                defaults = (self._get_history_split(payee) or
+                            self._get_similar_split(payee))
                 total = 0
-                share = None
                 while total < 100:
-                    pacc = (raw_input("Account (default: Expenses:Unknown): ")
-                            or "Expenses:Unknown")
+                    dacc, dshare = (defaults.pop(0) if defaults
+                                    else (Resources.UNKNOWN_ACCOUNT,
+                                          100 - total))
+                    pacc = (raw_input("Account (default: {0}): ".format(dacc))
+                            or dacc)
+                    share = None
                     while share is None:
-                        share = (raw_input("Percentage (default: 100): ")
-                                 or "100")
+                        share = (raw_input("Percentage (default: {0}): "
+                                           .format(dshare)) or dshare)
                         try:
                             share = int(share)
-                            if share < 1 or share > 100:
+                            if share < 1 or share > 100 - total:
                                 raise Exception()
                         except:
-                            print("Error: enter a number between 1 and 100.")
+                            print("Error: enter a number between 1 and "
+                                  "{0}.".format(100 - total))
                             share = None
                     total += share
                     accounts[pacc] = share
-                self._rules[payee] = accounts
+                accounts = self._intern_split(accounts)
+                with self._lock:
+                    self._set_rule(payee, accounts)
+                    self._add_similarity_keys(payee)
             else:
-                accounts = {"Expenses:Unknown": 100}
-        else:
-            accounts = self._rules[payee]
+                accounts = self._intern_split(
+                    {Resources.UNKNOWN_ACCOUNT: 100})
         return accounts
 
+    def get_similar_aliases(self, desc, k=5):
+        ''' Return up to k tuples (alias, payee) for the known aliases and
+        payees which are the most similar to desc, the most similar first.
+        Only the ones with a similarity of MIN_SIMILARITY at least are
+        returned, the first one is the default of the prompts.
+        '''
+        if self._similarity_index is None:
+            self._build_similarity_index()
+        with self._lock:
+            start, found = self._similar.pop((desc, k), (0, []))
+        return [(key, self.get_alias(key)) for score, key
+                in self._similarity_index.update(desc, found, start, k)
+                if score >= Resources.MIN_SIMILARITY]
+
+    def prefetch(self, desc, k=5):
+        ''' Search the aliases similar to desc, or to its payee if it has no
+        rule, before the interactive prompts need them. It is called by
+        another thread while a prompt waits for me, the search is completed
+        with the keys added in the meantime when the prompt comes.
+        '''
+        with self._lock:
+            if self._similarity_index is None:
+                return
+            query = self._find_alias(desc)
+            if query is not None and (self._get_rule(query) is not None or
+                                      self._get_history_split(query)):
+                return
+            query = desc if query is None else query
+            if (query, k) not in self._similar:
+                self._similar[(query, k)] = (
+                    len(self._similarity_index),
+                    self._similarity_index.search(query, k))
+
+    def _get_history_split(self, payee):
+        split = (self._history.get_split(payee)
+                 if self._history is not None else None)
+        return sorted(split, key=lambda x: -x[1]) if split else []
+
+    def _get_similar_split(self, payee):
+        ''' Return the split of the most similar payee having a rule as a
+        list of tuples (account, percentage), the biggest share first. '''
+        for key, p in self.get_similar_aliases(payee):
+            split = self._get_rule(p)
+            if split is not None:
+                return sorted(split.items(), key=lambda x: -x[1])
+        return []
+
+    def _build_similarity_index(self):
+        self._similarity_index = TrigramIndex()
+        aliases = self.get_aliases()
+        self._add_similarity_keys(*(aliases.keys() + aliases.values() +
+                                    self.get_rules().keys()))
+
+    # The storage of the resources, the methods below are the only ones
+    # accessing the accounts, aliases and rules dictionaries.
+
+    def _get_account_info(self, accnumber):
+        return self._accounts.get(accnumber)
+
+    def _set_account_info(self, accnumber, info):
+        self._accounts[accnumber] = info
+
+    def _find_alias(self, desc):
+        ''' Return the payee of the longest alias contained in desc or None.
+        Instead of testing every alias, only the substrings of desc having
+        the length of an alias are looked up. '''
+        for n in self._alias_lengths:
+            for i in range(len(desc) - n + 1):
+                payee = self._aliases.get(desc[i:i+n])
+                if payee is not None:
+                    return payee
+        return None
+
+    def _set_alias(self, desc, payee):
+        self._aliases[desc] = payee
+
+    def _get_rule(self, payee):
+        return self._rules.get(payee)
+
+    def _set_rule(self, payee, split):
+        self._rules[payee] = split
+
+    def _add_similarity_keys(self, *keys):
+        if self._similarity_index is not None:
+            for k in keys:
+                self._similarity_index.add(k)
+
+
+class SQLiteResources(Resources):
+    ''' Resources stored in a SQLite database.
+
+    Nothing is loaded upfront: the lookups are done with the indexes of the
+    database and each modification is committed in its own short
+    transaction, so that concurrent imports only wait for each other while
+    one of them writes. The JSON format can be imported and exported.
+    '''
+
+    # seconds to wait for the write lock of another process
+    TIMEOUT = 30
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS accounts ("
+        "number TEXT PRIMARY KEY, account TEXT, currency TEXT, ledger TEXT)",
+        "CREATE TABLE IF NOT EXISTS aliases ("
+        "key TEXT PRIMARY KEY, payee TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS alias_lengths ("
+        "length INTEGER PRIMARY KEY)",
+        "CREATE TABLE IF NOT EXISTS rules ("
+        "payee TEXT NOT NULL, account TEXT NOT NULL, "
+        "percent NUMERIC NOT NULL, PRIMARY KEY (payee, account))")
+
+    def __init__(self, path, interactive=False):
+        self._path = path
+        self._interactive = interactive
+        self._initialize_state()
+        # the transactions are explicit, see _transaction
+        self._db = sqlite3.connect(path, timeout=SQLiteResources.TIMEOUT,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+        self._depth = 0
+        with self._transaction():
+            for statement in SQLiteResources.SCHEMA:
+                self._db.execute(statement)
+            # the ledger routes came later
+            if "ledger" not in [r[1] for r in self._db.execute(
+                    "PRAGMA table_info(accounts)")]:
+                self._db.execute(
+                    "ALTER TABLE accounts ADD COLUMN ledger TEXT")
+        self._alias_lengths = [r[0] for r in self._db.execute(
+            "SELECT length FROM alias_lengths ORDER BY length DESC")]
+        if self._interactive:
+            self._build_similarity_index()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        ''' Commit the modifications done in the block at once, the
+        nested blocks are part of the outermost transaction. '''
+        if self._depth:
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+            return
+        # take the write lock upfront rather than failing to upgrade a read
+        # lock held by another process
+        self._db.execute("BEGIN IMMEDIATE")
+        self._depth = 1
+        try:
+            yield
+        except:
+            self._db.execute("ROLLBACK")
+            raise
+        else:
+            self._db.execute("COMMIT")
+        finally:
+            self._depth = 0
+
+    def import_json(self, dct):
+        ''' Add the accounts, aliases and rules of dct, a dictionary in
+        the format of the JSON resources file. '''
+        rules = Resources.rotate_rules(dct.get("rules", {}))
+        # nothing is imported if a rule is invalid
+        Resources.check_rules(rules)
+        with self._transaction():
+            for k, v in dct.get("accounts", {}).items():
+                self._set_account_info(k, v)
+            for k, v in dct.get("aliases", {}).items():
+                self.add_alias(k, v)
+            for k, v in rules.items():
+                self.add_rule(k, v.items())
+
+    def export_json(self):
+        ''' Return the resources in the format of the JSON resources file.
+        '''
+        return {"accounts": self.get_accounts(),
+                "aliases": self.get_aliases(),
+                "rules": Resources.rotate_rules(self.get_rules())}
+
+    def write(self):
+        # every modification is committed already
+        pass
+
+    def _validate_rules(self):
+        if self._db.execute("SELECT payee FROM rules GROUP BY payee "
+                            "HAVING SUM(percent) != 100").fetchone():
+            raise Exception(ERR_PERCENTAGE_SUM_NOT_EQUAL_TO_100)
+
+    def get_accounts(self):
+        res = {}
+        for number, account, currency, ledger in self._db.execute(
+                "SELECT number, account, currency, ledger FROM accounts"):
+            res[number] = self._to_account_info(account, currency, ledger)
+        return res
+
+    def get_account_count(self):
+        return self._db.execute("SELECT COUNT(*) FROM accounts").fetchone()[0]
+
+    def get_aliases(self):
+        return dict(self._db.execute("SELECT key, payee FROM aliases"))
+
+    def get_alias_count(self):
+        return self._db.execute("SELECT COUNT(*) FROM aliases").fetchone()[0]
+
+    def get_alias(self, desc):
+        row = self._db.execute("SELECT payee FROM aliases WHERE key = ?",
+                               (desc,)).fetchone()
+        return row[0] if row else desc
+
+    def get_rules(self):
+        res = {}
+        for payee, account, percent in self._db.execute(
+                "SELECT payee, account, percent FROM rules"):
+            res.setdefault(payee, {})[account] = percent
+        return res
+
+    def get_rule_count(self):
+        return self._db.execute(
+            "SELECT COUNT(DISTINCT payee) FROM rules").fetchone()[0]
+
+    def _to_account_info(self, account, currency, ledger):
+        info = {}
+        if account is not None:
+            info["account"] = account
+        if currency is not None:
+            info["currency"] = currency
+        if ledger is not None:
+            info["ledger"] = ledger
+        return info
+
+    def _get_account_info(self, accnumber):
+        row = self._db.execute("SELECT account, currency, ledger "
+                               "FROM accounts WHERE number = ?",
+                               (accnumber,)).fetchone()
+        return self._to_account_info(*row) if row else None
+
+    def _set_account_info(self, accnumber, info):
+        with self._transaction():
+            self._db.execute("INSERT OR REPLACE INTO accounts "
+                             "(number, account, currency, ledger) "
+                             "VALUES (?, ?, ?, ?)",
+                             (accnumber, info.get("account"),
+                              info.get("currency"), info.get("ledger")))
+
+    def _find_alias(self, desc):
+        for n in self._alias_lengths:
+            keys = set(desc[i:i+n] for i in range(len(desc) - n + 1))
+            if not keys:
+                continue
+            rows = self._db.execute(
+                "SELECT key, payee FROM aliases WHERE key IN ({0})".format(
+                    ",".join("?" * len(keys))), list(keys)).fetchall()
+            if rows:
+                # the alias found first in desc
+                return min(rows, key=lambda r: desc.index(r[0]))[1]
+        return None
+
+    def _set_alias(self, desc, payee):
+        with self._transaction():
+            self._db.execute("INSERT OR REPLACE INTO aliases VALUES (?, ?)",
+                             (desc, payee))
+            self._db.execute("INSERT OR IGNORE INTO alias_lengths VALUES (?)",
+                             (len(desc),))
+
+    def _get_rule(self, payee):
+        rows = self._db.execute("SELECT account, percent FROM rules "
+                                "WHERE payee = ?", (payee,)).fetchall()
+        return self._intern_split(dict(rows)) if rows else None
+
+    def _set_rule(self, payee, split):
+        with self._transaction():
+            self._db.execute("DELETE FROM rules WHERE payee = ?", (payee,))
+            self._db.executemany("INSERT INTO rules VALUES (?, ?, ?)",
+                                 [(payee, k, v) for k, v in split.items()])
+
+
+class TrigramIndex(object):
+    ''' Inverted index of the trigrams of a set of strings.
+
+    The strings the most similar to a query are found by only looking at the
+    strings sharing at least one trigram with it. The similarity is the
+    Jaccard index of the trigram sets, it is case insensitive.
+    '''
+
+    @staticmethod
+    def trigrams(s):
+        s = u" {0} ".format(u" ".join(s.lower().split()))
+        return set(s[i:i+3] for i in range(len(s) - 2))
+
+    def __init__(self, keys=()):
+        self._keys = []
+        self._sizes = []
+        self._ids = {}
+        self._index = {}
+        for k in keys:
+            self.add(k)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, key):
+        if key in self._ids:
+            return
+        i = len(self._keys)
+        trigrams = TrigramIndex.trigrams(key)
+        self._ids[key] = i
+        self._keys.append(key)
+        self._sizes.append(len(trigrams))
+        for t in trigrams:
+            self._index.setdefault(t, []).append(i)
+
+    def search(self, query, k=5):
+        ''' Return up to k tuples (score, key), the best score first. '''
+        return self.update(query, [], 0, k)
+
+    def update(self, query, found, start, k=5):
+        ''' Same as search but found are the results of the search of
+        query when the index had start keys, only the keys added since then
+        are compared to query. '''
+        trigrams = TrigramIndex.trigrams(query)
+        counts = {}
+        for t in trigrams:
+            ids = self._index.get(t, ())
+            # the ids of a trigram are sorted
+            for i in itertools.islice(ids, bisect.bisect_left(ids, start),
+                                      None):
+                counts[i] = counts.get(i, 0) + 1
+        scores = [(float(c) / (len(trigrams) + self._sizes[i] - c), -i)
+                  for i, c in counts.iteritems()]
+        scores.extend((score, -self._ids[key]) for score, key in found)
+        return [(score, self._keys[-i])
+                for score, i in heapq.nlargest(k, scores)]
+
+
+class HistoryIndex(object):
+    ''' Inverted index of the splits used by the payees of a ledger file.
+
+    The entries of each split of each payee are counted in one pass over the
+    ledger, the most frequent split of a payee is then found with one
+    lookup. The index is saved beside the ledger and updated with the
+    entries inserted in it, see Ledger.get_history.
+    '''
+
+    VERSION = 2
+    # store numbers and references ending a payee, e.g. 'IGA #123'
+    VARIANT_RX = re.compile(r'(?:[ \t]+|[ \t]*[#*])[ \t#*0-9-]*$')
+    MIN_VARIANT_LENGTH = 3
+
+    @staticmethod
+    def get_variant_key(payee):
+        ''' Return the name shared by the variants of payee. '''
+        return HistoryIndex.VARIANT_RX.sub(u'', payee)
+
+    @staticmethod
+    def get_path(path):
+        d, name = os.path.split(path)
+        return os.path.join(d, ".{0}.history".format(name))
+
+    @staticmethod
+    def load(path, stamp, accounts=None):
+        ''' Return the index of the ledger file path if it was saved when
+        the ledger had stamp, and for accounts if they are given, None
+        otherwise. '''
+        try:
+            with open(HistoryIndex.get_path(path), 'rb') as f:
+                version, saved, saved_accounts, counts = marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+        if (version != HistoryIndex.VERSION or saved != stamp or
+                (accounts is not None and
+                 saved_accounts != tuple(sorted(accounts)))):
+            return None
+        return HistoryIndex(counts, saved_accounts)
+
+    def save(self, path, stamp):
+        path = HistoryIndex.get_path(path)
+        with open(path + '.tmp', 'wb') as f:
+            marshal.dump((HistoryIndex.VERSION, stamp, self._accounts,
+                          self._counts), f)
+        os.rename(path + '.tmp', path)
+
+    def __init__(self, counts=None, accounts=()):
+        ''' counts is {payee: {split: [count, last]}} where last is the
+        number of the last entry of the split, accounts are the ones of
+        Ledger.get_splits. '''
+        self._counts = counts if counts is not None else {}
+        self._accounts = tuple(sorted(accounts))
+        self._size = 1 + max([c[1] for splits in self._counts.values()
+                              for c in splits.values()] or [-1])
+        self._best = None
+        self._variants = None
+
+    def __len__(self):
+        return len(self._counts)
+
+    def get_accounts(self):
+        return self._accounts
+
+    def add(self, payee, split):
+        c = self._counts.setdefault(payee, {}).setdefault(split, [0, 0])
+        c[0] += 1
+        c[1] = self._size
+        self._size += 1
+        self._best = None
+
+    def get_split(self, payee):
+        ''' Return the most frequent split of payee, or of its variants, as
+        a tuple of (account, percentage), None if it is unknown. '''
+        if self._best is None:
+            self._update_best()
+        best = self._best.get(payee)
+        return best[0] if best is not None else None
+
+    def suggest(self, resources, min_count=1):
+        ''' Return the aliases and the rules unknown to resources in the
+        format of the resources file. The variants of a payee are aliased to
+        their shared name, the payees get their most frequent split if it
+        was used at least min_count times. resources must not be interactive.
+        '''
+        if self._best is None:
+            self._update_best()
+        aliases = {}
+        for key, payees in self._variants.items():
+            if (len(key) >= HistoryIndex.MIN_VARIANT_LENGTH and
+                    key not in resources.get_aliases() and
+                    resources.get_payee(key) == key):
+                aliases[key] = key
+        known = resources.get_rules()
+        rules = {}
+        for payee, (split, count) in self._best.items():
+            # the aliased payees are not imported anymore
+            if (payee in known or count < min_count or
+                    (HistoryIndex.get_variant_key(payee) in aliases and
+                     payee not in aliases) or
+                    resources.get_payee(payee) != payee):
+                continue
+            rules[payee] = dict(split)
+        return {"aliases": aliases, "rules": Resources.rotate_rules(rules)}
+
+    def _update_best(self):
+        # the variants of a payee share the splits of their name unless the
+        # name itself is a payee
+        self._best = {}
+        self._variants = {}
+        merged = {}
+        for payee, splits in self._counts.items():
+            self._best[payee] = self._get_best(splits)
+            key = HistoryIndex.get_variant_key(payee)
+            if key and key != payee:
+                self._variants.setdefault(key, []).append(payee)
+                counts = merged.setdefault(key, {})
+                for split, (count, last) in splits.items():
+                    c = counts.setdefault(split, [0, 0])
+                    c[0] += count
+                    c[1] = max(c[1], last)
+        for key, splits in merged.items():
+            self._best.setdefault(key, self._get_best(splits))
+
+    def _get_best(self, splits):
+        ''' Return (split, count) of the most frequent split, the most
+        recent one first if several are as frequent. '''
+        split, (count, last) = max(splits.items(), key=lambda x: x[1])
+        return split, count
+
+
+class BalanceIndex(object):
+    ''' Running balance of the accounts of a ledger file.
+
+    The balance of an account is kept in cents at the end of each date it
+    is posted to. The index is saved beside the ledger and updated with the
+    entries inserted in it, it is only built from the whole ledger again if
+    the ledger was modified by something else.
+    '''
+
+    VERSION = 1
+
+    @staticmethod
+    def get_path(path):
+        d, name = os.path.split(path)
+        return os.path.join(d, ".{0}.balances".format(name))
+
+    @staticmethod
+    def load(path, stamp):
+        ''' Return the index of the ledger file path if it was saved when
+        the ledger had stamp, None otherwise. '''
+        try:
+            with open(BalanceIndex.get_path(path), 'rb') as f:
+                version, saved, dates, balances = marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+        if version != BalanceIndex.VERSION or saved != stamp:
+            return None
+        index = BalanceIndex()
+        index._dates = dates
+        index._balances = balances
+        return index
+
+    def __init__(self):
+        # sorted dates YYYYMMDD and balances at their end of each account
+        self._dates = {}
+        self._balances = {}
+
+    def save(self, path, stamp):
+        path = BalanceIndex.get_path(path)
+        with open(path + '.tmp', 'wb') as f:
+            marshal.dump((BalanceIndex.VERSION, stamp, self._dates,
+                          self._balances), f)
+        os.rename(path + '.tmp', path)
+
+    def get_accounts(self):
+        return self._dates.keys()
+
+    def get_balance(self, account, date):
+        ''' Return the balance of account at the end of date, an integer
+        YYYYMMDD. '''
+        dates = self._dates.get(account, [])
+        i = bisect.bisect_right(dates, date)
+        return self._balances[account][i - 1] if i else 0
+
+    def add(self, postings):
+        ''' Add the postings, tuples (account, date, cents) where date is
+        an integer YYYYMMDD. Only the balances from the first date of the
+        postings of an account are computed again. '''
+        deltas = {}
+        for account, date, cents in postings:
+            d = deltas.setdefault(account, {})
+            d[date] = d.get(date, 0) + cents
+        for account, d in deltas.items():
+            dates = self._dates.get(account, [])
+            balances = self._balances.get(account, [])
+            start = bisect.bisect_left(dates, min(d))
+            balance = balances[start - 1] if start else 0
+            previous = balance
+            for date, b in zip(dates[start:], balances[start:]):
+                d[date] = d.get(date, 0) + b - previous
+                previous = b
+            new_dates = sorted(d)
+            new_balances = []
+            for date in new_dates:
+                balance += d[date]
+                new_balances.append(balance)
+            self._dates[account] = dates[:start] + new_dates
+            self._balances[account] = balances[:start] + new_balances
+
+
+class Ledger(object):
+    ''' A ledger file in which rendered posts are inserted chronologically.
+
+    The byte offset of each dated entry is indexed so that an insertion only
+    rewrites the file from the first entry that comes after the inserted
+    posts. The index stays valid as long as the file is not modified by
+    someone else.
+    '''
+
+    DATE_RX = re.compile(r'^([0-9]{4}\/[0-9]{2}\/[0-9]{2}).*')
+    # first line of an entry written by Post
+    ENTRY_RX = re.compile(r'^([0-9]{4})\/([0-9]{2})\/([0-9]{2}) \* (.*)$')
+    # indented account, at least two spaces or a tab, amount and comment
+    POSTING_RX = re.compile(r'^[ \t]+([^ \t;](?:[^\t]*?[^ \t])?)'
+                            r'(?: {2,}|\t)[ \t]*([^ \t;][^;]*?)[ \t]*'
+                            r'(;.*)?$')
+    # first line of any dated entry: date, state, code, payee and comment
+    PAYEE_RX = re.compile(r'^[0-9]{4}\/[0-9]{2}\/[0-9]{2}(?:=[^ \t]*)?'
+                          r'[ \t]+(?:[*!][ \t]*)?(?:\([^)]*\)[ \t]*)?'
+                          r'(.*?)[ \t]*(?:;.*)?$')
+    AMOUNT_RX = re.compile(r'[0-9][0-9,]*(?:\.[0-9]+)?')
+    # accounts of the statements when they are not known
+    BALANCE_ACCOUNTS = ("Assets", "Liabilities")
+    REFORMAT_MEMORY = 64 << 20
+    # spilled runs merged at once, they are all open while being merged
+    MERGE_FAN_IN = 64
+    # estimated memory used by a sorted entry besides its text
+    ENTRY_OVERHEAD = 128
+
+    class Batch(object):
+
+        def __init__(self, entries, backup):
+            self.entries = entries
+            self.backup = backup
+            self.backup_path = None
+            self.done = False
+            self.error = None
+
+    def __init__(self, path):
+        self._path = path
+        self._stamp = None
+        self._has_directive = False
+        # running maximum of the entry dates and their offsets, in file order
+        self._dates = []
+        self._offsets = []
+        self._write_lock = threading.Lock()
+        self._queue_lock = threading.Lock()
+        self._pending = []
+        # bytes written by insert
+        self._rewritten = 0
+
+    def get_path(self):
+        return self._path
+
+    def get_rewritten(self):
+        return self._rewritten
+
+    def submit(self, entries, backup=False):
+        ''' Insert entries in the ledger, concurrent submissions are
+        coalesced into one write.
+        Returns the backup file path if a backup has been made.
+        '''
+        batch = Ledger.Batch(entries, backup)
+        with self._queue_lock:
+            self._pending.append(batch)
+        with self._write_lock:
+            if not batch.done:
+                with self._queue_lock:
+                    batches, self._pending = self._pending, []
+                self._write_batches(batches)
+        if batch.error is not None:
+            raise batch.error
+        return batch.backup_path
+
+    def _write_batches(self, batches):
+        ''' Other processes importing in the same ledger file spool their
+        entries then wait for the ledger lock, whoever gets the lock writes
+        all the spooled entries at once. '''
+        backup_path = None
+        try:
+            entries = []
+            for b in batches:
+                entries.extend(b.entries)
+            spooled = self._spool(entries, any(b.backup for b in batches))
+            with FileLock(self._path):
+                # our entries are gone if another process wrote them
+                if os.path.exists(spooled):
+                    backup_path = self._write_spooled()
+        except Exception as e:
+            for b in batches:
+                b.error = e
+        for b in batches:
+            b.backup_path = backup_path if b.backup else None
+            b.done = True
+
+    def _get_spool_dir(self):
+        d, name = os.path.split(self._path)
+        return os.path.join(d, ".{0}.queue".format(name))
+
+    def _spool(self, entries, backup):
+        d = self._get_spool_dir()
+        # the names keep the spooled batches in submission order
+        path = os.path.join(d, "{0:017.6f}-{1}-{2}".format(
+            time.time(), os.getpid(), uuid.uuid4().hex))
+        while True:
+            try:
+                f = open(path + '.tmp', 'wb')
+                break
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            # the directory is removed once drained, see _write_spooled
+            try:
+                os.mkdir(d)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        with f:
+            marshal.dump((backup, entries), f)
+        os.rename(path + '.tmp', path + '.batch')
+        return path + '.batch'
+
+    def _write_spooled(self):
+        ''' Write all the spooled entries, the ledger lock must be held.
+        Returns the backup file path if a backup has been made. '''
+        d = self._get_spool_dir()
+        paths = []
+        backup = False
+        entries = []
+        for name in sorted(os.listdir(d)):
+            if not name.endswith('.batch'):
+                continue
+            path = os.path.join(d, name)
+            paths.append(path)
+            # forget the batches of the processes which died waiting
+            if not _is_process_alive(int(name.split('-')[1])):
+                continue
+            with open(path, 'rb') as f:
+                b, e = marshal.load(f)
+            backup = backup or b
+            entries.extend(e)
+        backup_path = None
+        if backup and os.path.exists(self._path):
+            backup_path = backup_file(self._path)
+        self.insert(entries)
+        for path in paths:
+            os.remove(path)
+        try:
+            os.rmdir(d)
+        except OSError:
+            # other processes are spooling their batches
+            pass
+        return backup_path
+
+    def insert(self, entries):
+        ''' entries is a list of tuples (date, text) where date is
+        formatted as YYYY/MM/DD and text is the rendered post.
+        A post is written before the first entry of the file with a
+        greater date, or at the end of the file.
+        '''
+        entries = sorted(entries, key=lambda e: e[0])
+        self._recover()
+        self._update_index()
+        if not entries:
+            return
+        k = bisect.bisect_right(self._dates, entries[0][0])
+        offset = self._offsets[k] if k < len(self._offsets) else None
+        if not self._has_directive:
+            k, offset = 0, 0
+        last = self._dates[k-1] if k else ''
+        open(self._path, 'a').close()
+        with open(self._path, 'r+b') as f:
+            if offset is None:
+                f.seek(0, os.SEEK_END)
+                offset = f.tell()
+            f.seek(offset)
+            merged = tempfile.SpooledTemporaryFile(max_size=1 << 20)
+            dates, offsets = self._merge(
+                f, entries, merged, offset, last,
+                offset == 0 and not self._has_directive)
+            merged.seek(0)
+            # the tail is kept until the new one is on the disk
+            self._save_tail(f, offset)
+            f.seek(offset)
+            shutil.copyfileobj(merged, f)
+            f.truncate()
+            f.flush()
+            os.fsync(f.fileno())
+            self._rewritten += f.tell() - offset
+            merged.close()
+        os.remove(self._get_tail_path())
+        self._dates = self._dates[:k] + dates
+        self._offsets = self._offsets[:k] + offsets
+        self._has_directive = True
+        stamp, self._stamp = self._stamp, self._get_stamp()
+        self._update_balances(entries, stamp)
+        self._update_history(entries, stamp)
+
+    def _get_tail_path(self):
+        d, name = os.path.split(self._path)
+        return os.path.join(d, ".{0}.tail".format(name))
+
+    def _save_tail(self, f, offset):
+        ''' Save the end of the ledger file f from offset, see _recover.
+        '''
+        path = self._get_tail_path()
+        f.seek(offset)
+        with open(path + '.tmp', 'wb') as tail:
+            tail.write("{0}\n".format(offset))
+            shutil.copyfileobj(f, tail)
+            tail.flush()
+            os.fsync(tail.fileno())
+        # only a complete tail can be restored
+        os.rename(path + '.tmp', path)
+
+    def _recover(self):
+        ''' Restore the tail saved by an insert which was interrupted while
+        rewriting the ledger, the ledger lock must be held. '''
+        path = self._get_tail_path()
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as tail:
+            offset = int(tail.readline())
+            with open(self._path, 'r+b') as f:
+                f.seek(offset)
+                shutil.copyfileobj(tail, f)
+                f.truncate()
+                f.flush()
+                os.fsync(f.fileno())
+        os.remove(path)
+        self._stamp = None
+
+    def _merge(self, lines, entries, out, pos, last, directive):
+        ''' Write lines to out with the entries inserted, see _merged.
+        Returns the index of the written entries.
+        '''
+        dates = []
+        offsets = []
+        for date, text, _ in self._merged(lines, entries, directive):
+            if date is not None:
+                dates.append(max(dates[-1] if dates else last, date))
+                offsets.append(pos + out.tell())
+            out.write(text)
+        return dates, offsets
+
+    def _merged(self, lines, entries, directive):
+        ''' Yield (date, text, inserted) for each line of lines and each
+        entry inserted before the first line with a greater date. The mode
+        directive comes first if directive is true. '''
+        if directive:
+            yield None, LEDGER_MODE_DIRECTIVE + '\n', True
+        i = 0
+        for line in lines:
+            m = Ledger.DATE_RX.match(line)
+            if m is not None:
+                date = m.group(1)
+                while i < len(entries) and entries[i][0] < date:
+                    yield entries[i][0], entries[i][1], True
+                    yield None, '\n', True
+                    i += 1
+                yield date, line, False
+            else:
+                yield None, line, False
+        while i < len(entries):
+            yield None, '\n', True
+            yield entries[i][0], entries[i][1], True
+            i += 1
+
+    def plan(self, entries):
+        ''' Same as insert but nothing is written, return the list of the
+        insertions as dictionaries with the keys:
+        - line: number of the line of the file before which the text is
+          inserted, one more than the number of lines to append it
+        - date: date of the entry, None for the mode directive
+        - text: inserted text
+        '''
+        res = []
+        line = 1
+        for date, text, inserted in self._plan(entries):
+            if not inserted:
+                line += 1
+            elif text != '\n':
+                res.append({"line": line, "date": date, "text": text})
+        return res
+
+    def diff(self, entries, context=3, name=None):
+        ''' Same as insert but nothing is written, yield the lines of the
+        unified diff of the insertion instead. name is the file name in the
+        diff, the path of the ledger by default. '''
+        ops = ((l, inserted) for _, text, inserted in self._plan(entries)
+               for l in text.splitlines(True))
+        header = False
+        for hunk in self._hunks(ops, context):
+            if not header:
+                yield "--- {0}\n".format(name or self._path)
+                yield "+++ {0}\n".format(name or self._path)
+                header = True
+            for l in hunk:
+                yield l
+
+    def _plan(self, entries):
+        ''' Lines of the file merged with the entries as in insert, in
+        one read-only pass. '''
+        if not entries:
+            return
+        entries = sorted(entries, key=lambda e: e[0])
+        if not os.path.exists(self._path):
+            for m in self._merged([], entries, True):
+                yield m
+            return
+        with open(self._path, 'rb') as f:
+            first = f.readline()
+            lines = itertools.chain([first] if first else [], f)
+            for m in self._merged(lines, entries,
+                                  LEDGER_MODE_DIRECTIVE not in first):
+                yield m
+
+    def _hunks(self, ops, context):
+        ''' Group the (line, inserted) ops into the hunks of a unified
+        diff with context lines around the insertions. '''
+        before = []
+        hunk = None
+        old = new = 0
+        for line, inserted in ops:
+            if inserted:
+                if hunk is None:
+                    hunk = {"old": old - len(before) + 1,
+                            "new": new - len(before) + 1,
+                            "lines": [' ' + l for l in before],
+                            "old_n": len(before), "new_n": len(before)}
+                    before = []
+                hunk["lines"].append('+' + line)
+                hunk["new_n"] += 1
+                hunk["tail"] = 0
+                new += 1
+                continue
+            old += 1
+            new += 1
+            if hunk is None:
+                before = (before + [line])[-context:] if context else []
+                continue
+            hunk["lines"].append(' ' + line)
+            hunk["old_n"] += 1
+            hunk["new_n"] += 1
+            hunk["tail"] += 1
+            # the next insertion is too far to share the context
+            if hunk["tail"] > 2 * context:
+                before = [l[1:] for l in hunk["lines"][
+                    len(hunk["lines"]) - hunk["tail"]:]][-context:]
+                if not context:
+                    before = []
+                yield self._format_hunk(hunk, context)
+                hunk = None
+        if hunk is not None:
+            yield self._format_hunk(hunk, context)
+
+    def _format_hunk(self, hunk, context):
+        extra = max(hunk["tail"] - context, 0)
+        lines = hunk["lines"][:len(hunk["lines"]) - extra]
+        old_n = hunk["old_n"] - extra
+        new_n = hunk["new_n"] - extra
+        # an empty range starts at the line before
+        old = hunk["old"] if old_n else hunk["old"] - 1
+        return ["@@ -{0},{1} +{2},{3} @@\n".format(old, old_n, hunk["new"],
+                                                   new_n)] + lines
+
+    def reformat(self, align=False, memory=REFORMAT_MEMORY):
+        ''' Sort the entries of the ledger by date and separate them with
+        one empty line, the entries with the same date keep their order.
+        The lines which are not dated belong to the entry above them. The
+        amounts are aligned to Post.POST_AMOUNT_ALIGNMENT if align is true.
+        The file is rewritten once, the entries are sorted in memory up to
+        memory bytes and in sorted runs spilled to temporary files beyond.
+        Returns the number of entries.
+        '''
+        runs = []
+        with FileLock(self._path):
+            self._recover()
+            try:
+                with open(self._path, 'rb') as f:
+                    header, count = self._sort_runs(f, align, memory, runs)
+                if not header or LEDGER_MODE_DIRECTIVE not in header[0]:
+                    header.insert(0, LEDGER_MODE_DIRECTIVE + '\n')
+                with open(self._path + '.tmp', 'wb') as out:
+                    out.writelines(header)
+                    for _, _, text in heapq.merge(*[self._read_run(r)
+                                                    for r in runs]):
+                        out.write('\n')
+                        out.write(text)
+            finally:
+                for r in runs:
+                    if hasattr(r, 'close'):
+                        r.close()
+            os.rename(self._path + '.tmp', self._path)
+        self._stamp = None
+        return count
+
+    def _sort_runs(self, f, align, memory, runs):
+        ''' Append to runs the sorted runs of the entries of f, the last one
+        is kept in memory. Returns the header lines and the number of
+        entries. '''
+        header = []
+        run = []
+        size = 0
+        count = 0
+        # number of merges which made each spilled run
+        levels = []
+        for date, lines in self._split_entries(f):
+            if date is None:
+                header = self._format_entry(lines, False)
+                continue
+            text = ''.join(self._format_entry(lines, align))
+            # the entry number keeps the sort stable
+            run.append((date, count, text))
+            count += 1
+            size += len(text) + Ledger.ENTRY_OVERHEAD
+            if size > memory:
+                runs.append(self._spill(sorted(run)))
+                levels.append(0)
+                # merge MERGE_FAN_IN runs of the same level into one so that
+                # the open runs grow with the logarithm of the entries
+                n = Ledger.MERGE_FAN_IN
+                while len(levels) >= n and len(set(levels[-n:])) == 1:
+                    runs[-n:] = [self._merge_runs(runs[-n:])]
+                    levels[-n:] = [levels[-1] + 1]
+                run = []
+                size = 0
+        run.sort()
+        runs.append(run)
+        return header, count
+
+    def _merge_runs(self, runs):
+        ''' Merge the spilled runs into a new one, they are closed. '''
+        merged = self._spill(heapq.merge(*[self._read_run(r) for r in runs]))
+        for r in runs:
+            r.close()
+        return merged
+
+    def _split_entries(self, f):
+        ''' Yield (date, lines) for each entry of f, the lines before the
+        first entry are yielded with a None date. '''
+        date = None
+        lines = []
+        for line in f:
+            m = Ledger.DATE_RX.match(line)
+            if m is not None:
+                if lines or date is not None:
+                    yield date, lines
+                date = m.group(1)
+                lines = []
+            lines.append(line)
+        if lines or date is not None:
+            yield date, lines
+
+    def _format_entry(self, lines, align):
+        while lines and not lines[-1].strip():
+            lines.pop()
+        if lines and not lines[-1].endswith('\n'):
+            lines[-1] += '\n'
+        if align:
+            lines = [self._align(l) for l in lines]
+        return lines
+
+    def _align(self, line):
+        m = Ledger.POSTING_RX.match(line.rstrip('\r\n'))
+        if m is None:
+            return line
+        account, amount, comment = m.groups()
+        account = Post.POST_ACCOUNT_ALIGNMENT + account
+        # the width in characters of UTF-8 text, one per byte otherwise
+        width = len((account + amount).decode('utf-8', 'replace'))
+        # ledger needs two spaces between the account and the amount
+        spacing = max(Post.POST_AMOUNT_ALIGNMENT - width, 2)
+        line = account + ' ' * spacing + amount
+        if comment:
+            line += '  ' + comment
+        return line + '\n'
+
+    def recategorize(self, resources):
+        ''' Resolve again the payee and the accounts of the entries to
+        Resources.UNKNOWN_ACCOUNT with the aliases and the rules of
+        resources. Only the entries as written by Post are considered, the
+        other ones are left untouched. The file is rewritten in one pass if
+        some entries changed.
+        Returns the number of changed entries.
+        '''
+        count = 0
+        with FileLock(self._path):
+            with open(self._path, 'rb') as f:
+                with open(self._path + '.tmp', 'wb') as out:
+                    for date, lines in self._split_entries(f):
+                        text = (self._recategorize_entry(lines, resources)
+                                if date is not None else None)
+                        if text is not None:
+                            count += 1
+                            # keep the empty lines after the entry
+                            while lines and not lines[-1].strip():
+                                text += lines.pop()
+                            lines = [text]
+                        out.writelines(lines)
+            if count:
+                os.rename(self._path + '.tmp', self._path)
+            else:
+                os.remove(self._path + '.tmp')
+        self._stamp = None
+        return count
+
+    def _recategorize_entry(self, lines, resources):
+        ''' Return the text of the entry resolved again, None if it is
+        unchanged or if it doesn't come from Post. '''
+        lines = [l.rstrip('\r\n') for l in lines if l.strip()]
+        unknown = Resources.UNKNOWN_ACCOUNT
+        if len(lines) != 3 or unknown not in lines[1] + lines[2]:
+            return None
+        entry = Ledger.ENTRY_RX.match(lines[0])
+        posting = Ledger.POSTING_RX.match(lines[1])
+        if entry is None or posting is None or posting.group(3):
+            return None
+        # a debit is posted to the payee accounts, a credit to the account
+        account, balance = posting.group(1), lines[2].strip()
+        if account == unknown:
+            account, sign = balance, -1
+        elif balance == unknown:
+            sign = 1
+        else:
+            return None
+        amount = posting.group(2).split(' ')
+        if len(amount) != 2:
+            return None
+        if not re.match(r"^[a-zA-Z]+$", amount[1]):
+            amount.reverse()
+        try:
+            value = float(amount[0])
+        except ValueError:
+            return None
+        payee, encoding = Ledger._decode_encoding(entry.group(4))
+        new_payee = resources.get_payee(payee)
+        split = resources.get_payee_account(new_payee)
+        if new_payee == payee and split == {unknown: 100}:
+            return None
+        post = Post({account.decode(encoding): 100},
+                    amount[1].decode(encoding),
+                    int(''.join(entry.groups()[:3])),
+                    "",
+                    new_payee,
+                    split,
+                    sign * value)
+        text = unicode(post).encode(encoding)
+        return text if text != '\n'.join(lines) + '\n' else None
+
+    def get_splits(self, accounts=()):
+        ''' Yield (payee, split) for each entry of the ledger, split is the
+        sorted tuple of (account, percentage) of the postings to the other
+        accounts than accounts, the ledger accounts of the statements, and
+        than the BALANCE_ACCOUNTS.
+        The entries to Resources.UNKNOWN_ACCOUNT and the ones which cannot
+        be parsed are skipped.
+        '''
+        if not os.path.exists(self._path):
+            return
+        with open(self._path, 'rb') as f:
+            for date, lines in self._split_entries(f):
+                split = (self._get_split(lines, accounts)
+                         if date is not None else None)
+                if split is not None:
+                    yield split
+
+    def get_history(self, accounts=()):
+        ''' Return the HistoryIndex of the splits of the ledger, see
+        get_splits for accounts. From now on insert keeps it up to date.
+        '''
+        with FileLock(self._path):
+            self._recover()
+            stamp = self._get_stamp()
+            index = HistoryIndex.load(self._path, stamp, accounts)
+            if index is None:
+                index = HistoryIndex(accounts=accounts)
+                for payee, split in self.get_splits(accounts):
+                    index.add(payee, split)
+                index.save(self._path, stamp)
+        return index
+
+    def _update_history(self, entries, stamp):
+        ''' Add the inserted entries to the HistoryIndex saved with stamp,
+        see _update_balances. '''
+        if not os.path.exists(HistoryIndex.get_path(self._path)):
+            return
+        index = HistoryIndex.load(self._path, stamp)
+        if index is not None:
+            for date, text in entries:
+                split = self._get_split(text.splitlines(),
+                                        index.get_accounts())
+                if split is not None:
+                    index.add(*split)
+            index.save(self._path, self._stamp)
+
+    def _get_split(self, lines, accounts):
+        m = Ledger.PAYEE_RX.match(lines[0].rstrip('\r\n'))
+        postings = self._get_postings(lines)
+        if m is None or not m.group(1) or postings is None:
+            return None
+        shares = {}
+        for acc, v in postings:
+            # the balancing side of the entry is never part of the split
+            if (acc in accounts or
+                    acc.split(':')[0] in Ledger.BALANCE_ACCOUNTS):
+                continue
+            shares[acc] = shares.get(acc, 0) + abs(v)
+        total = sum(shares.values())
+        if not total or Resources.UNKNOWN_ACCOUNT in shares:
+            return None
+        split = dict((acc, int(round(v * 100 / total)))
+                     for acc, v in shares.items())
+        split = dict((acc, p) for acc, p in split.items() if p)
+        # the rounding error goes to the biggest share
+        biggest = max(split, key=lambda acc: (split[acc], acc))
+        split[biggest] += 100 - sum(split.values())
+        return Ledger._decode(m.group(1)), tuple(sorted(split.items()))
+
+    def _get_postings(self, lines):
+        ''' Return the list of (account, amount) of the postings of the
+        entry lines, the amount left out of a posting is computed. Returns
+        None if the entry cannot be parsed. '''
+        postings = []
+        for line in lines[1:]:
+            line = line.rstrip('\r\n')
+            if not line.strip() or line.lstrip().startswith(';'):
+                continue
+            p = Ledger.POSTING_RX.match(line)
+            if p is None:
+                # the amount of one posting can be left out
+                postings.append((line.split(';')[0].strip(), None))
+                continue
+            amount = Ledger.AMOUNT_RX.search(p.group(2))
+            if amount is None:
+                return None
+            value = float(amount.group(0).replace(',', ''))
+            postings.append((p.group(1), -value if '-' in p.group(2)
+                             else value))
+        if len([v for acc, v in postings if v is None]) > 1:
+            return None
+        balance = -sum(v for acc, v in postings if v is not None)
+        return [(Ledger._decode(acc), balance if v is None else v)
+                for acc, v in postings]
+
+    def get_balances(self):
+        ''' Return the BalanceIndex of the ledger, from now on insert keeps
+        it up to date. '''
+        with FileLock(self._path):
+            self._recover()
+            stamp = self._get_stamp()
+            index = BalanceIndex.load(self._path, stamp)
+            if index is None:
+                index = BalanceIndex()
+                if stamp is not None:
+                    with open(self._path, 'rb') as f:
+                        index.add(self._get_balance_postings(
+                            self._split_entries(f)))
+                index.save(self._path, stamp)
+        return index
+
+    def _update_balances(self, entries, stamp):
+        ''' Add the inserted entries to the BalanceIndex saved with stamp,
+        it is built again by get_balances if the ledger was modified by
+        something else. '''
+        # the index is only kept once it has been asked for
+        if not os.path.exists(BalanceIndex.get_path(self._path)):
+            return
+        index = BalanceIndex.load(self._path, stamp)
+        if index is not None:
+            index.add(self._get_balance_postings(
+                (date, text.splitlines()) for date, text in entries))
+            index.save(self._path, self._stamp)
+
+    def _get_balance_postings(self, entries):
+        ''' Yield (account, date, cents) for the postings of entries, the
+        tuples (date, lines) of _split_entries. '''
+        for date, lines in entries:
+            postings = (self._get_postings(lines) if date is not None
+                        else None)
+            for acc, v in postings or ():
+                yield acc, int(date.replace('/', '')), int(round(v * 100))
+
+    @staticmethod
+    def _decode(text):
+        if isinstance(text, unicode):
+            return text
+        return Ledger._decode_encoding(text)[0]
+
+    @staticmethod
+    def _decode_encoding(text):
+        ''' Return (text decoded, encoding used to decode it). '''
+        # the encoding of the ledger is not known, latin-1 always works
+        try:
+            return text.decode('utf-8'), 'utf-8'
+        except UnicodeDecodeError:
+            return text.decode('ISO-8859-1'), 'ISO-8859-1'
+
+    def _spill(self, run):
+        f = tempfile.TemporaryFile(dir=os.path.dirname(self._path) or None)
+        for e in run:
+            marshal.dump(e, f)
+        f.seek(0)
+        return f
+
+    def _read_run(self, run):
+        if isinstance(run, list):
+            for e in run:
+                yield e
+            return
+        while True:
+            try:
+                yield marshal.load(run)
+            except EOFError:
+                return
+
+    def _get_stamp(self):
+        try:
+            st = os.stat(self._path)
+        except OSError:
+            return None
+        return (st.st_size, st.st_mtime)
+
+    def _update_index(self):
+        stamp = self._get_stamp()
+        if stamp is not None and stamp == self._stamp:
+            return
+        self._dates = []
+        self._offsets = []
+        self._has_directive = False
+        if stamp is not None:
+            with open(self._path, 'rb') as f:
+                pos = 0
+                last = ''
+                for line in f:
+                    if pos == 0:
+                        self._has_directive = LEDGER_MODE_DIRECTIVE in line
+                    m = Ledger.DATE_RX.match(line)
+                    if m is not None:
+                        last = max(last, m.group(1))
+                        self._dates.append(last)
+                        self._offsets.append(pos)
+                    pos += len(line)
+        self._stamp = stamp
+
+
+class ShardedLedger(object):
+    ''' A master ledger file which includes one ledger file per period.
+
+    The shard of the period YYYY (or YYYY-MM) of the master file
+    path/name.ledger is path/name-YYYY.ledger (or path/name-YYYY-MM.ledger).
+    Inserting posts only rewrites the shards of their periods, the master
+    file is only modified when a new shard is created.
+    '''
+
+    PERIODS = ('year', 'month')
+    INCLUDE_RX = re.compile(r'^include\s+(.+?)\s*$')
+
+    def __init__(self, path, period):
+        if period not in ShardedLedger.PERIODS:
+            raise Exception(ERR_PERIOD_UNKNOWN.format(
+                period, ", ".join(ShardedLedger.PERIODS)))
+        self._path = path
+        self._period = period
+        self._rewritten = 0
+
+    def get_rewritten(self):
+        ''' Bytes written in the shards by insert. '''
+        return self._rewritten
+
+    def get_shard_path(self, date):
+        ''' date is formatted as YYYY/MM/DD '''
+        period = date[:4] if self._period == 'year' else date[:7]
+        base, ext = os.path.splitext(self._path)
+        return "{0}-{1}{2}".format(base, period.replace('/', '-'), ext)
+
+    def get_shard_paths(self, entries):
+        return sorted(set(self.get_shard_path(e[0]) for e in entries))
+
+    def insert(self, entries):
+        ''' Same as Ledger.insert '''
+        shards = {}
+        for e in entries:
+            shards.setdefault(self.get_shard_path(e[0]), []).append(e)
+        for path in sorted(shards):
+            ledger = Ledger(path)
+            ledger.submit(shards[path])
+            self._rewritten += ledger.get_rewritten()
+        with FileLock(self._path):
+            self._include(shards.keys())
+
+    def split(self):
+        ''' Move the entries of the master file into the shards in one pass,
+        the master file only keeps the lines before the first entry.
+        Returns the list of the shard paths. '''
+        header = []
+        shards = {}
+        # the imports into the master file wait for the split
+        with FileLock(self._path):
+            try:
+                with open(self._path, 'rb') as f:
+                    out = None
+                    for line in f:
+                        m = Ledger.DATE_RX.match(line)
+                        if m is not None:
+                            out = self._open_shard(
+                                shards, self.get_shard_path(m.group(1)))
+                        if out is None:
+                            header.append(line)
+                        else:
+                            out.write(line)
+            finally:
+                for out in shards.values():
+                    out.close()
+            for path in shards:
+                os.rename(path + '.tmp', path)
+            if header and LEDGER_MODE_DIRECTIVE not in header[0]:
+                header.insert(0, LEDGER_MODE_DIRECTIVE + '\n')
+            self._write(self._add_includes(header, shards.keys()))
+        return sorted(shards)
+
+    def _open_shard(self, shards, path):
+        if path not in shards:
+            if os.path.exists(path):
+                for out in shards.values():
+                    out.close()
+                    os.remove(out.name)
+                shards.clear()
+                raise Exception(ERR_SHARD_EXISTS.format(path))
+            shards[path] = open(path + '.tmp', 'wb')
+            shards[path].write(LEDGER_MODE_DIRECTIVE + '\n\n')
+        return shards[path]
+
+    def _include(self, paths):
+        ''' Add the missing include directives of paths in the master file,
+        the ledger lock must be held. '''
+        lines = []
+        if os.path.exists(self._path):
+            with open(self._path, 'rb') as f:
+                lines = f.readlines()
+        included = self._add_includes(list(lines), paths)
+        if included != lines:
+            self._write(included)
+
+    def _add_includes(self, lines, paths):
+        ''' Return the lines of the master file with the missing include
+        directives of paths, the include directives are kept sorted. '''
+        included = set(m.group(1) for m in
+                       (ShardedLedger.INCLUDE_RX.match(l) for l in lines) if m)
+        names = sorted(set(os.path.basename(p) for p in paths) - included)
+        if not names:
+            return lines
+        if not lines or LEDGER_MODE_DIRECTIVE not in lines[0]:
+            lines.insert(0, LEDGER_MODE_DIRECTIVE + '\n')
+        if not lines[-1].endswith('\n'):
+            lines[-1] += '\n'
+        for name in names:
+            i = len(lines)
+            for j, l in enumerate(lines):
+                m = ShardedLedger.INCLUDE_RX.match(l)
+                if m is not None and m.group(1) > name:
+                    i = j
+                    break
+            lines.insert(i, "include {0}\n".format(name))
+        return lines
+
+    def _write(self, lines):
+        ''' Replace the master file with lines. '''
+        with open(self._path + '.tmp', 'wb') as f:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(self._path + '.tmp', self._path)
+
+
+class ImportService(object):
+    ''' Import statements on request, keeping the resources and the
+    ledger indexes in memory between the requests.
+
+    A request is a dictionary with the keys:
+    - bank: the bank name
+    - input: path to the statement file
+    - output: path to the ledger file (default: input with .ledger extension)
+    - backup: make a backup of the ledger before modifying it (default: no)
+    '''
+
+    def __init__(self, verbose=False):
+        self._verbose = verbose
+        self._lock = threading.Lock()
+        # path: (stamp, resources, lock), the resources are not thread-safe
+        # so the requests using them are serialized by their lock
+        self._resources = {}
+        self._ledgers = {}
+
+    def handle(self, request, reply):
+        ''' reply is called with a dictionary for each rendered post and
+        a last time with the number of imported posts. '''
+        for k in ("bank", "input"):
+            if k not in request:
+                raise Exception(ERR_INVALID_REQUEST.format(
+                    "missing '{0}'".format(k)))
+        i = os.path.abspath(os.path.normpath(request["input"]))
+        o = request.get("output") or os.path.splitext(i)[0] + '.ledger'
+        o = os.path.abspath(os.path.normpath(o))
+        resources, lock = self._get_resources(o)
+        with lock:
+            app = MyLedgerPal(request["bank"], i, o,
+                              verbose=self._verbose,
+                              no_backup=True,
+                              resources=resources)
+            posts = app._read_input()
+        entries = []
+        for p in posts:
+            entries.append(app._get_ledger_entry(p))
+            reply({"post": unicode(p)})
+        backup = self._get_ledger(o).submit(entries,
+                                            request.get("backup", False))
+        res = {"posts": len(entries), "output": o}
+        if backup:
+            res["backup"] = backup
+        reply(res)
+
+    def _get_ledger(self, path):
+        with self._lock:
+            if path not in self._ledgers:
+                self._ledgers[path] = Ledger(path)
+            return self._ledgers[path]
+
+    def _get_resources(self, output):
+        ''' Return the resources of output and the lock to hold while
+        using them. '''
+        paths = []
+        for p in MyLedgerPal._get_resources_file_paths(output):
+            paths.append(os.path.join(os.path.dirname(p),
+                                      resources_db_filename()))
+            paths.append(p)
+        path = next((p for p in paths if os.path.exists(p)), None)
+        if path is None:
+            return Resources({}, paths[1]), threading.Lock()
+        with self._lock:
+            # the SQLite resources are always up to date
+            if path.endswith(resources_db_filename()):
+                if path not in self._resources:
+                    self._resources[path] = (None, SQLiteResources(path),
+                                             threading.Lock())
+                return self._resources[path][1:]
+            stamp = os.stat(path).st_mtime
+            cached = self._resources.get(path)
+            if cached is None or cached[0] != stamp:
+                with open(path, 'r') as f:
+                    cached = (stamp, Resources(json.load(f), path),
+                              threading.Lock())
+                self._resources[path] = cached
+            return cached[1:]
+
+
+class ImportRequestHandler(SocketServer.StreamRequestHandler):
+    ''' One JSON request per line, the replies are streamed back as JSON
+    lines. The last reply of a request has either a 'posts' or an 'error'
+    key. '''
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise Exception(ERR_INVALID_REQUEST.format(line.strip()))
+                self.server.service.handle(request, self._reply)
+            except Exception as e:
+                self._reply({"error": str(e)})
+
+    def _reply(self, dct):
+        self.wfile.write(json.dumps(dct) + '\n')
+        self.wfile.flush()
+
+
+class ThreadingUnixServer(SocketServer.ThreadingMixIn,
+                          SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class ThreadingTCPServer(SocketServer.ThreadingMixIn,
+                         SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def _is_socket_listened(path):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+    except socket.error as e:
+        if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+            return False
+        raise
+    finally:
+        s.close()
+    return True
+
+
+def serve(socket_path=None, port=None, verbose=False):
+    if port:
+        server = ThreadingTCPServer(('127.0.0.1', int(port)),
+                                    ImportRequestHandler)
+        address = "127.0.0.1:{0}".format(port)
+    else:
+        if not socket_path:
+            socket_path = os.path.join(os.environ.get("HOME", os.getcwd()),
+                                       socket_filename())
+        if os.path.exists(socket_path):
+            # left by a previous service, never remove anything else
+            if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+                raise Exception(ERR_NOT_A_SOCKET.format(socket_path))
+            if _is_socket_listened(socket_path):
+                raise Exception(ERR_SERVICE_RUNNING.format(socket_path))
+            os.remove(socket_path)
+        server = ThreadingUnixServer(socket_path, ImportRequestHandler)
+        address = socket_path
+    server.service = ImportService(verbose)
+    print("Listening on {0}".format(address))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if not port and os.path.exists(socket_path):
+            os.remove(socket_path)
+
 
 if __name__ == '__main__':
     main()
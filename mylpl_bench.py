@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''mylpl_bench.py - Benchmarks of My Ledger Pal.
+Each benchmark prints its result as a JSON line.
+
+Usage:
+  mylpl_bench.py post-memory [-n COUNT]
+  mylpl_bench.py import-memory [-n COUNT]
+  mylpl_bench.py (-h | --help)
+
+Options:
+  -h, --help    Show this help.
+  -n COUNT      Number of posts or rows [default: 1000000].
+'''
+from docopt import docopt
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import mylpl
+import mylpl_testdata
+
+# distinct payees of the posts and sources of the statement rows
+SOURCES = 1000
+
+
+class DictPost(object):
+    ''' Post as it was stored before being compacted, used as a reference:
+    instance dictionary, struct_time date, float amount and a new account
+    split dictionary for each post. '''
+
+    def __init__(self, account, currency, date, checknum, payee,
+                 payee_accounts, amount):
+        self._account = dict(account)
+        self._currency = currency
+        self._date = time.localtime(time.mktime(date))
+        self._cnum = checknum
+        self._payee = payee
+        self._payee_accounts = dict(payee_accounts)
+        self._comment = ""
+        self._amount = amount
+
+
+def _create_posts(cls, count, queue):
+    payees = ["Payee {0}".format(i) for i in range(SOURCES)]
+    # the payees share 50 accounts so the posts share their splits
+    res = mylpl.Resources({"rules": mylpl_testdata.get_rules(SOURCES)},
+                          "dummy_path")
+    dates = [time.strptime("2014/{0}/{1}".format(m, d), "%Y/%m/%d")
+             for m in range(1, 13) for d in range(1, 29)]
+    before = mylpl.get_rss()
+    posts = [cls(res.get_ledger_account("000-000-0000"),
+                 "$",
+                 dates[i % len(dates)],
+                 "",
+                 payees[i % len(payees)],
+                 res.get_payee_account(payees[i % len(payees)]),
+                 -(i % 100000) / 100.0)
+             for i in xrange(count)]
+    queue.put(mylpl.get_rss() - before)
+    del posts
+
+
+def bench_post_memory(count):
+    ''' Memory used by count posts, each post type is measured in its own
+    process. '''
+    result = {"benchmark": "post-memory", "posts": count}
+    for name, cls in (("post", mylpl.Post), ("dict_post", DictPost)):
+        queue = multiprocessing.Queue()
+        p = multiprocessing.Process(target=_create_posts,
+                                    args=(cls, count, queue))
+        p.start()
+        used = queue.get()
+        p.join()
+        result["{0}_bytes".format(name)] = used
+        result["{0}_bytes_per_post".format(name)] = used // max(count, 1)
+    return result
+
+
+def bench_import_memory(count):
+    ''' Memory used by each stage of the import of a statement of count
+    rows. '''
+    d = tempfile.mkdtemp()
+    try:
+        input = os.path.join(d, "statement.csv")
+        mylpl_testdata.write_rbc_statement(input, count, SOURCES)
+        res = mylpl_testdata.get_resources(os.path.join(d, "resources"),
+                                           SOURCES)
+        report = mylpl.MemoryReport()
+        app = mylpl.MyLedgerPal("RBC", input, os.path.join(d, "out.ledger"),
+                                no_backup=True, resources=res,
+                                memory_report=report)
+        # keep the output of the import out of the result line
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        try:
+            app.run()
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        result = {"benchmark": "import-memory", "rows": count}
+        result.update(report.to_dict())
+        return result
+    finally:
+        shutil.rmtree(d)
+
+
+def main():
+    args = docopt(__doc__)
+    if args['post-memory']:
+        print(json.dumps(bench_post_memory(int(args['-n']))))
+    elif args['import-memory']:
+        print(json.dumps(bench_import_memory(int(args['-n']))))
+
+
+if __name__ == '__main__':
+    main()
@@ -100,5 +100,33 @@ class FunctionalTestsMyLedgerPal(unittest.TestCase):
         expected = os.path.join(TEST_DATA_DIR, "RBC.ledger.expected")
         self.assertTrue(filecmp.cmp(result, expected))
 
+    def test_010_run_stdout(self):
+        self._print_func_name(functest=True)
+        p = self._spawn_process(
+            ["python", MYLPL_SCRIPT, "RBC",
+             os.path.join(TEST_DATA_DIR, "RBC.csv"), "-o", "-",
+             "--no-cache"])
+        out, err = p.communicate()
+        print out
+        print err
+        lines = [l for l in out.splitlines() if l]
+        self.assertTrue(lines)
+        # only the entries, a date line followed by its postings
+        for l in lines:
+            self.assertTrue(l[:4] == "2014" or l.startswith("    "), l)
+        self.assertTrue("Number of posts: 9" in err)
+
+    def test_011_interactive_stdout(self):
+        self._print_func_name(functest=True)
+        p = self._spawn_process(
+            ["python", MYLPL_SCRIPT, "-i", "RBC",
+             os.path.join(TEST_DATA_DIR, "RBC.csv"), "-o", "-",
+             "--no-cache"])
+        out, err = p.communicate()
+        print out
+        print err
+        self.assertEqual("", out)
+        self.assertTrue(mylpl.ERR_INTERACTIVE_STDOUT in err)
+
 if __name__ == '__main__':
     unittest.main()
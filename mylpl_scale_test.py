@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+import unittest
+import gc
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import mylpl
+import mylpl_testdata
+
+# rows of the imported statements, the ledger and the alias table grow with
+# them
+TIME_SIZES = (1000, 4000, 16000)
+# the operations are counted exactly, smaller sizes are enough
+OPERATION_SIZES = (500, 2000)
+# growth of the cost per row allowed between the smallest and the biggest
+# size, a quadratic import would grow by the ratio of the sizes
+MAX_TIME_GROWTH = 2.0
+MAX_OPERATION_GROWTH = 1.1
+
+
+class ScaleTestsMyLedgerPal(unittest.TestCase):
+
+    # --------------------------- Utils --------------------------------
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _write_ledger(self, path, count):
+        ''' A ledger of count entries over the dates of the statement so
+        that the posts are inserted between its entries. '''
+        with open(path, 'w') as f:
+            f.write("; -*- ledger -*-\n")
+            for i in xrange(count):
+                day = i * 12 * 28 // count
+                f.write("\n2014/{0:02d}/{1:02d} * Payee {2}\n"
+                        "    Expenses:Payee{3}  {4}.00 CAD\n"
+                        "    Assets:Checking\n".format(
+                            day // 28 + 1, day % 28 + 1, i, i % 50,
+                            i % 1000))
+
+    def _get_import(self, count):
+        ''' Return the import of a statement of count rows, its resources
+        and its ledger are ready. '''
+        d = os.path.join(self._dir, str(count))
+        os.mkdir(d)
+        input = os.path.join(d, "statement.csv")
+        output = os.path.join(d, "my.ledger")
+        # a quarter of the rows come from distinct sources
+        mylpl_testdata.write_rbc_statement(input, count, count // 4)
+        self._write_ledger(output, count)
+        resources = mylpl_testdata.get_resources(
+            os.path.join(self._dir, "resources"), count // 4)
+        return mylpl.MyLedgerPal("RBC", input, output, no_backup=True,
+                                 resources=resources)
+
+    def _run(self, app, trace=None, profile=None):
+        # keep the output of the import out of the test report
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        gc.disable()
+        sys.settrace(trace)
+        sys.setprofile(profile)
+        try:
+            app.run()
+        finally:
+            sys.setprofile(None)
+            sys.settrace(None)
+            gc.enable()
+            sys.stdout.close()
+            sys.stdout = stdout
+
+    def _get_time_per_row(self, count):
+        app = self._get_import(count)
+        start = time.time()
+        self._run(app)
+        return (time.time() - start) / count
+
+    def _get_operations_per_row(self, count):
+        ''' Number of executed Python lines and of calls to builtin
+        functions by row. '''
+        app = self._get_import(count)
+        operations = [0]
+
+        def trace(frame, event, arg):
+            operations[0] += 1
+            return trace
+
+        def profile(frame, event, arg):
+            if event == 'c_call':
+                operations[0] += 1
+        self._run(app, trace, profile)
+        return float(operations[0]) / count
+
+    # ------------------------ Import -----------------------------
+
+    def test_import_time_is_linear(self):
+        times = [self._get_time_per_row(n) for n in TIME_SIZES]
+        self.assertLessEqual(times[-1], times[0] * MAX_TIME_GROWTH,
+                             "time per row by size: {0}".format(
+                                 zip(TIME_SIZES, times)))
+
+    def test_import_operations_are_linear(self):
+        operations = [self._get_operations_per_row(n)
+                      for n in OPERATION_SIZES]
+        self.assertLessEqual(operations[-1],
+                             operations[0] * MAX_OPERATION_GROWTH,
+                             "operations per row by size: {0}".format(
+                                 zip(OPERATION_SIZES, operations)))
+
+    def test_import_is_correct(self):
+        app = self._get_import(1000)
+        self._run(app)
+        with open(os.path.join(self._dir, "1000", "my.ledger"), 'r') as f:
+            dates = [l[:10] for l in f if l[:1].isdigit()]
+        self.assertEqual(2000, len(dates))
+        self.assertEqual(sorted(dates), dates)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+'''mylpl_testdata.py - Generated statements and resources shared by the
+scale tests and the benchmarks of My Ledger Pal.
+
+The rows of a statement come from sources SRC0 to SRC<sources - 1>, each
+source is aliased to a payee and the payees share 50 accounts.
+'''
+import mylpl
+
+
+def write_rbc_statement(path, count, sources):
+    ''' Write a RBC statement of count rows to path. '''
+    with open(path, 'w') as f:
+        f.write('"Type de compte","Num\xe9ro du compte",'
+                '"Date de l\'op\xe9ration","Num\xe9ro du ch\xe8que",'
+                '"Description 1","Description 2","CAD","USD"\n')
+        for i in xrange(count):
+            f.write('Ch\xe8ques,000-000-0000,{0}/{1}/2014,,"Paiement",'
+                    '"SRC{2}",-{3}.{4:02d},,\n'.format(
+                        i % 12 + 1, i % 28 + 1, i % sources,
+                        i % 1000, i % 100))
+
+
+def get_rules(sources):
+    ''' Rules of the payees of the sources. '''
+    rules = {}
+    for i in range(sources):
+        rules.setdefault("Expenses:Payee{0}".format(i % 50),
+                         {})["Payee {0}".format(i)] = 100
+    return rules
+
+
+def get_resources(path, sources):
+    ''' Resources to import the statements of write_rbc_statement, saved
+    to path. '''
+    return mylpl.Resources(
+        {"accounts": {"000-000-0000": {"account": "Assets:Checking",
+                                       "currency": "CAD"}},
+         "aliases": dict(("SRC{0}".format(i), "Payee {0}".format(i))
+                         for i in range(sources)),
+         "rules": get_rules(sources)},
+        path)
@@ -4,6 +4,16 @@ import os
 import shutil
 import time
 import json
+import marshal
+import subprocess
+import tempfile
+import threading
+import gzip
+import bz2
+import heapq
+import zipfile
+from contextlib import closing
+from StringIO import StringIO
 from mock import patch
 
 SCRIPT_PATH = os.path.abspath(os.path.dirname(os.path.realpath(__file__)))
@@ -327,6 +337,217 @@ class UnitTestsMyLedgerPal(unittest.TestCase):
                          "to format %m/%d/%Y",
                          exception_ctx.exception.message)
 
+    # ------------------------ StatementReader -----------------------------
+
+    def _get_statement_reader(self, bank="RBC"):
+        res = mylpl.Resources(self._get_resources_data(), "dummy_path")
+        return mylpl.StatementReader(bank, res)
+
+    def test_statement_reader_detect_bank(self):
+        cls = mylpl.StatementReader
+        with open(os.path.join(TEST_DATA_DIR, "RBC.csv"), 'rb') as f:
+            self.assertEqual("RBC", cls.detect_bank(f))
+            self.assertEqual(0, f.tell())
+        # the case and the spaces of the header don't matter
+        data = StringIO('"TYPE DE COMPTE", "Num\xe9ro du  compte",'
+                        '"Date de l\'op\xe9ration","Num\xe9ro du ch\xe8que",'
+                        '"Description 1","Description 2","CAD","USD"\n')
+        self.assertEqual("RBC", cls.detect_bank(data,
+                                                cls.get_bank_signatures()))
+        self.assertEqual("OFX", cls.detect_bank(
+            StringIO(self._get_ofx_sgml())))
+        self.assertIsNone(cls.detect_bank(StringIO("a,b,c\n1,2,3\n")))
+        self.assertIsNone(cls.detect_bank(StringIO("")))
+
+    def test_run_auto_bank(self):
+        d = tempfile.mkdtemp()
+        try:
+            input = os.path.join(TEST_DATA_DIR, "RBC.csv")
+            for bank in ("RBC", "auto"):
+                output = os.path.join(d, bank + ".ledger")
+                mylpl.MyLedgerPal(bank, input, output, no_backup=True,
+                                  resources=mylpl.Resources(
+                                      self._get_resources_data(),
+                                      "dummy_path")).run()
+            self.assertEqual(self._read(os.path.join(d, "RBC.ledger")),
+                             self._read(os.path.join(d, "auto.ledger")))
+            with open(os.path.join(d, "unknown.csv"), 'w') as f:
+                f.write("a,b,c\n")
+            with self.assertRaises(Exception) as cm:
+                mylpl.MyLedgerPal("auto", os.path.join(d, "unknown.csv"),
+                                  output)
+            self.assertIn("Cannot detect the bank", str(cm.exception))
+        finally:
+            shutil.rmtree(d)
+
+    def test_statement_reader_posts_from_rows(self):
+        reader = self._get_statement_reader()
+        posts = list(reader.posts([self._get_rbc_bank_row()]))
+        self.assertEqual(1, len(posts))
+        self.assertEqual("2014/05/05", posts[0].get_date())
+
+    def test_statement_reader_posts_are_lazy(self):
+        reader = self._get_statement_reader()
+        rows = [self._get_rbc_bank_row(),
+                self._get_rbc_bank_row_wrong_date_format()]
+        posts = reader.posts(rows)
+        self.assertEqual("2014/05/05", next(posts).get_date())
+        with self.assertRaises(Exception):
+            next(posts)
+
+    def test_statement_reader_render_from_file_object(self):
+        reader = self._get_statement_reader()
+        data = StringIO("header\n"
+                        "Cheques,000-000-0000,5/5/2014,,SRC1,,-10.00,,\n")
+        self.assertEqual(
+            [u"2014/05/05 * Source1\n"
+             u"    Expenses:num1                                    "
+             u"10.00 CAD\n"
+             u"    Assets:Acc1\n"], list(reader.render(data)))
+
+    def test_statement_reader_bank_profile(self):
+        reader = self._get_statement_reader(self._get_bank_definition())
+        row = ["", "000-000-0000", "2014/05/05", "", "SRC2", "", "1.5"]
+        post = next(reader.posts([row]))
+        self.assertEqual("Source2", post._payee)
+        self.assertEqual(1.5, post._amount)
+
+    def test_statement_reader_unknown_bank(self):
+        with self.assertRaises(Exception) as exception_ctx:
+            self._get_statement_reader("ubank")
+        self.assertEqual(mylpl.ERR_BANK_UNKNOWN.format("ubank"),
+                         exception_ctx.exception.message)
+
+    def _get_dated_rows(self, days):
+        return [["", "000-000-0000", "2014/05/{0:02d}".format(d), "", "SRC1",
+                 "", "-1"] for d in days]
+
+    def test_statement_reader_date_range(self):
+        res = mylpl.Resources(self._get_resources_data(), "dummy_path")
+        reader = mylpl.StatementReader(self._get_bank_definition(), res,
+                                       since=20140503, until=20140505)
+        posts = reader.posts(self._get_dated_rows([1, 4, 6, 3, 5, 2]))
+        self.assertEqual(["2014/05/04", "2014/05/03", "2014/05/05"],
+                         [p.get_date() for p in posts])
+
+    def test_statement_reader_date_range_skips_decoding(self):
+        res = mylpl.Resources(self._get_resources_data(), "dummy_path")
+        reader = mylpl.StatementReader(self._get_bank_definition(), res,
+                                       since=20140503)
+        with patch.object(reader, "_decode_row",
+                          wraps=reader._decode_row) as m:
+            list(reader.posts(self._get_dated_rows([1, 2, 3])))
+        self.assertEqual(1, m.call_count)
+
+    def test_statement_reader_date_range_stops_on_sorted_rows(self):
+        def rows():
+            for row in self._get_dated_rows([2, 3, 4]):
+                yield row
+            raise AssertionError("read past the range")
+        res = mylpl.Resources(self._get_resources_data(), "dummy_path")
+        bank = self._get_bank_definition()
+        bank["sorted"] = "ascending"
+        reader = mylpl.StatementReader(bank, res, until=20140303)
+        self.assertEqual([], list(reader.posts(rows())))
+        bank["sorted"] = "descending"
+        reader = mylpl.StatementReader(bank, res, since=20140601)
+        self.assertEqual([], list(reader.posts(rows())))
+
+    def test_statement_reader_dates_are_memoized(self):
+        reader = self._get_statement_reader()
+        with patch.object(time, "strptime", wraps=time.strptime) as m:
+            for _ in range(3):
+                self.assertEqual(20140505, reader._parse_date("5/5/2014"))
+        self.assertEqual(1, m.call_count)
+
+    def test_run_date_range(self):
+        d = tempfile.mkdtemp()
+        try:
+            input = os.path.join(TEST_DATA_DIR, "RBC.csv")
+            cache = mylpl.StatementCache(d)
+            for since in (None, 20140501):
+                app = mylpl.MyLedgerPal("RBC", input,
+                                        os.path.join(d, "o.ledger"),
+                                        no_backup=True, cache=cache,
+                                        since=since)
+                posts = app._read_input()
+            self.assertTrue(posts)
+            self.assertTrue(all(p.get_date() >= "2014/05/01" for p in posts))
+        finally:
+            shutil.rmtree(d)
+
+    def test_statement_reader_unknown_format(self):
+        with self.assertRaises(Exception) as exception_ctx:
+            self._get_statement_reader({"format": "qif"})
+        self.assertEqual(mylpl.ERR_FORMAT_UNKNOWN.format(
+            "qif", {"format": "qif"}), exception_ctx.exception.message)
+
+    def test_statement_reader_render_ofx(self):
+        reader = self._get_statement_reader("OFX")
+        self.assertEqual(
+            [u"2014/05/05 * Source1\n"
+             u"    Expenses:num1                                    "
+             u"10.00 CAD\n"
+             u"    Assets:Acc1\n"],
+            list(reader.render(StringIO(self._get_ofx_sgml()))))
+
+    # ------------------------ OFXReader -----------------------------
+
+    def _get_ofx_sgml(self):
+        return ("OFXHEADER:100\r\nDATA:OFXSGML\r\nVERSION:102\r\n"
+                "ENCODING:USASCII\r\nCHARSET:1252\r\n\r\n"
+                "<OFX><BANKMSGSRSV1><STMTTRNRS><STMTRS><CURDEF>CAD\r\n"
+                "<BANKACCTFROM><BANKID>1<ACCTID>000-000-0000"
+                "<ACCTTYPE>CHECKING</BANKACCTFROM>\r\n<BANKTRANLIST>\r\n"
+                "<STMTTRN><TRNTYPE>DEBIT<DTPOSTED>20140505120000[-5:EST]\r\n"
+                "<TRNAMT>-10.00<FITID>1<NAME>SRC1</STMTTRN>\r\n"
+                "</BANKTRANLIST></STMTRS></STMTTRNRS></BANKMSGSRSV1></OFX>")
+
+    def _get_ofx_xml(self):
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<?OFX OFXHEADER="200" VERSION="211"?>\n'
+                '<OFX><CREDITCARDMSGSRSV1><CCSTMTTRNRS><CCSTMTRS>'
+                '<CCACCTFROM><ACCTID>111-111-1111</ACCTID></CCACCTFROM>'
+                '<BANKTRANLIST><STMTTRN><DTPOSTED>20140428</DTPOSTED>'
+                '<TRNAMT>12,50</TRNAMT><CHECKNUM>42</CHECKNUM>'
+                '<NAME>Caf\xc3\xa9 &amp; co</NAME><MEMO>SRC2</MEMO>'
+                '<CCACCTTO><ACCTID>999</ACCTID></CCACCTTO>'
+                '</STMTTRN></BANKTRANLIST></CCSTMTRS></CCSTMTTRNRS>'
+                '</CREDITCARDMSGSRSV1></OFX>')
+
+    def test_ofx_reader_sgml(self):
+        rows = list(mylpl.OFXReader(StringIO(self._get_ofx_sgml())))
+        self.assertEqual(
+            [[u"000-000-0000", u"20140505", u"", u"SRC1", u"", u"-10.00"]],
+            rows)
+
+    def test_ofx_reader_xml(self):
+        rows = list(mylpl.OFXReader(StringIO(self._get_ofx_xml())))
+        self.assertEqual(
+            [[u"111-111-1111", u"20140428", u"42", u"Caf\xe9 & co", u"SRC2",
+              u"12.50"]], rows)
+
+    def test_ofx_reader_small_chunks(self):
+        for data in (self._get_ofx_sgml(), self._get_ofx_xml()):
+            self.assertEqual(
+                list(mylpl.OFXReader(StringIO(data))),
+                list(mylpl.OFXReader(StringIO(data), chunk_size=7)))
+
+    def test_ofx_reader_header_encoding(self):
+        reader = mylpl.OFXReader(StringIO(""))
+        self.assertEqual("cp1252", reader._get_encoding(self._get_ofx_sgml()))
+        self.assertEqual("UTF-8", reader._get_encoding(self._get_ofx_xml()))
+        self.assertEqual("UTF-8", reader._get_encoding("ENCODING:UTF-8\n"))
+
+    def test_ofx_reader_same_fields_as_csv(self):
+        ofx = self._get_statement_reader("OFX")
+        csv = self._get_statement_reader()
+        row = ["Cheques", "000-000-0000", "5/5/2014", "", "SRC1", "",
+               "-10.00"]
+        self.assertEqual(
+            [csv._parse_row(row)],
+            list(ofx._parse_rows(StringIO(self._get_ofx_sgml()))))
+
     # ------------------------ Resources -----------------------------
 
     def test_resource_rotate_rules(self):
@@ -375,6 +596,18 @@ class UnitTestsMyLedgerPal(unittest.TestCase):
         self.assertEqual({"Assets:000-000-0000": 100},
                          res.get_ledger_account("000-000-0000"))
 
+    def test_resource_get_ledger_account_is_shared(self):
+        dct = self._get_resources_data()
+        res = mylpl.Resources(dct, "dummy_path")
+        self.assertIs(res.get_ledger_account("000-000-0000"),
+                      res.get_ledger_account("000-000-0000"))
+
+    def test_resource_rules_with_same_split_are_shared(self):
+        dct = self._get_resources_data()
+        res = mylpl.Resources(dct, "dummy_path")
+        self.assertIs(res.get_payee_account("Source1"),
+                      res.get_payee_account("Source2"))
+
     def test_resource_get_ledger_account_get_currency(self):
         dct = self._get_resources_data()
         res = mylpl.Resources(dct, "dummy_path")
@@ -394,6 +627,14 @@ class UnitTestsMyLedgerPal(unittest.TestCase):
         self.assertEqual("$", res.get_currency("000-000-0000"))
         self.assertEqual("$", res.get_currency("111-111-1111"))
 
+    def test_resource_get_ledger(self):
+        dct = self._get_resources_data()
+        dct["accounts"]["111-111-1111"]["ledger"] = "acc2.ledger"
+        res = mylpl.Resources(dct, "dummy_path")
+        self.assertIsNone(res.get_ledger("000-000-0000"))
+        self.assertEqual("acc2.ledger", res.get_ledger("111-111-1111"))
+        self.assertIsNone(res.get_ledger("222-222-2222"))
+
     def test_resource_load_with_aliases_in_data(self):
         dct = self._get_resources_data()
         res = mylpl.Resources(dct, "dummy_path")
@@ -460,6 +701,13 @@ class UnitTestsMyLedgerPal(unittest.TestCase):
         self.assertEqual("Source2", res.get_payee("SRC2"))
         self.assertEqual("Source3", res.get_payee("SRC3"))
 
+    def test_resource_get_payee_longest_alias(self):
+        dct = self._get_resources_data()
+        dct["aliases"]["SRC1 LONG"] = "Source1Long"
+        res = mylpl.Resources(dct, "dummy_path")
+        self.assertEqual("Source1Long", res.get_payee("X SRC1 LONG"))
+        self.assertEqual("Source1", res.get_payee("X SRC1 SHORT"))
+
     def test_resource_get_payee_with_no_alias_in_data(self):
         dct = self._get_resources_data_no_alias()
         res = mylpl.Resources(dct, "dummy_path")
@@ -487,6 +735,78 @@ class UnitTestsMyLedgerPal(unittest.TestCase):
         self.assertEqual({"Expenses:Unknown": 100},
                          res.get_payee_account("Source3"))
 
+    def test_resource_get_similar_aliases(self):
+        dct = self._get_resources_data()
+        res = mylpl.Resources(dct, "dummy_path")
+        self.assertEqual([("SRC3", "Source3")],
+                         res.get_similar_aliases("XSRC3", 1))
+
+    @patch("mylpl.rlinput", side_effect=lambda prompt, prefill='': prefill)
+    def test_resource_get_payee_interactive_suggests_similar_payee(
+            self, rlinput_mock):
+        dct = self._get_resources_data()
+        res = mylpl.Resources(dct, "dummy_path", interactive=True)
+        self.assertEqual("Source2", res.get_payee("SOURCE-2 SHOP"))
+        self.assertEqual("Source2", res.get_alias("SOURCE-2 SHOP"))
+
+    @patch("mylpl.rlinput", side_effect=lambda prompt, prefill='': prefill)
+    def test_resource_get_payee_interactive_no_similar_payee(
+            self, rlinput_mock):
+        dct = self._get_resources_data()
+        dct["aliases"]["COSTCO WHOLESAL"] = "Costco"
+        res = mylpl.Resources(dct, "dummy_path", interactive=True)
+        # only "al " is shared with COSTCO WHOLESAL
+        self.assertEqual([], res.get_similar_aliases(
+            u"PHARMAPRIX 0456 MONTREAL"))
+        self.assertEqual(u"PHARMAPRIX 0456 MONTREAL",
+                         res.get_payee(u"PHARMAPRIX 0456 MONTREAL"))
+
+    @patch("__builtin__.raw_input", return_value="")
+    def test_resource_get_payee_account_interactive_no_similar_split(
+            self, raw_input_mock):
+        dct = self._get_resources_data()
+        res = mylpl.Resources(dct, "dummy_path", interactive=True)
+        self.assertEqual({"Expenses:Unknown": 100},
+                         res.get_payee_account("Sourdough Bakery"))
+
+    def test_resource_prefetch_similar_aliases(self):
+        dct = self._get_resources_data()
+        res = mylpl.Resources(dct, "dummy_path", interactive=True)
+        res.prefetch("SOURCE-2 SHOP")
+        res.prefetch("SRC1")
+        self.assertEqual([("SOURCE-2 SHOP", 5)], res._similar.keys())
+        res.add_alias("SOURCE-2 SHO", "Shop")
+        self.assertEqual(("SOURCE-2 SHO", "Shop"),
+                         res.get_similar_aliases("SOURCE-2 SHOP")[0])
+        self.assertEqual({}, res._similar)
+
+    @patch("__builtin__.raw_input", return_value="")
+    def test_resource_get_payee_account_interactive_suggests_split(
+            self, raw_input_mock):
+        dct = self._get_resources_data()
+        res = mylpl.Resources(dct, "dummy_path", interactive=True)
+        self.assertEqual({"Expenses:num2": 40, "Expenses:num3": 60},
+                         res.get_payee_account("Source3 Inc"))
+
+    @patch("__builtin__.raw_input", return_value="")
+    def test_resource_get_payee_account_interactive_history_default(
+            self, raw_input_mock):
+        dct = self._get_resources_data()
+        res = mylpl.Resources(dct, "dummy_path", interactive=True)
+        index = mylpl.HistoryIndex()
+        index.add(u"Source3 Inc", ((u"Expenses:num1", 100),))
+        res.set_history(index)
+        self.assertEqual({"Expenses:num1": 100},
+                         res.get_payee_account("Source3 Inc"))
+
+    @patch("__builtin__.raw_input", return_value="")
+    def test_resource_get_payee_account_interactive_no_suggestion(
+            self, raw_input_mock):
+        dct = self._get_resources_data_no_rule()
+        res = mylpl.Resources(dct, "dummy_path", interactive=True)
+        self.assertEqual({"Expenses:Unknown": 100},
+                         res.get_payee_account("Source3 Inc"))
+
     def test_resource_add_ledger_account(self):
         dct = self._get_resources_data()
         res = mylpl.Resources(dct, "dummy_path")
@@ -582,13 +902,143 @@ class UnitTestsMyLedgerPal(unittest.TestCase):
 
     def test_resource_read_write_idempotency(self):
         dct = self._get_resources_data()
-        out = os.path.join(SCRIPT_PATH, "tmp.txt")
-        res = mylpl.Resources(dct, out)
-        res.write()
-        with open(out, 'r') as f:
-            content = f.read()
-        os.remove(out)
-        self.assertEqual(dct, json.loads(content))
+        d = tempfile.mkdtemp()
+        try:
+            out = os.path.join(d, "tmp.txt")
+            res = mylpl.Resources(dct, out)
+            res.write()
+            with open(out, 'r') as f:
+                content = f.read()
+            self.assertEqual(dct, json.loads(content))
+            # nothing is left beside the resources file
+            self.assertEqual(["tmp.txt"], os.listdir(d))
+        finally:
+            shutil.rmtree(d)
+
+    def test_resource_write_keeps_changes_of_other_processes(self):
+        d = tempfile.mkdtemp()
+        try:
+            out = os.path.join(d, ".mylplrc")
+            res = mylpl.Resources(self._get_resources_data(), out)
+            other = mylpl.Resources({}, out)
+            other.add_alias("SRC4", "Source4")
+            other.add_rule("Source4", [("Expenses:num4", 100)])
+            other.write()
+            res.add_alias("SRC1", "Source5")
+            res.write()
+            with open(out, 'r') as f:
+                content = json.load(f)
+            self.assertEqual({"SRC1": "Source5",
+                              "SRC2": "Source2",
+                              "SRC3": "Source3",
+                              "SRC4": "Source4"}, content["aliases"])
+            self.assertEqual({"Source4": 100},
+                             content["rules"]["Expenses:num4"])
+        finally:
+            shutil.rmtree(d)
+
+    # ------------------------ SQLiteResources -----------------------------
+
+    def _get_sqlite_resources(self, path=":memory:"):
+        res = mylpl.SQLiteResources(path)
+        res.import_json(self._get_resources_data())
+        return res
+
+    def test_sqlite_resource_export_json(self):
+        res = self._get_sqlite_resources()
+        self.assertEqual(self._get_resources_data(), res.export_json())
+
+    def test_sqlite_resource_import_json_invalid_rule(self):
+        dct = self._get_resources_data()
+        dct["rules"]["Expenses:num4"] = {"Source1": 20}
+        res = mylpl.SQLiteResources(":memory:")
+        with self.assertRaises(Exception) as exception_ctx:
+            res.import_json(dct)
+        self.assertEqual(mylpl.ERR_PERCENTAGE_SUM_NOT_EQUAL_TO_100,
+                         exception_ctx.exception.message)
+        self.assertEqual({}, res.get_aliases())
+
+    def test_sqlite_resource_ledger(self):
+        res = self._get_sqlite_resources()
+        self.assertIsNone(res.get_ledger("000-000-0000"))
+        res._set_account_info("000-000-0000", {"account": "Assets:Acc1",
+                                               "ledger": "acc1.ledger"})
+        self.assertEqual("acc1.ledger", res.get_ledger("000-000-0000"))
+        res.add_ledger_account("000-000-0000", "Assets:Acc", "CAD")
+        self.assertEqual({"account": "Assets:Acc", "currency": "CAD",
+                          "ledger": "acc1.ledger"},
+                         res.export_json()["accounts"]["000-000-0000"])
+
+    def test_sqlite_resource_adds_ledger_column(self):
+        d = tempfile.mkdtemp()
+        try:
+            path = os.path.join(d, "res.db")
+            db = mylpl.sqlite3.connect(path)
+            db.execute("CREATE TABLE accounts (number TEXT PRIMARY KEY, "
+                       "account TEXT, currency TEXT)")
+            db.execute("INSERT INTO accounts VALUES ('1', 'Assets:A', '$')")
+            db.commit()
+            db.close()
+            res = mylpl.SQLiteResources(path)
+            self.assertEqual({"1": {"account": "Assets:A", "currency": "$"}},
+                             res.get_accounts())
+            self.assertIsNone(res.get_ledger("1"))
+        finally:
+            shutil.rmtree(d)
+
+    def test_sqlite_resource_counts(self):
+        res = self._get_sqlite_resources()
+        self.assertEqual(2, res.get_account_count())
+        self.assertEqual(3, res.get_alias_count())
+        self.assertEqual(3, res.get_rule_count())
+
+    def test_sqlite_resource_get_payee(self):
+        res = self._get_sqlite_resources()
+        self.assertEqual("Source1", res.get_payee("XX SRC1 YY"))
+        self.assertEqual("NOALIAS", res.get_payee("NOALIAS"))
+
+    def test_sqlite_resource_get_payee_account(self):
+        res = self._get_sqlite_resources()
+        self.assertEqual({"Expenses:num2": 40, "Expenses:num3": 60},
+                         res.get_payee_account("Source3"))
+        self.assertEqual({"Expenses:Unknown": 100},
+                         res.get_payee_account("Unknown"))
+
+    def test_sqlite_resource_get_ledger_account_and_currency(self):
+        res = self._get_sqlite_resources()
+        self.assertEqual({"Assets:Acc1": 100},
+                         res.get_ledger_account("000-000-0000"))
+        self.assertEqual("USD", res.get_currency("111-111-1111"))
+        self.assertEqual("$", res.get_currency("222-222-2222"))
+
+    def test_sqlite_resource_add_rule_not_equal_to_100(self):
+        res = self._get_sqlite_resources()
+        with self.assertRaises(Exception):
+            res.add_rule("Source1", [("Expenses:num4", 20)])
+        self.assertEqual({"Expenses:num1": 100},
+                         res.get_payee_account("Source1"))
+
+    def test_sqlite_resource_concurrent_changes(self):
+        d = tempfile.mkdtemp()
+        try:
+            path = os.path.join(d, mylpl.resources_db_filename())
+            self._get_sqlite_resources(path).write()
+            # another importer would fail at once if a write transaction
+            # was left open
+            with patch.object(mylpl.SQLiteResources, "TIMEOUT", 0):
+                res = mylpl.SQLiteResources(path)
+                other = mylpl.SQLiteResources(path)
+                res.add_alias("SRC4", "Source4")
+                other.add_alias("SRC5", "Source5")
+                other.add_rule("Source5", [("Expenses:num1", 100)])
+                res.add_rule("Source4", [("Expenses:num2", 100)])
+            res = mylpl.SQLiteResources(path)
+            self.assertEqual("Source4", res.get_payee("SRC4"))
+            self.assertEqual("Source5", res.get_payee("SRC5"))
+            self.assertEqual({"Expenses:num1": 100},
+                             res.get_payee_account("Source5"))
+        finally:
+            shutil.rmtree(d)
 
     # ------------------------ Post -----------------------------
 
@@ -653,6 +1103,18 @@ class UnitTestsMyLedgerPal(unittest.TestCase):
         self.assertEqual(u"    Expenses:Payee",
                          post._format_balance_account())
 
+    def test_post_is_compact(self):
+        post = self._get_post()
+        self.assertFalse(hasattr(post, "__dict__"))
+        self.assertEqual(20140902, post._date)
+        self.assertEqual(-10000, post._cents)
+
+    def test_post_integer_date(self):
+        post = mylpl.Post({"Assets:MyAccount": 100}, "$", 20141231, "",
+                          "Payee", {"Expenses:Payee": 100}, -0.1)
+        self.assertEqual("2014/12/31", post.get_date())
+        self.assertEqual(-10, post._cents)
+
     def test__validate_ok(self):
         post = self._get_post()
         post._validate()
@@ -706,5 +1168,1252 @@ class UnitTestsMyLedgerPal(unittest.TestCase):
         self.assertEqual(mylpl.ERR_PERCENTAGE_SUM_NOT_EQUAL_TO_100,
                          exception_ctx.exception.message)
 
+    # ------------------------ TrigramIndex -----------------------------
+
+    def test_trigram_index_search(self):
+        index = mylpl.TrigramIndex([u"COSTCO WHOLESAL", u"HYDRO QUEBEC",
+                                    u"COSTCO ESSENCE"])
+        res = index.search(u"costco wholesale 123", 2)
+        self.assertEqual([u"COSTCO WHOLESAL", u"COSTCO ESSENCE"],
+                         [k for score, k in res])
+        self.assertTrue(res[0][0] > res[1][0])
+
+    def test_trigram_index_search_no_match(self):
+        index = mylpl.TrigramIndex([u"HYDRO QUEBEC"])
+        self.assertEqual([], index.search(u"xyz"))
+
+    def test_trigram_index_update(self):
+        index = mylpl.TrigramIndex([u"COSTCO WHOLESAL", u"HYDRO QUEBEC"])
+        found = index.search(u"costco essence", 2)
+        index.add(u"COSTCO ESSENCE")
+        index.add(u"ESSO")
+        self.assertEqual(index.search(u"costco essence", 2),
+                         index.update(u"costco essence", found, 2, 2))
+        self.assertEqual(u"COSTCO ESSENCE", index.search(u"costco essence",
+                                                         2)[0][1])
+
+    def test_trigram_index_add_twice(self):
+        index = mylpl.TrigramIndex([u"IGA", u"IGA"])
+        self.assertEqual(1, len(index))
+
+    # ------------------------ HistoryIndex -----------------------------
+
+    def _get_history_index(self):
+        index = mylpl.HistoryIndex()
+        for payee, split in [(u"IGA #12", ((u"Expenses:num1", 100),)),
+                             (u"IGA #34", ((u"Expenses:num2", 100),)),
+                             (u"IGA #34", ((u"Expenses:num1", 100),)),
+                             (u"Hydro", ((u"Expenses:num2", 100),)),
+                             (u"Source1", ((u"Expenses:num2", 100),))]:
+            index.add(payee, split)
+        return index
+
+    def test_history_index_get_split(self):
+        index = self._get_history_index()
+        # the most recent split first when they are as frequent
+        self.assertEqual(((u"Expenses:num1", 100),),
+                         index.get_split(u"IGA #34"))
+        self.assertEqual(((u"Expenses:num1", 100),), index.get_split(u"IGA"))
+        self.assertIsNone(index.get_split(u"Unknown"))
+
+    def test_history_index_suggest(self):
+        res = mylpl.Resources(self._get_resources_data(), "dummy_path")
+        index = self._get_history_index()
+        self.assertEqual({"aliases": {u"IGA": u"IGA"},
+                          "rules": {u"Expenses:num1": {u"IGA": 100},
+                                    u"Expenses:num2": {u"Hydro": 100}}},
+                         index.suggest(res))
+        self.assertEqual({"aliases": {u"IGA": u"IGA"},
+                          "rules": {u"Expenses:num1": {u"IGA": 100}}},
+                         index.suggest(res, 2))
+
+    def test_ledger_get_history_updated_by_insert(self):
+        path = self._get_ledger_path()
+        ledger = mylpl.Ledger(path)
+        ledger.insert([("2014/05/05", str(mylpl.Post(
+            {"Assets:Acc1": 100}, "CAD", 20140505, "", "Hydro",
+            {"Expenses:num2": 100}, -10)))])
+        ledger.get_history({"Assets:Acc1"})
+        ledger.insert([("2014/05/06", "2014/05/06 * IGA\n"
+                        "    Expenses:num1  10.00 CAD\n"
+                        "    Assets:Acc1\n")])
+        with patch.object(mylpl.Ledger, "get_splits") as get_splits:
+            index = mylpl.Ledger(path).get_history({"Assets:Acc1"})
+            self.assertFalse(get_splits.called)
+        self.assertEqual(((u"Expenses:num2", 100),),
+                         index.get_split(u"Hydro"))
+        self.assertEqual(((u"Expenses:num1", 100),),
+                         index.get_split(u"IGA"))
+        # for other accounts or modified by something else, the index is
+        # built again
+        with patch.object(mylpl.Ledger, "get_splits",
+                          return_value=iter([])) as get_splits:
+            mylpl.Ledger(path).get_history()
+            self.assertTrue(get_splits.called)
+        with open(path, 'ab') as f:
+            f.write("\n2014/05/07 * Bell\n"
+                    "    Expenses:num3  10.00 CAD\n"
+                    "    Assets:Acc1\n")
+        self.assertEqual(3, len(mylpl.Ledger(path).get_history(
+            {"Assets:Acc1"})))
+
+    # ------------------------ StatementCache -----------------------------
+
+    def test_statement_cache_key_depends_on_content_and_profile(self):
+        cache = mylpl.StatementCache("dummy_dir")
+        rbc = self._get_rbc_bank_definition()
+        key = cache.get_key(StringIO("a,b"), rbc)
+        self.assertEqual(key, cache.get_key(StringIO("a,b"), rbc))
+        self.assertNotEqual(key, cache.get_key(StringIO("a,c"), rbc))
+        self.assertNotEqual(key, cache.get_key(StringIO("a,b"),
+                                               self._get_bank_definition()))
+
+    def test_statement_cache_save_load(self):
+        d = tempfile.mkdtemp()
+        try:
+            cache = mylpl.StatementCache(os.path.join(d, "cache"))
+            rows = [(u"000-000-0000", 20140505, u"", u"SRC1", -1000)]
+            self.assertEqual((None, 0), cache.load("key"))
+            cache.save("key", rows, 2)
+            self.assertEqual((rows, 2), cache.load("key"))
+        finally:
+            shutil.rmtree(d)
+
+    def test_statement_cache_imports(self):
+        d = tempfile.mkdtemp()
+        try:
+            cache = mylpl.StatementCache(d)
+            self.assertFalse(cache.is_imported("key", "/a.ledger"))
+            cache.add_import("key", "/a.ledger")
+            cache.add_import("key", "/a.ledger")
+            self.assertTrue(cache.is_imported("key", "/a.ledger"))
+            self.assertFalse(cache.is_imported("key", "/b.ledger"))
+        finally:
+            shutil.rmtree(d)
+
+    def test_statement_cache_prune(self):
+        d = tempfile.mkdtemp()
+        try:
+            rows = [(u"000-000-0000", 20140505, u"", u"SRC1", -1000)]
+            size = len(marshal.dumps((rows, 0)))
+            cache = mylpl.StatementCache(d, max_age=3600,
+                                         max_size=2 * size)
+            cache.save("old", rows)
+            cache.save("used", rows)
+            cache.add_import("old", "/a.ledger")
+            past = time.time() - 7200
+            os.utime(os.path.join(d, "old.imports"), (past, past))
+            os.utime(os.path.join(d, "old.rows"), (past - 10, past - 10))
+            os.utime(os.path.join(d, "used.rows"), (past - 20, past - 20))
+            # loading an entry keeps it in the cache
+            self.assertEqual((rows, 0), cache.load("used"))
+            cache.save("new", rows)
+            self.assertEqual(["new.rows", "used.rows"],
+                             sorted(os.listdir(d)))
+            # the least recently used entry makes room for the new one
+            past = time.time() - 60
+            os.utime(os.path.join(d, "used.rows"), (past, past))
+            cache.save("newer", rows)
+            self.assertEqual(["new.rows", "newer.rows"],
+                             sorted(os.listdir(d)))
+        finally:
+            shutil.rmtree(d)
+
+    def test_run_with_cache_skips_parsing(self):
+        d = tempfile.mkdtemp()
+        try:
+            input = os.path.join(TEST_DATA_DIR, "RBC.csv")
+            cache = mylpl.StatementCache(d)
+            for output in ("a.ledger", "b.ledger"):
+                app = mylpl.MyLedgerPal("RBC", input,
+                                        os.path.join(d, output),
+                                        no_backup=True, cache=cache)
+                with patch.object(app, "_parse_row",
+                                  wraps=app._parse_row) as m:
+                    app.run()
+            self.assertEqual(0, m.call_count)
+            self.assertEqual(self._read(os.path.join(d, "a.ledger")),
+                             self._read(os.path.join(d, "b.ledger")))
+        finally:
+            shutil.rmtree(d)
+
+    # ------------------------ Compressed statements -----------------------
+
+    def _import(self, input, output):
+        mylpl.MyLedgerPal("RBC", input, output, no_backup=True).run()
+        return self._read(output)
+
+    def test_get_compression(self):
+        self.assertIsNone(mylpl.get_compression(
+            os.path.join(TEST_DATA_DIR, "RBC.csv")))
+        d = tempfile.mkdtemp()
+        try:
+            path = os.path.join(d, "a.gz")
+            with closing(gzip.GzipFile(path, 'wb')) as f:
+                f.write("data")
+            self.assertEqual("gzip", mylpl.get_compression(path))
+        finally:
+            shutil.rmtree(d)
+
+    def test_run_compressed(self):
+        d = tempfile.mkdtemp()
+        try:
+            input = os.path.join(TEST_DATA_DIR, "RBC.csv")
+            expected = self._import(input, os.path.join(d, "a.ledger"))
+            openers = [("gz", gzip.GzipFile), ("bz2", bz2.BZ2File)]
+            if mylpl.lzma is not None:
+                openers.append(("xz", mylpl.lzma.LZMAFile))
+            for ext, opener in openers:
+                path = os.path.join(d, "RBC.csv." + ext)
+                with closing(opener(path, 'wb')) as f:
+                    f.write(self._read(input))
+                self.assertEqual(expected, self._import(
+                    path, os.path.join(d, ext + ".ledger")))
+        finally:
+            shutil.rmtree(d)
+
+    def test_run_zip_imports_every_member(self):
+        d = tempfile.mkdtemp()
+        try:
+            inputs = [os.path.join(TEST_DATA_DIR, n)
+                      for n in ("RBC.csv", "RBC2.csv")]
+            for i in inputs:
+                expected = self._import(i, os.path.join(d, "a.ledger"))
+            path = os.path.join(d, "statements.zip")
+            with closing(zipfile.ZipFile(path, 'w',
+                                         zipfile.ZIP_DEFLATED)) as z:
+                for i in inputs:
+                    z.write(i, os.path.basename(i))
+            cache = mylpl.StatementCache(os.path.join(d, "cache"))
+            app = mylpl.MyLedgerPal("RBC", path, os.path.join(d, "b.ledger"),
+                                    no_backup=True, cache=cache)
+            app.run()
+            self.assertEqual(expected, self._read(os.path.join(d,
+                                                               "b.ledger")))
+            self.assertEqual(2, len(app._cache_keys))
+        finally:
+            shutil.rmtree(d)
+
+    def test_run_route_accounts(self):
+        d = tempfile.mkdtemp()
+        try:
+            input = os.path.join(d, "statement.csv")
+            with open(input, 'w') as f:
+                f.write("header\n"
+                        "C,000-000-0000,5/5/2014,,SRC1,,-10.00,,\n"
+                        "C,111-111-1111,5/6/2014,,SRC2,,-20.00,,\n"
+                        "C,222-222-2222,5/7/2014,,SRC3,,-30.00,,\n"
+                        "C,111-111-1111,5/4/2014,,SRC1,,-40.00,,\n")
+            data = self._get_resources_data()
+            data["accounts"]["111-111-1111"]["ledger"] = "acc2.ledger"
+            data["accounts"]["222-222-2222"] = {"ledger": "sub/acc3.ledger"}
+            res = mylpl.Resources(data, os.path.join(d, "res"))
+            os.mkdir(os.path.join(d, "sub"))
+            app = mylpl.MyLedgerPal("RBC", input, os.path.join(d, "o.ledger"),
+                                    no_backup=True, resources=res,
+                                    route=True)
+            with patch.object(mylpl.Ledger, "submit",
+                              autospec=True,
+                              side_effect=mylpl.Ledger.submit) as m:
+                app.run()
+            self.assertEqual(3, m.call_count)
+            main = self._read(os.path.join(d, "o.ledger"))
+            acc2 = self._read(os.path.join(d, "acc2.ledger"))
+            acc3 = self._read(os.path.join(d, "sub", "acc3.ledger"))
+            self.assertIn("Assets:Acc1", main)
+            self.assertNotIn("Liabilites:Acc2", main)
+            self.assertEqual(2, acc2.count("Liabilites:Acc2"))
+            self.assertLess(acc2.index("2014/05/04"),
+                            acc2.index("2014/05/06"))
+            self.assertIn("Assets:222-222-2222", acc3)
+        finally:
+            shutil.rmtree(d)
+
+    def test_run_stdout(self):
+        d = tempfile.mkdtemp()
+        try:
+            expected = self._import(os.path.join(TEST_DATA_DIR, "RBC.csv"),
+                                    os.path.join(d, "a.ledger"))
+            app = mylpl.MyLedgerPal("RBC",
+                                    os.path.join(TEST_DATA_DIR, "RBC.csv"),
+                                    mylpl.MyLedgerPal.STDOUT)
+            stdout = StringIO()
+            stderr = StringIO()
+            with patch("sys.stdout", stdout), patch("sys.stderr", stderr):
+                with patch.object(mylpl.MyLedgerPal, "STDOUT_CHUNK_SIZE",
+                                  100):
+                    with patch.object(stdout, "write",
+                                      wraps=stdout.write) as m:
+                        app.run()
+            self.assertFalse(os.path.exists(mylpl.MyLedgerPal.STDOUT))
+            self.assertEqual(expected.split("\n", 2)[2], stdout.getvalue())
+            self.assertGreater(m.call_count, 1)
+            self.assertLess(m.call_count, expected.count("\n"))
+            self.assertEqual("Number of posts: 9\n", stderr.getvalue())
+        finally:
+            shutil.rmtree(d)
+
+    def test_run_stdout_closed_pipe(self):
+        app = mylpl.MyLedgerPal("RBC", os.path.join(TEST_DATA_DIR, "RBC.csv"),
+                                mylpl.MyLedgerPal.STDOUT)
+        error = IOError(mylpl.errno.EPIPE, "Broken pipe")
+        with patch("sys.stdout") as stdout, patch("sys.stderr"):
+            stdout.write.side_effect = error
+            app.run()
+
+    # ------------------------ Checkpoint -----------------------
+
+    def _write_long_statement(self, path, bad_row=None):
+        with open(path, 'w') as f:
+            f.write("header\n")
+            for n in range(50):
+                date = "{0}/{1}/2014".format(n % 12 + 1, n % 28 + 1)
+                if n == bad_row:
+                    date = "2014/13/01"
+                f.write("C,000-000-0000,{0},,SRC{1},,-{2}.00,,\n".format(
+                    date, n % 3 + 1, n))
+
+    def _get_checkpointed_app(self, d, input, resume=False,
+                              output="o.ledger", checkpoint=10):
+        res = mylpl.Resources(self._get_resources_data(),
+                              os.path.join(d, "res"))
+        return mylpl.MyLedgerPal("RBC", input, os.path.join(d, output),
+                                 no_backup=True, resources=res,
+                                 checkpoint=checkpoint, resume=resume)
+
+    def test_run_checkpoint_resume(self):
+        d = tempfile.mkdtemp()
+        try:
+            input = os.path.join(d, "statement.csv")
+            self._write_long_statement(input)
+            self._get_checkpointed_app(d, input, output="expected",
+                                       checkpoint=None).run()
+            expected = self._read(os.path.join(d, "expected"))
+            self._write_long_statement(input, bad_row=35)
+            app = self._get_checkpointed_app(d, input)
+            with self.assertRaises(Exception):
+                app.run()
+            self.assertFalse(os.path.exists(os.path.join(d, "o.ledger")) and
+                             self._read(os.path.join(d, "o.ledger")))
+            checkpoint = mylpl.Checkpoint(os.path.join(d, "o.ledger"),
+                                          app._get_checkpoint_key())
+            self.assertEqual(30, len(checkpoint.load()))
+            # fix the statement and resume
+            self._write_long_statement(input)
+            app = self._get_checkpointed_app(d, input, resume=True)
+            with patch.object(app, "_parse_row",
+                              wraps=app._parse_row) as m:
+                app.run()
+            self.assertEqual(20, m.call_count)
+            self.assertEqual(expected,
+                             self._read(os.path.join(d, "o.ledger")))
+            self.assertFalse(checkpoint.exists())
+        finally:
+            shutil.rmtree(d)
+
+    def test_run_checkpoint_input_changed(self):
+        d = tempfile.mkdtemp()
+        try:
+            input = os.path.join(d, "statement.csv")
+            self._write_long_statement(input, bad_row=35)
+            with self.assertRaises(Exception):
+                self._get_checkpointed_app(d, input).run()
+            self._write_long_statement(input, bad_row=5)
+            with self.assertRaises(Exception) as exception_ctx:
+                self._get_checkpointed_app(d, input, resume=True).run()
+            self.assertEqual(mylpl.ERR_CHECKPOINT_MISMATCH.format(
+                os.path.join(d, "o.ledger")),
+                exception_ctx.exception.message)
+        finally:
+            shutil.rmtree(d)
+
+    def test_checkpoint_ignores_unsaved_entries(self):
+        d = tempfile.mkdtemp()
+        try:
+            output = os.path.join(d, "o.ledger")
+            checkpoint = mylpl.Checkpoint(output, "key")
+            checkpoint.save([("o", "2014/05/01", "A\n")], 0, 10, "x", 1)
+            # a save which failed before the position was saved
+            with open(checkpoint._path + ".entries", "ab") as f:
+                marshal.dump(("o", "2014/05/02", "B\n"), f)
+            checkpoint = mylpl.Checkpoint(output, "key")
+            self.assertEqual([("o", "2014/05/01", "A\n")],
+                             checkpoint.load())
+            self.assertEqual((0, 10, "x", 1),
+                             (checkpoint.statement, checkpoint.offset,
+                              checkpoint.digest, checkpoint.rows))
+            self.assertIsNone(mylpl.Checkpoint(output, "other").load())
+            checkpoint.remove()
+            self.assertEqual([], os.listdir(d))
+        finally:
+            shutil.rmtree(d)
+
+    # ------------------------ Interactive import -----------------------
+
+    def _run_interactive(self, d, input, interactive=True):
+        res = mylpl.Resources(self._get_resources_data(),
+                              os.path.join(d, "res"), interactive)
+        output = os.path.join(d, "o.ledger")
+        if os.path.exists(output):
+            os.remove(output)
+        mylpl.MyLedgerPal("RBC", input, output, interactive, no_backup=True,
+                          resources=res).run()
+        return self._read(output)
+
+    @patch("__builtin__.raw_input", return_value="")
+    @patch("mylpl.rlinput", side_effect=lambda prompt, prefill='': prefill)
+    def test_run_interactive_resolves_ahead(self, rlinput_mock,
+                                            raw_input_mock):
+        d = tempfile.mkdtemp()
+        try:
+            input = os.path.join(d, "statement.csv")
+            self._write_long_statement(input)
+            with open(input, 'a') as f:
+                f.write("C,000-000-0000,1/1/2014,,NEW SHOP,,-1.00,,\n")
+            expected = self._run_interactive(d, input, False)
+            with patch.object(mylpl.Resources, "prefetch",
+                              autospec=True,
+                              side_effect=mylpl.Resources.prefetch) as m:
+                self.assertEqual(expected, self._run_interactive(d, input))
+            self.assertEqual(51, m.call_count)
+            # the match and the alias of NEW SHOP
+            self.assertEqual(2, rlinput_mock.call_count)
+        finally:
+            shutil.rmtree(d)
+
+    def test_run_interactive_parse_error(self):
+        d = tempfile.mkdtemp()
+        try:
+            input = os.path.join(d, "statement.csv")
+            self._write_long_statement(input, bad_row=35)
+            with self.assertRaises(Exception) as cm:
+                self._run_interactive(d, input)
+            self.assertIn("2014/13/01", str(cm.exception))
+        finally:
+            shutil.rmtree(d)
+
+    # ------------------------ Balances -----------------------
+
+    def _run_with_balances(self, d, balance=None):
+        input = os.path.join(d, "statement.csv")
+        with open(input, 'w') as f:
+            f.write("header\n"
+                    "C:000-000-0000:2014/05/02::SRC1::-10.00:90.00\n"
+                    "C:000-000-0000:2014/05/03::SRC2::-5.00:85.00\n"
+                    "C:000-000-0000:2014/05/03::SRC3::2.00:87.00\n"
+                    "C:000-000-0000:2014/05/04::SRC3::-7.00:70.00\n")
+        bank = self._get_bank_definition()
+        bank[mylpl.MyLedgerPal.BANK_COLNAME_BALANCE] = 7
+        output = os.path.join(d, "o.ledger")
+        with open(output, 'w') as f:
+            f.write("; -*- ledger -*-\n\n2014/05/01 * Opening\n"
+                    "    Assets:Acc1                100.00 CAD\n"
+                    "    Equity:Opening\n")
+        res = mylpl.Resources(self._get_resources_data(),
+                              os.path.join(d, "res"))
+        app = mylpl.MyLedgerPal(bank, input, output, no_backup=True,
+                                resources=res, balance=balance)
+        with patch.object(app, "_message") as message:
+            app.run()
+        return [c[0][0] for c in message.call_args_list]
+
+    def test_run_check_balances(self):
+        d = tempfile.mkdtemp()
+        try:
+            self.assertEqual(
+                ["Warning: the balance of Assets:Acc1 on 2014/05/04 is 80.00 "
+                 "in {0} instead of 70.00.".format(
+                     os.path.join(d, "o.ledger"))],
+                self._run_with_balances(d))
+        finally:
+            shutil.rmtree(d)
+
+    def test_run_check_closing_balance(self):
+        d = tempfile.mkdtemp()
+        try:
+            messages = self._run_with_balances(d, 8000)
+            self.assertEqual([], messages)
+            self.assertTrue(os.path.exists(os.path.join(d,
+                                                        ".o.ledger.balances")))
+        finally:
+            shutil.rmtree(d)
+
+    # ------------------------ Progress -----------------------
+
+    def test_progress_is_throttled(self):
+        out = StringIO()
+        with patch("mylpl.time.time", side_effect=[0, 0, 0.1, 0.3, 0.4, 1]):
+            progress = mylpl.Progress(1000, out)
+            progress.stage("parse", position=lambda: 500)
+            progress.update()
+            progress.update()
+            progress.update()
+            progress.close()
+        lines = out.getvalue().split('\r')[1:]
+        self.assertEqual(["parse: 0s, 0.0/0.0 MB, 50%, ETA 0s",
+                          "parse: 2 rows, 7 rows/s, 0.0/0.0 MB, 50%, "
+                          "ETA 0s",
+                          "parse: 3 rows, 3 rows/s, 0.0/0.0 MB, 50%, "
+                          "ETA 1s\n"], lines)
+
+    def test_progress_rows_total(self):
+        out = StringIO()
+        with patch("mylpl.time.time", side_effect=[0, 0, 2]):
+            progress = mylpl.Progress(out=out)
+            progress.stage("resolve", 4)
+            progress.update()
+        self.assertTrue(out.getvalue().endswith(
+            "\rresolve: 1 rows, 0 rows/s, 25%, ETA 6s"))
+        progress.clear()
+        self.assertTrue(out.getvalue().endswith(" " * 37 + "\r"))
+
+    def test_progress_is_enabled(self):
+        self.assertFalse(mylpl.Progress.is_enabled(StringIO()))
+
+    def test_run_progress(self):
+        d = tempfile.mkdtemp()
+        try:
+            out = StringIO()
+            input = os.path.join(TEST_DATA_DIR, "RBC.csv")
+            # show every row
+            with patch.object(mylpl.Progress, "INTERVAL", 0):
+                mylpl.MyLedgerPal("RBC", input, os.path.join(d, "o.ledger"),
+                                  no_backup=True,
+                                  resources=mylpl.Resources(
+                                      self._get_resources_data(),
+                                      "dummy_path"),
+                                  progress=mylpl.Progress(
+                                      os.path.getsize(input), out)).run()
+            lines = out.getvalue().split('\r')
+            self.assertTrue(lines[-1].startswith("write: "))
+            self.assertTrue(lines[-1].endswith("\n"))
+            self.assertIn("resolve: 9 rows", out.getvalue())
+        finally:
+            shutil.rmtree(d)
+
+    # ------------------------ MemoryReport -----------------------
+
+    def test_memory_report_stages(self):
+        report = mylpl.MemoryReport()
+        with report.stage("one"):
+            pass
+        with report.stage("two"):
+            pass
+        stats = report.to_dict()
+        self.assertEqual(["one", "two"], [s["name"] for s in stats["stages"]])
+        for s in stats["stages"]:
+            self.assertGreaterEqual(s["seconds"], 0)
+            self.assertGreater(s["peak_bytes"], 0)
+        self.assertEqual(report.get_peak(), stats["peak_bytes"])
+
+    def test_memory_report_stage_recorded_on_error(self):
+        report = mylpl.MemoryReport()
+        with self.assertRaises(ValueError):
+            with report.stage("fail"):
+                raise ValueError()
+        self.assertEqual(["fail"],
+                         [s["name"] for s in report.to_dict()["stages"]])
+
+    def test_run_with_memory_report(self):
+        d = tempfile.mkdtemp()
+        try:
+            report = mylpl.MemoryReport()
+            app = mylpl.MyLedgerPal("RBC",
+                                    os.path.join(TEST_DATA_DIR, "RBC.csv"),
+                                    os.path.join(d, "out.ledger"),
+                                    no_backup=True, memory_report=report)
+            app.run()
+            path = os.path.join(d, "report.json")
+            report.write(path)
+            with open(path, 'r') as f:
+                stats = json.load(f)
+            self.assertEqual(["load-resources", "parse", "resolve", "write"],
+                             [s["name"] for s in stats["stages"]])
+        finally:
+            shutil.rmtree(d)
+
+    # ------------------------ Metrics ----------------------------
+
+    def test_metrics_prometheus(self):
+        metrics = mylpl.Metrics()
+        metrics.add("rows_read", 2)
+        metrics.add("rows_read", 3)
+        metrics.add("bytes_rewritten", 10, ledger='my "a".ledger')
+        lines = metrics.to_prometheus().splitlines()
+        self.assertIn("# TYPE mylpl_rows_read gauge", lines)
+        self.assertIn("mylpl_rows_read 5", lines)
+        self.assertIn('mylpl_bytes_rewritten{ledger="my \\"a\\".ledger"} 10',
+                      lines)
+        self.assertIn("mylpl_success 0", lines)
+
+    def test_metrics_write(self):
+        d = tempfile.mkdtemp()
+        try:
+            metrics = mylpl.Metrics()
+            metrics.set("success", 1)
+            metrics.add("stage_seconds", 2, stage="parse")
+            path = os.path.join(d, "mylpl.prom")
+            metrics.write(path)
+            metrics.write(path)
+            self.assertEqual(["mylpl.prom"], os.listdir(d))
+            with open(path, 'r') as f:
+                lines = f.read().splitlines()
+            self.assertIn('mylpl_stage_seconds{stage="parse"} 2', lines)
+            self.assertEqual(1, lines.count("mylpl_success 1"))
+            # the JSON lines are appended run after run
+            path = os.path.join(d, "mylpl.json")
+            metrics.write(path)
+            metrics.write(path)
+            with open(path, 'r') as f:
+                lines = [json.loads(l) for l in f]
+            self.assertEqual(2, len(lines))
+            self.assertEqual({"parse": 2}, lines[0]["stage_seconds"])
+            self.assertEqual(1, lines[0]["success"])
+        finally:
+            shutil.rmtree(d)
+
+    def test_run_with_metrics(self):
+        d = tempfile.mkdtemp()
+        try:
+            output = os.path.join(d, "out.ledger")
+            metrics = mylpl.Metrics()
+            mylpl.MyLedgerPal("RBC", os.path.join(TEST_DATA_DIR, "RBC.csv"),
+                              output, no_backup=True,
+                              resources=mylpl.Resources(
+                                  self._get_resources_data(), "dummy_path"),
+                              since=20140501, metrics=metrics).run()
+            stats = metrics.to_dict()
+            self.assertEqual(7, stats["rows_read"])
+            self.assertEqual(7, stats["posts_written"])
+            self.assertEqual(2, stats["rows_skipped"])
+            self.assertEqual(stats["rows_read"],
+                             stats["alias_hits"] + stats["alias_misses"])
+            self.assertEqual(stats["rows_read"],
+                             stats["rule_hits"] + stats["rule_misses"])
+            self.assertEqual(["parse", "resolve", "write"],
+                             sorted(stats["stage_seconds"]))
+            self.assertEqual({output: 0}, stats["ledger_bytes_before"])
+            self.assertEqual({output: os.path.getsize(output)},
+                             stats["ledger_bytes_after"])
+            self.assertEqual(stats["ledger_bytes_after"],
+                             stats["bytes_rewritten"])
+        finally:
+            shutil.rmtree(d)
+
+    def test_run_with_metrics_from_cache(self):
+        d = tempfile.mkdtemp()
+        try:
+            cache = mylpl.StatementCache(os.path.join(d, "cache"))
+            skipped = []
+            for output in ("a.ledger", "b.ledger"):
+                metrics = mylpl.Metrics()
+                mylpl.MyLedgerPal("RBC",
+                                  os.path.join(TEST_DATA_DIR, "RBC.csv"),
+                                  os.path.join(d, output), no_backup=True,
+                                  resources=mylpl.Resources(
+                                      self._get_resources_data(),
+                                      "dummy_path"),
+                                  cache=cache, since=20140501,
+                                  metrics=metrics).run()
+                skipped.append(metrics.to_dict()["rows_skipped"])
+            # the second import only resolves the cached rows
+            self.assertEqual([2, 2], skipped)
+        finally:
+            shutil.rmtree(d)
+
+    # ------------------------ Ledger -----------------------------
+
+    def _get_ledger_path(self):
+        d = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, d)
+        return os.path.join(d, "tmp.ledger")
+
+    def _read_and_remove(self, path):
+        with open(path, 'rb') as f:
+            content = f.read()
+        os.remove(path)
+        return content
+
+    def test_ledger_insert_new_file(self):
+        path = self._get_ledger_path()
+        mylpl.Ledger(path).insert([("2014/05/02", "2014/05/02 * B\n"),
+                                   ("2014/05/01", "2014/05/01 * A\n")])
+        self.assertEqual("; -*- ledger -*-\n"
+                         "\n2014/05/01 * A\n"
+                         "\n2014/05/02 * B\n", self._read_and_remove(path))
+
+    def test_ledger_insert_chronologically(self):
+        path = self._get_ledger_path()
+        ledger = mylpl.Ledger(path)
+        ledger.insert([("2014/05/01", "2014/05/01 * A\n"),
+                       ("2014/05/03", "2014/05/03 * C\n")])
+        ledger.insert([("2014/05/03", "2014/05/03 * D\n"),
+                       ("2014/05/02", "2014/05/02 * B\n")])
+        self.assertEqual("; -*- ledger -*-\n"
+                         "\n2014/05/01 * A\n"
+                         "\n2014/05/02 * B\n"
+                         "\n2014/05/03 * C\n"
+                         "\n2014/05/03 * D\n", self._read_and_remove(path))
+
+    def test_ledger_insert_keeps_index_up_to_date(self):
+        path = self._get_ledger_path()
+        ledger = mylpl.Ledger(path)
+        ledger.insert([("2014/05/01", "2014/05/01 * A\n"),
+                       ("2014/05/03", "2014/05/03 * C\n")])
+        ledger.insert([("2014/05/02", "2014/05/02 * B\n")])
+        fresh = mylpl.Ledger(path)
+        fresh._update_index()
+        self._read_and_remove(path)
+        self.assertEqual(fresh._offsets, ledger._offsets)
+        self.assertEqual(fresh._dates, ledger._dates)
+
+    def test_ledger_insert_adds_missing_directive(self):
+        path = self._get_ledger_path()
+        with open(path, 'wb') as f:
+            f.write("2014/05/02 * B\n")
+        mylpl.Ledger(path).insert([("2014/05/01", "2014/05/01 * A\n")])
+        self.assertEqual("; -*- ledger -*-\n"
+                         "2014/05/01 * A\n"
+                         "\n2014/05/02 * B\n", self._read_and_remove(path))
+
+    def test_ledger_insert_interrupted_is_recovered(self):
+        path = self._get_ledger_path()
+        ledger = mylpl.Ledger(path)
+        ledger.insert([("2014/05/0{0}".format(d), "2014/05/0{0} * E\n"
+                        .format(d)) for d in (1, 3, 5)])
+        original = self._read(path)
+        copy = shutil.copyfileobj
+
+        def crash(src, dst):
+            # the tail is saved, the new one is half written
+            if isinstance(src, file):
+                return copy(src, dst)
+            dst.write(src.read(10))
+            raise IOError(mylpl.errno.ENOSPC, "No space left on device")
+        with patch("shutil.copyfileobj", side_effect=crash):
+            with self.assertRaises(IOError):
+                mylpl.Ledger(path).insert([("2014/05/02",
+                                            "2014/05/02 * F\n")])
+        self.assertNotEqual(original, self._read(path))
+        mylpl.Ledger(path).insert([])
+        self.assertEqual(original, self._read(path))
+        self.assertEqual(["tmp.ledger"], os.listdir(os.path.dirname(path)))
+
+    def test_ledger_submit_coalesces_concurrent_batches(self):
+        path = self._get_ledger_path()
+        ledger = mylpl.Ledger(path)
+        ledger._write_lock.acquire()
+        threads = [threading.Thread(target=ledger.submit,
+                                    args=([(d, "{0} * X\n".format(d))],))
+                   for d in ("2014/05/02", "2014/05/01")]
+        with patch.object(ledger, "insert", wraps=ledger.insert) as m:
+            for t in threads:
+                t.start()
+            while len(ledger._pending) < 2:
+                time.sleep(0.001)
+            ledger._write_lock.release()
+            for t in threads:
+                t.join()
+        self.assertEqual(1, m.call_count)
+        # neither the lock nor the drained spool directory are left
+        self.assertEqual(["tmp.ledger"], os.listdir(os.path.dirname(path)))
+        self.assertEqual("; -*- ledger -*-\n"
+                         "\n2014/05/01 * X\n"
+                         "\n2014/05/02 * X\n", self._read_and_remove(path))
+
+    def _get_unsorted_ledger(self):
+        return ("; comment\n"
+                "2014/05/03 * C\n"
+                "    Expenses:num1   10.00 CAD  ; note\n"
+                "    Assets:Acc1\n"
+                "\n\n"
+                "2014/05/01 * A\n"
+                "\tExpenses:num2\t$ 5.00\n"
+                "    Assets:Acc1\n"
+                "; belongs to A\n"
+                "2014/05/03 * D\n"
+                "    Assets:Acc1\n"
+                "2014/05/02 * B\n"
+                "    Assets:Acc1")
+
+    def test_ledger_reformat(self):
+        path = self._get_ledger_path()
+        with open(path, 'wb') as f:
+            f.write(self._get_unsorted_ledger())
+        self.assertEqual(4, mylpl.Ledger(path).reformat())
+        self.assertEqual("; -*- ledger -*-\n"
+                         "; comment\n"
+                         "\n2014/05/01 * A\n"
+                         "\tExpenses:num2\t$ 5.00\n"
+                         "    Assets:Acc1\n"
+                         "; belongs to A\n"
+                         "\n2014/05/02 * B\n"
+                         "    Assets:Acc1\n"
+                         "\n2014/05/03 * C\n"
+                         "    Expenses:num1   10.00 CAD  ; note\n"
+                         "    Assets:Acc1\n"
+                         "\n2014/05/03 * D\n"
+                         "    Assets:Acc1\n", self._read_and_remove(path))
+
+    def test_ledger_reformat_spills_runs(self):
+        path = self._get_ledger_path()
+        with open(path, 'wb') as f:
+            f.write(self._get_unsorted_ledger())
+        ledger = mylpl.Ledger(path)
+        ledger.reformat()
+        expected = self._read(path)
+        with open(path, 'wb') as f:
+            f.write(self._get_unsorted_ledger())
+        with patch.object(ledger, "_spill", wraps=ledger._spill) as m:
+            ledger.reformat(memory=0)
+        self.assertEqual(4, m.call_count)
+        self.assertEqual(expected, self._read_and_remove(path))
+
+    def test_ledger_reformat_bounds_open_runs(self):
+        path = self._get_ledger_path()
+        with open(path, 'wb') as f:
+            for n in range(100):
+                f.write("2014/{0:02d}/{1:02d} * E{2}\n".format(
+                    n % 12 + 1, n % 28 + 1, n))
+        ledger = mylpl.Ledger(path)
+        opened = []
+        merge = heapq.merge
+        with patch.object(mylpl.Ledger, "MERGE_FAN_IN", 4):
+            with patch.object(ledger, "_merge_runs",
+                              wraps=ledger._merge_runs) as m:
+                with patch.object(mylpl.heapq, "merge",
+                                  side_effect=lambda *runs: opened.append(
+                                      len(runs)) or merge(*runs)):
+                    ledger.reformat(memory=0)
+        # 100 runs of one entry, 25 + 6 + 1 merges of 4 runs
+        self.assertEqual(32, m.call_count)
+        self.assertLessEqual(max(opened), 4 * 3)
+        dates = [l[:10] for l in self._read_and_remove(path).splitlines()
+                 if l[:1].isdigit()]
+        self.assertEqual(100, len(dates))
+        self.assertEqual(sorted(dates), dates)
+
+    def test_ledger_reformat_align(self):
+        path = self._get_ledger_path()
+        with open(path, 'wb') as f:
+            f.write(self._get_unsorted_ledger())
+        mylpl.Ledger(path).reformat(align=True)
+        lines = self._read_and_remove(path).splitlines()
+        self.assertIn("    Expenses:num2" + " " * 39 + "$ 5.00", lines)
+        self.assertIn("    Expenses:num1" + " " * 36 + "10.00 CAD  ; note",
+                      lines)
+        for l in lines:
+            if "Expenses" in l:
+                self.assertEqual(mylpl.Post.POST_AMOUNT_ALIGNMENT,
+                                 len(l.split("  ;")[0]))
+
+    def test_ledger_reformat_keeps_index_valid(self):
+        path = self._get_ledger_path()
+        with open(path, 'wb') as f:
+            f.write(self._get_unsorted_ledger())
+        ledger = mylpl.Ledger(path)
+        ledger.insert([("2014/05/02", "2014/05/02 * X\n")])
+        ledger.reformat()
+        ledger.insert([("2014/05/02", "2014/05/02 * Y\n")])
+        text = self._read_and_remove(path)
+        self.assertLess(text.index("* Y"), text.index("* C"))
+        self.assertLess(text.index("* X"), text.index("* Y"))
+
+    def _get_unknown_entry(self, payee, amount, currency="CAD"):
+        return str(mylpl.Post({"Assets:Acc1": 100}, currency, 20140505, "",
+                              payee, {"Expenses:Unknown": 100}, amount))
+
+    def test_ledger_recategorize(self):
+        path = self._get_ledger_path()
+        res = mylpl.Resources(self._get_resources_data(), "dummy_path")
+        debit = self._get_unknown_entry("XX SRC1 YY", -10)
+        credit = self._get_unknown_entry("SRC3", 25.5, "$")
+        unknown = self._get_unknown_entry("NOALIAS", -1)
+        edited = debit.replace("    Assets", "    ; edited\n    Assets")
+        with open(path, 'wb') as f:
+            f.write("; -*- ledger -*-\n\n" + debit + "\n" + credit +
+                    "\n" + unknown + "\n" + edited)
+        self.assertEqual(2, mylpl.Ledger(path).recategorize(res))
+        self.assertEqual(
+            "; -*- ledger -*-\n\n" +
+            str(mylpl.Post({"Assets:Acc1": 100}, "CAD", 20140505, "",
+                           "Source1", {"Expenses:num1": 100}, -10)) + "\n" +
+            str(mylpl.Post({"Assets:Acc1": 100}, "$", 20140505, "",
+                           "Source3", {"Expenses:num2": 40,
+                                       "Expenses:num3": 60}, 25.5)) +
+            "\n" + unknown + "\n" + edited, self._read_and_remove(path))
+
+    def test_ledger_recategorize_nothing_to_fix(self):
+        path = self._get_ledger_path()
+        res = mylpl.Resources(self._get_resources_data(), "dummy_path")
+        text = self._get_unknown_entry("NOALIAS", -1)
+        with open(path, 'wb') as f:
+            f.write(text)
+        mtime = os.path.getmtime(path)
+        self.assertEqual(0, mylpl.Ledger(path).recategorize(res))
+        self.assertEqual(mtime, os.path.getmtime(path))
+        self.assertFalse(os.path.exists(path + ".tmp"))
+        self.assertEqual(text, self._read_and_remove(path))
+
+    def test_ledger_get_splits(self):
+        path = self._get_ledger_path()
+        with open(path, 'wb') as f:
+            f.write("; -*- ledger -*-\n\n" +
+                    str(mylpl.Post({"Assets:Acc1": 100}, "CAD", 20140505, "",
+                                   "IGA #12", {"Expenses:num1": 100}, -10)) +
+                    "\n" + self._get_unknown_entry("NOALIAS", -1) +
+                    "\n2014/05/06 ! (12) Hydro  ; paid\n"
+                    "    Expenses:num2  $ 1,000.00\n"
+                    "    ; split by hand\n"
+                    "    Expenses:num3  $ 500.00\n"
+                    "    Assets:Acc1\n"
+                    "\n2014/05/07 * Transfer\n"
+                    "    Assets:Acc1  $ 10.00\n"
+                    "    Liabilites:Acc2\n")
+        accounts = {"Assets:Acc1", "Liabilites:Acc2"}
+        self.assertEqual(
+            [(u"IGA #12", ((u"Expenses:num1", 100),)),
+             (u"Hydro", ((u"Expenses:num2", 67), (u"Expenses:num3", 33)))],
+            list(mylpl.Ledger(path).get_splits(accounts)))
+        # the typo of Liabilites is not a balance account anymore
+        self.assertEqual((u"Transfer", ((u"Liabilites:Acc2", 100),)),
+                         list(mylpl.Ledger(path).get_splits())[-1])
+        os.remove(path)
+
+    def test_ledger_get_splits_unknown_balancing_account(self):
+        path = self._get_ledger_path()
+        with open(path, 'wb') as f:
+            f.write("2014/05/06 * Store\n"
+                    "    Expenses:num1  $ 50.00\n"
+                    "    Assets:Other  $ -50.00\n")
+        # Assets:Other is not an account of my statements
+        self.assertEqual([(u"Store", ((u"Expenses:num1", 100),))],
+                         list(mylpl.Ledger(path).get_splits(
+                             {"Assets:Acc1"})))
+
+    def test_balance_index_add(self):
+        index = mylpl.BalanceIndex()
+        index.add([("A", 20140510, 1000), ("A", 20140505, -250),
+                   ("B", 20140505, 1)])
+        index.add([("A", 20140507, 100), ("A", 20140510, 50)])
+        self.assertEqual(0, index.get_balance("A", 20140504))
+        self.assertEqual(-250, index.get_balance("A", 20140506))
+        self.assertEqual(-150, index.get_balance("A", 20140507))
+        self.assertEqual(900, index.get_balance("A", 20141231))
+        self.assertEqual(1, index.get_balance("B", 20140505))
+        self.assertEqual(0, index.get_balance("C", 20140505))
+
+    def test_ledger_get_balances_updated_by_insert(self):
+        path = self._get_ledger_path()
+        post = str(mylpl.Post({"Assets:Acc1": 100}, "CAD", 20140505, "",
+                              "X", {"Expenses:num1": 100}, -10))
+        with open(path, 'wb') as f:
+            f.write("2014/05/01 * Opening\n"
+                    "    Assets:Acc1  100.00 CAD\n"
+                    "    Equity:Opening\n")
+        ledger = mylpl.Ledger(path)
+        balances = ledger.get_balances()
+        self.assertEqual(10000, balances.get_balance("Assets:Acc1",
+                                                     20140505))
+        ledger.insert([("2014/05/05", post)])
+        with patch.object(mylpl.Ledger, "_split_entries") as m:
+            balances = mylpl.Ledger(path).get_balances()
+            self.assertFalse(m.called)
+        self.assertEqual(9000, balances.get_balance("Assets:Acc1",
+                                                    20140505))
+        self.assertEqual(1000, balances.get_balance("Expenses:num1",
+                                                    20140505))
+        # modified by something else, the index is built again
+        with open(path, 'ab') as f:
+            f.write("\n" + post)
+        self.assertEqual(8000, mylpl.Ledger(path).get_balances().get_balance(
+            "Assets:Acc1", 20140505))
+        os.remove(mylpl.BalanceIndex.get_path(path))
+        os.remove(path)
+
+    def _get_planned_ledger(self):
+        path = self._get_ledger_path()
+        with open(path, 'wb') as f:
+            f.write("; -*- ledger -*-\n")
+            for d in range(1, 10):
+                f.write("\n2014/05/0{0} * E\n".format(d))
+        return path
+
+    def test_ledger_plan(self):
+        path = self._get_planned_ledger()
+        before = self._read(path)
+        entries = [("2014/05/09", "2014/05/09 * X\n"),
+                   ("2014/05/01", "2014/05/01 * Y\n")]
+        planned = mylpl.Ledger(path).plan(entries)
+        self.assertEqual(before, self._read_and_remove(path))
+        self.assertEqual(
+            [{"line": 5, "date": "2014/05/01", "text": "2014/05/01 * Y\n"},
+             {"line": 20, "date": "2014/05/09", "text": "2014/05/09 * X\n"}],
+            planned)
+
+    def test_ledger_plan_new_file(self):
+        path = self._get_ledger_path()
+        self.assertEqual(
+            [{"line": 1, "date": None, "text": "; -*- ledger -*-\n"},
+             {"line": 1, "date": "2014/05/01", "text": "2014/05/01 * Y\n"}],
+            mylpl.Ledger(path).plan([("2014/05/01", "2014/05/01 * Y\n")]))
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual([], mylpl.Ledger(path).plan([]))
+
+    def test_ledger_diff(self):
+        path = self._get_planned_ledger()
+        entries = [("2014/05/09", "2014/05/09 * X\n"),
+                   ("2014/05/01", "2014/05/01 * Y\n")]
+        diff = "".join(mylpl.Ledger(path).diff(entries, 2, "a.ledger"))
+        self.assertEqual("--- a.ledger\n"
+                         "+++ a.ledger\n"
+                         "@@ -3,4 +3,6 @@\n"
+                         " 2014/05/01 * E\n"
+                         " \n"
+                         "+2014/05/01 * Y\n"
+                         "+\n"
+                         " 2014/05/02 * E\n"
+                         " \n"
+                         "@@ -18,2 +20,4 @@\n"
+                         " \n"
+                         " 2014/05/09 * E\n"
+                         "+\n"
+                         "+2014/05/09 * X\n", diff)
+        # the context of close insertions is shared
+        diff = list(mylpl.Ledger(path).diff(entries, 8))
+        self.assertEqual(1, sum(1 for l in diff if l.startswith("@@")))
+        diff = list(mylpl.Ledger(path).diff(entries, 0))
+        self.assertIn("@@ -4,0 +5,2 @@\n", diff)
+        self._read_and_remove(path)
+
+    def test_ledger_diff_matches_insert(self):
+        path = self._get_planned_ledger()
+        entries = [("2014/05/03", "2014/05/03 * X\n"),
+                   ("2014/05/07", "2014/05/07 * Y\n    A  1\n")]
+        diff = list(mylpl.Ledger(path).diff(entries, 0))
+        with open(path, 'rb') as f:
+            lines = f.readlines()
+        # apply the hunks from the last one
+        for n in reversed([n for n, l in enumerate(diff)
+                           if l.startswith("@@")]):
+            old = int(diff[n].split()[1].split(",")[0][1:])
+            added = []
+            for l in diff[n + 1:]:
+                if not l.startswith("+"):
+                    break
+                added.append(l[1:])
+            lines[old:old] = added
+        mylpl.Ledger(path).insert(entries)
+        self.assertEqual("".join(lines), self._read_and_remove(path))
+
+    def test_run_plan_writes_nothing(self):
+        d = tempfile.mkdtemp()
+        try:
+            output = os.path.join(d, "o.ledger")
+            cache = mylpl.StatementCache(os.path.join(d, "cache"))
+            app = mylpl.MyLedgerPal("RBC",
+                                    os.path.join(TEST_DATA_DIR, "RBC.csv"),
+                                    output, cache=cache, plan="json")
+            stdout = StringIO()
+            with patch("sys.stdout", stdout):
+                app.run()
+            planned = json.loads(stdout.getvalue())
+            self.assertEqual(output, planned[0]["ledger"])
+            self.assertEqual(mylpl.LEDGER_MODE_DIRECTIVE + "\n",
+                             planned[0]["text"])
+            self.assertEqual([], os.listdir(d))
+        finally:
+            shutil.rmtree(d)
+
+    # ------------------------ ShardedLedger -----------------------------
+
+    def _read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_sharded_ledger_get_shard_path(self):
+        year = mylpl.ShardedLedger("/l/main.ledger", "year")
+        month = mylpl.ShardedLedger("/l/main.ledger", "month")
+        self.assertEqual("/l/main-2014.ledger",
+                         year.get_shard_path("2014/05/01"))
+        self.assertEqual("/l/main-2014-05.ledger",
+                         month.get_shard_path("2014/05/01"))
+
+    def test_sharded_ledger_unknown_period(self):
+        with self.assertRaises(Exception) as exception_ctx:
+            mylpl.ShardedLedger("/l/main.ledger", "week")
+        self.assertEqual(mylpl.ERR_PERIOD_UNKNOWN.format("week",
+                                                         "year, month"),
+                         exception_ctx.exception.message)
+
+    def test_sharded_ledger_insert(self):
+        d = tempfile.mkdtemp()
+        try:
+            master = os.path.join(d, "main.ledger")
+            ledger = mylpl.ShardedLedger(master, "year")
+            ledger.insert([("2015/01/01", "2015/01/01 * B\n")])
+            ledger.insert([("2014/01/01", "2014/01/01 * A\n")])
+            self.assertEqual("; -*- ledger -*-\n"
+                             "include main-2014.ledger\n"
+                             "include main-2015.ledger\n",
+                             self._read(master))
+            self.assertEqual("; -*- ledger -*-\n"
+                             "\n2014/01/01 * A\n",
+                             self._read(os.path.join(d, "main-2014.ledger")))
+        finally:
+            shutil.rmtree(d)
+
+    def test_sharded_ledger_split(self):
+        d = tempfile.mkdtemp()
+        try:
+            master = os.path.join(d, "main.ledger")
+            with open(master, 'wb') as f:
+                f.write("; -*- ledger -*-\n\n"
+                        "2015/01/01 * B\n\n"
+                        "2014/01/01 * A\n")
+            ledger = mylpl.ShardedLedger(master, "year")
+            lock = os.path.join(d, ".main.ledger.lock")
+            locked = []
+            write = ledger._write
+            with patch.object(ledger, "_write", side_effect=lambda lines: (
+                    locked.append(os.path.exists(lock)), write(lines))):
+                shards = ledger.split()
+            # the master is replaced while the imports wait for it
+            self.assertEqual([True], locked)
+            self.assertEqual([os.path.join(d, "main-2014.ledger"),
+                              os.path.join(d, "main-2015.ledger")], shards)
+            self.assertEqual("; -*- ledger -*-\n\n"
+                             "include main-2014.ledger\n"
+                             "include main-2015.ledger\n",
+                             self._read(master))
+            self.assertEqual("; -*- ledger -*-\n\n"
+                             "2015/01/01 * B\n\n",
+                             self._read(shards[1]))
+            self.assertEqual(["main-2014.ledger", "main-2015.ledger",
+                              "main.ledger"], sorted(os.listdir(d)))
+        finally:
+            shutil.rmtree(d)
+
+    def test_sharded_ledger_split_shard_exists(self):
+        d = tempfile.mkdtemp()
+        try:
+            master = os.path.join(d, "main.ledger")
+            with open(master, 'wb') as f:
+                f.write("2014/01/01 * A\n")
+            open(os.path.join(d, "main-2014.ledger"), 'w').close()
+            with self.assertRaises(Exception):
+                mylpl.ShardedLedger(master, "year").split()
+            self.assertEqual(["main-2014.ledger", "main.ledger"],
+                             sorted(os.listdir(d)))
+        finally:
+            shutil.rmtree(d)
+
+    def _spool_batch(self, ledger, pid, entries):
+        d = ledger._get_spool_dir()
+        if not os.path.isdir(d):
+            os.mkdir(d)
+        with open(os.path.join(d, "0-{0}-x.batch".format(pid)), 'wb') as f:
+            marshal.dump((False, entries), f)
+
+    def test_ledger_submit_writes_batches_spooled_by_other_processes(self):
+        d = tempfile.mkdtemp()
+        try:
+            ledger = mylpl.Ledger(os.path.join(d, "main.ledger"))
+            self._spool_batch(ledger, os.getpid(),
+                              [("2014/05/02", "2014/05/02 * B\n")])
+            ledger.submit([("2014/05/01", "2014/05/01 * A\n")])
+            self.assertEqual("; -*- ledger -*-\n"
+                             "\n2014/05/01 * A\n"
+                             "\n2014/05/02 * B\n",
+                             self._read(ledger.get_path()))
+            self.assertFalse(os.path.exists(ledger._get_spool_dir()))
+        finally:
+            shutil.rmtree(d)
+
+    def test_ledger_submit_ignores_batches_of_dead_processes(self):
+        d = tempfile.mkdtemp()
+        try:
+            ledger = mylpl.Ledger(os.path.join(d, "main.ledger"))
+            p = subprocess.Popen(["true"])
+            p.wait()
+            self._spool_batch(ledger, p.pid,
+                              [("2014/05/02", "2014/05/02 * B\n")])
+            ledger.submit([("2014/05/01", "2014/05/01 * A\n")])
+            self.assertEqual("; -*- ledger -*-\n"
+                             "\n2014/05/01 * A\n",
+                             self._read(ledger.get_path()))
+            self.assertFalse(os.path.exists(ledger._get_spool_dir()))
+        finally:
+            shutil.rmtree(d)
+
+    # ------------------------ ImportService -----------------------------
+
+    def test_import_service_handle(self):
+        path = self._get_ledger_path()
+        service = mylpl.ImportService()
+        replies = []
+        service.handle({"bank": "RBC",
+                        "input": os.path.join(TEST_DATA_DIR, "RBC.csv"),
+                        "output": path}, replies.append)
+        self._read_and_remove(path)
+        self.assertEqual(10, len(replies))
+        self.assertEqual({"posts": 9, "output": path}, replies[-1])
+
+    def test_import_service_keeps_resources_loaded(self):
+        service = mylpl.ImportService()
+        path = os.path.join(TEST_DATA_DIR, "tmp.ledger")
+        self.assertEqual(service._get_resources(path),
+                         service._get_resources(path))
+
+    def test_import_service_serializes_resources(self):
+        service = mylpl.ImportService()
+        path = self._get_ledger_path()
+        resources, lock = service._get_resources(path)
+        with patch.object(service, "_get_resources",
+                          return_value=(resources, lock)):
+            with patch.object(mylpl.MyLedgerPal, "_read_input",
+                              side_effect=lambda: [lock.locked()]):
+                with patch.object(mylpl.MyLedgerPal, "_get_ledger_entry",
+                                  side_effect=lambda locked: (
+                                      "2014/05/05", str(locked))):
+                    replies = []
+                    service.handle({"bank": "RBC",
+                                    "input": os.path.join(TEST_DATA_DIR,
+                                                          "RBC.csv"),
+                                    "output": path}, replies.append)
+        self.assertEqual({"post": "True"}, replies[0])
+        self.assertFalse(lock.locked())
+
+    def test_serve_keeps_file_at_socket_path(self):
+        path = self._get_ledger_path()
+        with open(path, 'w') as f:
+            f.write("; -*- ledger -*-\n")
+        with self.assertRaises(Exception) as exception_ctx:
+            mylpl.serve(path)
+        self.assertEqual(mylpl.ERR_NOT_A_SOCKET.format(path),
+                         exception_ctx.exception.message)
+        self.assertTrue(os.path.isfile(path))
+
+    def test_serve_keeps_socket_of_running_service(self):
+        path = self._get_ledger_path()
+        server = mylpl.ThreadingUnixServer(path, mylpl.ImportRequestHandler)
+        try:
+            with self.assertRaises(Exception) as exception_ctx:
+                mylpl.serve(path)
+            self.assertEqual(mylpl.ERR_SERVICE_RUNNING.format(path),
+                             exception_ctx.exception.message)
+            self.assertTrue(os.path.exists(path))
+        finally:
+            server.server_close()
+        # left by a service which is gone
+        self.assertFalse(mylpl._is_socket_listened(path))
+
+    def test_import_service_missing_input(self):
+        service = mylpl.ImportService()
+        with self.assertRaises(Exception) as exception_ctx:
+            service.handle({"bank": "RBC"}, None)
+        self.assertEqual(mylpl.ERR_INVALID_REQUEST.format("missing 'input'"),
+                         exception_ctx.exception.message)
+
 if __name__ == '__main__':
     unittest.main()